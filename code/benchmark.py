@@ -0,0 +1,243 @@
+"""Нагрузочные замеры хранилища и разборщика команд.
+
+Для каждого размера таблицы создаётся синтетическая база со столбцами всех типов, после чего
+по очереди замеряются вставка, точечные и диапазонные выборки, изменение, удаление
+и удаление таблицы. Каждый размер обрабатывается в отдельном процессе, чтобы пиковый объём
+памяти относился только к нему. Результаты записываются в JSON и могут сравниваться
+с результатами другой ревизии:
+
+    python benchmark.py --rows 10000 100000 --out new.json --compare old.json
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from database import Database
+from parser import eval_node, execute, prepare
+
+TABLE = 'bench'
+COLUMNS = {'id': 'integer', 'price': 'float', 'name': 'string', 'note': 'text'}
+WORDS = ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta')
+INSERT_BATCH = 10000
+RANGE_WIDTH = 100
+PERCENTILES = (50, 95, 99)
+
+
+def make_row(rng: random.Random, i: int) -> list:
+    # Часть строк text длиннее поля записи и попадает в кучу таблицы
+    note = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 12)))
+    return [i, round(rng.uniform(0, 1000), 2), f'{rng.choice(WORDS)}-{i}', note]
+
+
+def where(text: str) -> ast.Expression:
+    return ast.parse(text, mode='eval')
+
+
+def percentile(ordered: list, p: int) -> float:
+    # Ближайший ранг по отсортированной выборке
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+class Recorder:
+    """Собирает время операций каждой фазы и пиковую память процесса."""
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.phases = {}
+
+    def phase(self, name: str, operations, items: int = None):
+        """Выполняет операции фазы по одной и замеряет каждую.
+
+        operations -- итерируемый набор функций без аргументов; items -- число обработанных
+        строк, если пропускная способность считается по строкам, а не по операциям.
+        """
+        if self.trace_memory:
+            tracemalloc.start()
+        latencies = []
+        clock = time.perf_counter
+        started = clock()
+        for operation in operations:
+            t = clock()
+            operation()
+            latencies.append(clock() - t)
+        total = clock() - started
+        result = {
+            'ops': len(latencies),
+            'total_s': total,
+            'ops_per_s': len(latencies) / total if total else None,
+        }
+        if items is not None:
+            result['rows_per_s'] = items / total if total else None
+        ordered = sorted(latencies)
+        if ordered:
+            for p in PERCENTILES:
+                result[f'p{p}_ms'] = percentile(ordered, p) * 1000
+            result['max_ms'] = ordered[-1] * 1000
+        # ru_maxrss в Linux измеряется в килобайтах
+        result['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if self.trace_memory:
+            result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.phases[name] = result
+        return result
+
+
+def run_size(rows: int, ops: int, seed: int, directory: str, trace_memory: bool) -> dict:
+    """Все фазы замера для таблицы из rows строк; выполняется в отдельном процессе."""
+    rng = random.Random(seed)
+    path = os.path.join(directory, f'bench-{rows}.db')
+    for name in (path, path + '-wal'):
+        if os.path.exists(name):
+            os.remove(name)
+    recorder = Recorder(trace_memory)
+    db = Database(path, keep_open=True)
+    db.create_table(TABLE, COLUMNS)
+
+    def insert_batch(start):
+        return lambda: db.insert_many(TABLE, [make_row(rng, i) for i in range(start, min(start + INSERT_BATCH, rows))])
+
+    recorder.phase('bulk_insert', [insert_batch(start) for start in range(0, rows, INSERT_BATCH)], items=rows)
+    next_id = rows
+    inserted = [make_row(rng, next_id + i) for i in range(ops)]
+    next_id += ops
+    recorder.phase('insert', [lambda row=row: db.insert(TABLE, row) for row in inserted])
+    total = rows + ops
+    recorder.phase('full_scan', [lambda: db.select(TABLE, ['*'])], items=total)
+
+    def point(k):
+        return lambda: db.select(TABLE, ['*'], where=where(f'id == {k}'))
+
+    def span(k):
+        return lambda: db.select(TABLE, ['id', 'price'], where=where(f'id >= {k} and id < {k + RANGE_WIDTH}'))
+
+    # Сканирующие фазы на миллионе строк медленные, поэтому число операций ограничено ops
+    keys = [rng.randrange(total) for _ in range(ops)]
+    recorder.phase('point_select', [point(k) for k in keys])
+    recorder.phase('range_select', [span(rng.randrange(total)) for _ in range(ops)])
+    recorder.phase('update', [lambda k=k: db.update(TABLE, {'price': 1.5}, where=where(f'id == {k}')) for k in keys])
+    victims = rng.sample(range(total), 2 * ops)
+    recorder.phase('delete', [lambda k=k: db.delete(TABLE, where=where(f'id == {k}')) for k in victims[:ops]])
+
+    recorder.phase('create_index', [lambda: db.create_index(TABLE, 'id')])
+    indexed_keys = [rng.randrange(total) for _ in range(ops * 10)]
+    recorder.phase('point_select_index', [point(k) for k in indexed_keys])
+    recorder.phase('range_select_index', [span(rng.randrange(total)) for _ in range(ops * 10)])
+    recorder.phase('update_index',
+                   [lambda k=k: db.update(TABLE, {'price': 2.5}, where=where(f'id == {k}')) for k in indexed_keys])
+    recorder.phase('delete_index', [lambda k=k: db.delete(TABLE, where=where(f'id == {k}')) for k in victims[ops:]])
+
+    # Разбор команды: текст каждый раз новый, поэтому кэш планов не срабатывает
+    commands = [f'select id name from {TABLE} where id == {i} and price > {i % 1000}' for i in range(ops * 100)]
+    recorder.phase('parse', [lambda c=c: prepare(c) for c in commands])
+    statement = prepare(f'select id name from {TABLE} where id == ?')
+    recorder.phase('execute_prepared', [lambda k=k: execute(statement, db, (k,)) for k in indexed_keys])
+    condition = where('id >= 10 and (price * 2 < 1500 or name in ("a", "b")) and not note == ""')
+    sample = [dict(zip(COLUMNS, make_row(rng, i))) for i in range(ops * 100)]
+    recorder.phase('eval_node', [lambda row=row: eval_node(condition, row) for row in sample])
+
+    db.flush()
+    size = os.path.getsize(path)
+    recorder.phase('drop_table', [lambda: db.drop_table(TABLE)])
+    db.close()
+    for name in (path, path + '-wal'):
+        if os.path.exists(name):
+            os.remove(name)
+    return {'rows': rows, 'file_bytes': size, 'phases': recorder.phases}
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: dict, new: dict):
+    # Отношение нового времени к старому по медиане и по общему времени фазы; меньше 1 -- ускорение
+    previous = {r['rows']: r['phases'] for r in old['results']}
+    print(f"{'rows':>8} {'phase':<20} {'p50 old':>10} {'p50 new':>10} {'ratio':>7} {'total ratio':>12}")
+    for result in new['results']:
+        phases = previous.get(result['rows'])
+        if phases is None:
+            continue
+        for name, stats in result['phases'].items():
+            before = phases.get(name)
+            if before is None or 'p50_ms' not in stats or 'p50_ms' not in before:
+                continue
+            ratio = stats['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('nan')
+            total = stats['total_s'] / before['total_s'] if before['total_s'] else float('nan')
+            print(f"{result['rows']:>8} {name:<20} {before['p50_ms']:>10.3f} {stats['p50_ms']:>10.3f} "
+                  f"{ratio:>7.2f} {total:>12.2f}")
+
+
+def summary(result: dict):
+    print(f"{result['rows']} строк, файл {result['file_bytes']} байт", file=sys.stderr)
+    for name, stats in result['phases'].items():
+        rate = stats.get('rows_per_s') or stats['ops_per_s']
+        unit = 'строк/с' if 'rows_per_s' in stats else 'оп/с'
+        print(f"  {name:<20} {rate:>12.1f} {unit:<8} p50 {stats.get('p50_ms', 0):9.3f} мс  "
+              f"p99 {stats.get('p99_ms', 0):9.3f} мс  RSS {stats['peak_rss_bytes'] // 2**20} МиБ", file=sys.stderr)
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(description='Замеры производительности СУБД')
+    arguments.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                           help='размеры таблицы, по умолчанию 10000 и 100000')
+    arguments.add_argument('--ops', type=int, default=20,
+                           help='число операций в сканирующих фазах; индексные выполняются в 10 раз чаще')
+    arguments.add_argument('--seed', type=int, default=1)
+    arguments.add_argument('--dir', help='каталог для временных баз, по умолчанию временный')
+    arguments.add_argument('--trace-memory', action='store_true',
+                           help='пиковая память выделений Python по фазам (замедляет замеры)')
+    arguments.add_argument('--out', help='файл результатов JSON, по умолчанию стандартный вывод')
+    arguments.add_argument('--compare', help='результаты предыдущего запуска для сравнения')
+    args = arguments.parse_args(argv)
+
+    directory = args.dir or tempfile.mkdtemp(prefix='vkr-bench-')
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    try:
+        for rows in args.rows:
+            # Новый процесс на каждый размер: пиковый RSS не наследуется от предыдущего
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_size, rows, args.ops, args.seed, directory, args.trace_memory).result()
+            summary(result)
+            results.append(result)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'revision': revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {'ops': args.ops, 'seed': args.seed, 'trace_memory': args.trace_memory},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as file:
+            file.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            compare(json.load(file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+from struct import Struct
+
+LEAF = 1
+INTERNAL = 2
+DEAD_END = 256**4 - 1
+# Заголовок узла: тип, количество ключей, следующий лист (для листа) или крайний левый потомок
+NODE_HEADER = Struct('=BHI')
+FIRST = -1
+LAST = 256**4
+
+
+class BTree:
+    """B+-дерево в страницах файла БД.
+
+    Ключ записи составной: (значение столбца, страница, слот), поэтому повторяющиеся значения
+    столбца различаются ссылкой на запись. Страницы берутся у движка через db.
+    """
+
+    def __init__(self, db, file, key_code: str, root: int):
+        self.db = db
+        self.file = file
+        self.root = root
+        self.leaf = Struct('=' + key_code + 'IH')
+        self.node = Struct('=' + key_code + 'IHI')
+        page_size = db.pool.page_size
+        self.leaf_cap = (page_size - NODE_HEADER.size) // self.leaf.size
+        self.node_cap = (page_size - NODE_HEADER.size) // self.node.size
+
+    @classmethod
+    def create(cls, db, file, key_code: str, entries=()):
+        tree = cls(db, file, key_code, DEAD_END)
+        tree.root = tree._build(sorted(entries))
+        return tree
+
+    def _frame(self, page):
+        return self.db._page(self.file, page)
+
+    def _new_page(self, content: bytes):
+        page = self.db._take_vacant_page(self.file)
+        self.db.pool.new(self.file, page, content)
+        return page
+
+    def _write(self, page, content: bytes):
+        self.db.pool.new(self.file, page, content)
+
+    def _leaf_bytes(self, next_leaf, entries):
+        pack = self.leaf.pack
+        return NODE_HEADER.pack(LEAF, len(entries), next_leaf) + b''.join(pack(*e) for e in entries)
+
+    def _node_bytes(self, child, entries):
+        pack = self.node.pack
+        return NODE_HEADER.pack(INTERNAL, len(entries), child) + b''.join(pack(*e) for e in entries)
+
+    def _entries(self, frame, struct_, n):
+        start = NODE_HEADER.size
+        return list(struct_.iter_unpack(memoryview(frame)[start:start + struct_.size * n]))
+
+    def _bisect(self, frame, struct_, n, key, right=False):
+        lo, hi = 0, n
+        size = struct_.size
+        start = NODE_HEADER.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = struct_.unpack_from(frame, start + mid * size)[:3]
+            if probe < key or (right and probe == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _descend(self, key):
+        # Путь от корня до листа: список пар (страница узла, номер выбранного потомка)
+        path = []
+        page = self.root
+        while True:
+            frame = self._frame(page)
+            kind, n, child = NODE_HEADER.unpack_from(frame)
+            if kind == LEAF:
+                return page, path
+            i = 0 if key is None else self._bisect(frame, self.node, n, key, right=True)
+            path.append((page, i))
+            if i > 0:
+                child = self.node.unpack_from(frame, NODE_HEADER.size + (i - 1) * self.node.size)[3]
+            page = child
+
+    def insert(self, key, page, slot):
+        entry = (key, page, slot)
+        leaf, path = self._descend(entry)
+        frame = self._frame(leaf)
+        _, n, next_leaf = NODE_HEADER.unpack_from(frame)
+        pos = self._bisect(frame, self.leaf, n, entry)
+        size = self.leaf.size
+        start = NODE_HEADER.size + pos * size
+        if n < self.leaf_cap:
+            end = NODE_HEADER.size + n * size
+            frame[start + size:end + size] = frame[start:end]
+            self.leaf.pack_into(frame, start, *entry)
+            NODE_HEADER.pack_into(frame, 0, LEAF, n + 1, next_leaf)
+            self.db.pool.mark_dirty(leaf)
+            return
+        entries = self._entries(frame, self.leaf, n)
+        entries.insert(pos, entry)
+        mid = len(entries) // 2
+        right = self._new_page(self._leaf_bytes(next_leaf, entries[mid:]))
+        self._write(leaf, self._leaf_bytes(right, entries[:mid]))
+        self._insert_separator(path, entries[mid], right)
+
+    def _insert_separator(self, path, separator, right):
+        while path:
+            page, i = path.pop()
+            frame = self._frame(page)
+            _, n, child = NODE_HEADER.unpack_from(frame)
+            entries = self._entries(frame, self.node, n)
+            entries.insert(i, (*separator[:3], right))
+            if len(entries) <= self.node_cap:
+                self._write(page, self._node_bytes(child, entries))
+                return
+            mid = len(entries) // 2
+            up = entries[mid]
+            right = self._new_page(self._node_bytes(up[3], entries[mid + 1:]))
+            self._write(page, self._node_bytes(child, entries[:mid]))
+            separator = up
+        self.root = self._new_page(self._node_bytes(self.root, [(*separator[:3], right)]))
+
+    def delete(self, key, page, slot) -> bool:
+        # Узлы не объединяются: опустевшие листы остаются в цепочке до перестроения индекса
+        entry = (key, page, slot)
+        leaf, _ = self._descend(entry)
+        frame = self._frame(leaf)
+        _, n, next_leaf = NODE_HEADER.unpack_from(frame)
+        pos = self._bisect(frame, self.leaf, n, entry)
+        size = self.leaf.size
+        start = NODE_HEADER.size + pos * size
+        if pos >= n or self.leaf.unpack_from(frame, start) != entry:
+            return False
+        end = NODE_HEADER.size + n * size
+        frame[start:end - size] = frame[start + size:end]
+        NODE_HEADER.pack_into(frame, 0, LEAF, n - 1, next_leaf)
+        self.db.pool.mark_dirty(leaf)
+        return True
+
+    def range(self, lo=None, lo_inclusive=True, hi=None, hi_inclusive=True):
+        bound = None if lo is None else (lo, FIRST, FIRST) if lo_inclusive else (lo, LAST, LAST)
+        leaf, _ = self._descend(bound)
+        frame = self._frame(leaf)
+        _, n, next_leaf = NODE_HEADER.unpack_from(frame)
+        pos = 0 if bound is None else self._bisect(frame, self.leaf, n, bound)
+        while True:
+            for key, page, slot in self._entries(frame, self.leaf, n)[pos:]:
+                if hi is not None and (key > hi or (key == hi and not hi_inclusive)):
+                    return
+                yield page, slot
+            if next_leaf == DEAD_END:
+                return
+            frame = self._frame(next_leaf)
+            _, n, next_leaf = NODE_HEADER.unpack_from(frame)
+            pos = 0
+
+    def _build(self, entries):
+        # Построение дерева снизу вверх из отсортированных записей
+        chunks = [entries[i:i + self.leaf_cap] for i in range(0, len(entries), self.leaf_cap)] or [[]]
+        pages = [self.db._take_vacant_page(self.file) for _ in chunks]
+        for i, chunk in enumerate(chunks):
+            next_leaf = pages[i + 1] if i + 1 < len(pages) else DEAD_END
+            self._write(pages[i], self._leaf_bytes(next_leaf, chunk))
+        level = [(chunk[0] if chunk else None, page) for chunk, page in zip(chunks, pages)]
+        while len(level) > 1:
+            upper = []
+            step = self.node_cap + 1
+            for i in range(0, len(level), step):
+                group = level[i:i + step]
+                entries = [(*first[:3], page) for first, page in group[1:]]
+                upper.append((group[0][0], self._new_page(self._node_bytes(group[0][1], entries))))
+            level = upper
+        return level[0][1]
+
+    def pages(self) -> list:
+        result = []
+        stack = [self.root]
+        while stack:
+            page = stack.pop()
+            result.append(page)
+            frame = self._frame(page)
+            kind, n, child = NODE_HEADER.unpack_from(frame)
+            if kind == INTERNAL:
+                stack.append(child)
+                stack.extend(e[3] for e in self._entries(frame, self.node, n))
+        return result
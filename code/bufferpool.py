@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+
+class BufferPool:
+    def __init__(self, capacity: int, page_size: int, base_offset: int):
+        if capacity < 8:
+            raise ValueError('Размер буферного пула должен быть не меньше 8 страниц')
+        self.capacity = capacity
+        self.page_size = page_size
+        self.base_offset = base_offset
+        self.frames = OrderedDict()
+        self.dirty = set()
+        # steal=False запрещает вытеснять изменённые страницы в файл: до фиксации они остаются в пуле,
+        # который при необходимости временно превышает capacity. Если задана функция log, то при
+        # пуле, целиком занятом изменёнными страницами, она получает их список [(страница, кадр)]
+        # и сохраняет образы (в журнал), после чего страницы считаются чистыми и вытесняются
+        self.steal = True
+        self.log = None
+        # Образы страниц, которые при промахе берутся вместо файла (журнал упреждающей записи)
+        self.overlay = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _offset(self, page):
+        return self.base_offset + page * self.page_size
+
+    def _evict(self, file, room=1):
+        while len(self.frames) > self.capacity - room:
+            page = next(iter(self.frames))
+            if page in self.dirty and not self.steal:
+                if len(self.dirty) >= len(self.frames):
+                    if self.log is None:
+                        return
+                    self.log([(page, self.frames[page]) for page in self.frames if page in self.dirty])
+                    self.dirty.clear()
+                    continue
+                self.frames.move_to_end(page)
+                continue
+            frame = self.frames.pop(page)
+            if page in self.dirty:
+                file.seek(self._offset(page))
+                file.write(frame)
+                self.dirty.discard(page)
+                self.writes += 1
+
+    def get(self, file, page: int) -> bytearray:
+        frame = self.frames.get(page)
+        if frame is not None:
+            self.hits += 1
+            self.frames.move_to_end(page)
+            return frame
+        self.misses += 1
+        self._evict(file)
+        content = self.overlay.get(page) if self.overlay is not None else None
+        if content is None:
+            file.seek(self._offset(page))
+            content = file.read(self.page_size)
+        frame = bytearray(content)
+        self.frames[page] = frame
+        return frame
+
+    def new(self, file, page: int, content: bytes) -> bytearray:
+        frame = self.frames.get(page)
+        if frame is None:
+            self._evict(file)
+            frame = self.frames[page] = bytearray(self.page_size)
+        else:
+            self.frames.move_to_end(page)
+        frame[:len(content)] = content
+        frame[len(content):] = bytes(self.page_size - len(content))
+        self.dirty.add(page)
+        return frame
+
+    def mark_dirty(self, page: int):
+        self.dirty.add(page)
+
+    def flush(self, file):
+        for page in sorted(self.dirty):
+            file.seek(self._offset(page))
+            file.write(self.frames[page])
+            self.writes += 1
+        self.dirty.clear()
+
+    def trim(self, file):
+        # Возвращает пул к capacity после фиксации, когда изменённые страницы стали чистыми
+        self._evict(file, 0)
+
+    def clear(self):
+        self.frames.clear()
+        self.dirty.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'capacity': self.capacity,
+            'cached': len(self.frames),
+            'dirty': len(self.dirty),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'writes': self.writes,
+        }
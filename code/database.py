@@ -1,260 +1,2429 @@
+import ast
+import csv
+import heapq
+import json
+import mmap
 import os
+import pickle
 import struct
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice
 from struct import Struct
+from btree import BTree
+from bufferpool import BufferPool
+from predicate import column_names, compile_where, conjunction, conjuncts, index_ranges, qualify, range_overlaps, vector_mask
+from stats import QueryStats
+from wal import MAGIC as WAL_MAGIC, WriteAheadLog
+
+try:
+    import fcntl
+except ImportError:
+    # Без fcntl (Windows) доступ к файлу согласуется только между потоками одного процесса
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    # Без numpy недоступна только выборка в виде массива (select_array)
+    np = None
 
 TABLE_META_SIZE = 4358
 MAX_TABLE_COUNT = 255
-MAX_COLUMN_COUNT = 255
+MAX_COLUMN_COUNT = 251
+MAX_INDEX_COUNT = 8
+# Последние EXT_SIZE байт метаданных таблицы хранят описания индексов и флаги таблицы
+EXT_SIZE = 68
+FLAGS_OFFSET = 1 + 5 * MAX_INDEX_COUNT
+# Страницы таблицы содержат карту удалённых записей и число свободных слотов
+SLOTTED = 1
+# У таблицы есть каталог страниц, корень которого хранится после флагов
+DIRECTORY = 2
+# У таблицы есть куча строк переменной длины, первая и последняя страницы которой хранятся после каталога
+HEAP = 4
+HEAP_OFFSET = FLAGS_OFFSET + 5
+# Номера первой и последней страниц таблицы хранятся 32-битными после описания кучи
+WIDE_PAGES = 8
+PAGES_OFFSET = HEAP_OFFSET + 8
+# У таблицы есть словарь строк столбцов типа dict, первая страница которого хранится после номеров страниц
+DICTIONARY = 16
+DICTIONARY_OFFSET = PAGES_OFFSET + 8
 PAGE_SIZE = 4096
-DATA_TYPES = {'integer': 0, 'float': 1, 'string': 2}
-STRUCT_TYPES = {0: 'i', 1: 'f', 2: '255s'}
-CHECK_TYPES = {0: int, 1: float, 2: str}
+DATA_TYPES = {'integer': 0, 'float': 1, 'string': 2, 'text': 3, 'dict': 4}
+STRUCT_TYPES = {0: 'i', 1: 'f', 2: '255s', 3: '32s', 4: 'H'}
+CHECK_TYPES = {0: int, 1: float, 2: str, 3: str, 4: str}
+NUMPY_TYPES = {0: '=i4', 1: '=f4', 2: 'S255', 3: 'S32', 4: '=u2'}
+# Поле text хранит короткую строку в записи, а длинную -- в куче таблицы: байт HEAP_REF,
+# затем страница кучи и смещение, по которому записаны длина строки и её байты
+TEXT_SIZE = 32
+HEAP_REF = 0xFF
+HEAP_POINTER = Struct('=IH')
 DEAD_END = 256**4 - 1
+# Поле dict хранит код строки в словаре таблицы, общем для всех её столбцов dict. Страница
+# словаря: номер следующей страницы и число занятых байтов, затем строки в порядке кодов --
+# байт длины и байты UTF-8
+DICTIONARY_HEADER = Struct('=IH')
+DICTIONARY_CODES = 1 << 16
+MAX_DICTIONARY_VALUE = 255
+# Страница каталога: заголовок как у страницы данных, затем номера страниц таблицы
+DIRECTORY_CAPACITY = (PAGE_SIZE - 6) // 4
+DATA_OFFSET = 3 + TABLE_META_SIZE * MAX_TABLE_COUNT
+# Формат 2: место последней таблицы занимает суперблок с 32-битными номерами страниц --
+# началом списка свободных страниц, числом выделенных в файле страниц и первой ещё не
+# использованной из них. В формате 1 начало списка хранилось в заголовке как =H
+FORMAT_MAGIC = b'VKRDB002'
+SUPERBLOCK = Struct('=8sIII')
+SUPERBLOCK_OFFSET = 3 + TABLE_META_SIZE * (MAX_TABLE_COUNT - 1)
+# За суперблоком -- счётчик поколений файла, увеличиваемый каждой изменяющей операцией; по нему
+# процессы обнаруживают изменения, сделанные другими. Счётчик пишется прямо в основной файл,
+# минуя журнал, и на восстановление не влияет
+GENERATION = Struct('=Q')
+GENERATION_OFFSET = SUPERBLOCK_OFFSET + SUPERBLOCK.size
+# Файл растёт участками: не меньше EXTENT_PAGES страниц и не больше MAX_EXTENT_PAGES
+EXTENT_PAGES = 256
+MAX_EXTENT_PAGES = 16384
+POOL_SIZE = 256
+VACUUM_PAGES = 64
+# Число образов страниц в журнале, после которого выполняется контрольная точка
+CHECKPOINT_PAGES = 1024
+# Таблицы меньшего размера просматриваются без параллельных исполнителей
+PARALLEL_PAGES = 256
+# Изменения индексов больше этого числа записей могут выполняться перестроением индекса
+INDEX_REBUILD_ROWS = 1024
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+# Размер блока записей, над которым select_array вычисляет условие
+ARRAY_CHUNK = 1 << 20
+# Объём строящей стороны соединения, начиная с которого обе таблицы разбиваются на разделы
+# во временных файлах; число разделов не больше JOIN_PARTITIONS
+JOIN_MEMORY = 64 << 20
+JOIN_PARTITIONS = 256
+# Число строк раздела, накапливаемых в памяти перед записью во временный файл
+SPILL_BATCH = 1024
+# Число строк, сортируемых в памяти; большие выборки сортируются сериями во временных файлах,
+# которые сливаются не более чем по MERGE_FANIN за проход
+SORT_ROWS = 100000
+MERGE_FANIN = 64
+# Курсор select_iter читает таблицу порциями по CURSOR_PAGES страниц, снимая блокировки между ними
+CURSOR_PAGES = 64
+# Форматы файлов copy по расширению и число строк, загружаемых одной операцией
+COPY_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+COPY_BATCH = 10000
 
 def decode_string(string: bytes):
     return string[:string.index(b'\x00')].decode('utf-8')
 
+
+def read_heap(read, page, offset) -> bytes:
+    # Строка из кучи таблицы; длинная строка продолжается на следующих страницах кучи
+    frame = read(page)
+    length = struct.unpack_from('=I', frame, offset)[0]
+    offset += 4
+    chunks = []
+    while True:
+        chunk = bytes(frame[offset:offset + length])
+        chunks.append(chunk)
+        length -= len(chunk)
+        if not length:
+            return b''.join(chunks)
+        frame = read(struct.unpack_from('=I', frame)[0])
+        offset = 6
+
+
+def text_decoder(read):
+    # Декодирование строковых полей обоих типов: байт HEAP_REF не встречается в UTF-8,
+    # поэтому ссылка на кучу не совпадает ни с одной строкой, хранящейся в записи
+    def decode(raw):
+        if raw[0] != HEAP_REF:
+            return raw[:raw.index(b'\x00')].decode('utf-8')
+        return read_heap(read, *HEAP_POINTER.unpack_from(raw, 1)).decode('utf-8')
+    return decode
+
+
+def dictionary_decoder(decode, values: list):
+    # Поле dict распаковывается в число -- код строки, остальные строковые поля -- в байты
+    def decode_value(raw):
+        return values[raw] if raw.__class__ is int else decode(raw)
+    return decode_value
+
+
+def record_decoder(read, meta: 'TableMeta'):
+    decode = text_decoder(read) if 3 in meta.types else decode_string
+    return decode if meta.dictionary is None else dictionary_decoder(decode, meta.dictionary)
+
+
+def write_spill(path: str, rows) -> str:
+    # Записывает строки во временный файл пачками по SPILL_BATCH
+    with open(path, 'wb') as file:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= SPILL_BATCH:
+                pickle.dump(batch, file, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, file, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_spill(path: str):
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                batch = pickle.load(file)
+            except EOFError:
+                return
+            yield from batch
+
+
+def copy_format(path: str, format=None) -> str:
+    if format is None:
+        format = COPY_FORMATS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise ValueError(f'Формат файла {path} не определяется по расширению, укажите csv или jsonl')
+    if format not in ('csv', 'jsonl'):
+        raise ValueError(f'Неизвестный формат файла: {format}')
+    return format
+
+
+def copy_converter(data_type: int, format: str):
+    # Преобразование значения из файла к типу столбца; выбирается один раз для столбца
+    expected = CHECK_TYPES[data_type]
+    if format == 'csv':
+        return expected
+
+    def check(value):
+        if data_type == 1 and isinstance(value, int) and not isinstance(value, bool):
+            return float(value)
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise TypeError(f'Wrong type: {type(value)}, expected {expected}')
+        return value
+    return check
+
+
+class _Descending:
+    # Обратный порядок для столбца, сортируемого по убыванию вместе со столбцами по возрастанию
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def order_key(order: list):
+    """Функция ключа и признак обратного порядка для сортировки строк-словарей.
+
+    order -- список пар (столбец, по убыванию).
+    """
+    columns = [c for c, _ in order]
+    directions = {descending for _, descending in order}
+    if len(directions) == 1:
+        if len(columns) == 1:
+            column = columns[0]
+            return (lambda row: row[column]), directions.pop()
+        return (lambda row: tuple(row[c] for c in columns)), directions.pop()
+    return (lambda row: tuple(_Descending(row[c]) if descending else row[c] for c, descending in order)), False
+
+
+def order_columns(order_by) -> list:
+    # Порядок сортировки в виде списка (столбец, по убыванию); допускаются имена столбцов и пары
+    order = [(item, False) if isinstance(item, str) else (item[0], bool(item[1])) for item in order_by]
+    if not order:
+        raise ValueError('Не заданы столбцы сортировки')
+    return order
+
+
+class TableMeta:
+    def __init__(self, slot, name, first_page, last_page, rec_size, columns, types):
+        self.slot = slot
+        self.name = name
+        self.first_page = first_page
+        self.last_page = last_page
+        self.rec_size = rec_size
+        self.columns = columns
+        self.types = types
+        self.packer = Struct('=' + ''.join(STRUCT_TYPES[t] for t in types))
+        self.indexes = {}
+        self.slotted = False
+        self.directory_root = DEAD_END
+        # Номера страниц таблицы в порядке цепочки и страницы, в которых они хранятся
+        self.directory = None
+        self.directory_pages = None
+        self.heap_first = DEAD_END
+        self.heap_last = DEAD_END
+        self.dictionary_root = DEAD_END
+        # Строки словаря в порядке кодов, коды строк и страницы словаря; None, пока не прочитаны
+        self.dictionary = None
+        self.codes = None
+        self.dictionary_pages = None
+        # Страницы с удалёнными записями: страница -> число свободных слотов; None, пока не собраны
+        self.holes = None
+        # Зонные карты: страница -> [(min, max) по каждому столбцу]; None, пока не построены
+        self.zones = None
+        self._projections = {}
+
+    def projection(self, columns) -> Struct:
+        # Формат записи, в котором невыбранные столбцы пропускаются байтами заполнения
+        key = tuple(sorted(columns))
+        unpacker = self._projections.get(key)
+        if unpacker is None:
+            wanted = set(columns)
+            fmt = '='
+            for col, t in zip(self.columns, self.types):
+                code = STRUCT_TYPES[t]
+                fmt += code if col in wanted else f'{struct.calcsize("=" + code)}x'
+            unpacker = self._projections[key] = Struct(fmt)
+        return unpacker
+
+    def column_offsets(self) -> dict:
+        # Смещение и размер поля каждого столбца внутри упакованной записи
+        offsets = {}
+        offset = 0
+        for col, t in zip(self.columns, self.types):
+            size = struct.calcsize('=' + STRUCT_TYPES[t])
+            offsets[col] = (offset, size)
+            offset += size
+        return offsets
+
+    def fields(self, columns) -> list:
+        wanted = set(columns)
+        return [(col, t) for col, t in zip(self.columns, self.types) if col in wanted]
+
+    def layout(self, fields=None) -> dict:
+        # Позиция столбца в распакованном кортеже и размер строкового поля: None для чисел,
+        # со знаком минус для строк переменной длины, 0 для кода строки в словаре
+        if fields is None:
+            fields = list(zip(self.columns, self.types))
+        sizes = {0: None, 1: None, 2: struct.calcsize(STRUCT_TYPES[2]), 3: -TEXT_SIZE, 4: 0}
+        return {col: (i, sizes[t]) for i, (col, t) in enumerate(fields)}
+
+    @property
+    def offset(self):
+        return 3 + self.slot * TABLE_META_SIZE
+
+    @property
+    def capacity(self) -> int:
+        if not self.slotted:
+            return (PAGE_SIZE - 6) // self.rec_size
+        # Записи, число свободных слотов и битовая карта удалённых записей в конце страницы
+        capacity = (PAGE_SIZE - 8) * 8 // (self.rec_size * 8 + 1)
+        while 8 + capacity * self.rec_size + (capacity + 7) // 8 > PAGE_SIZE:
+            capacity -= 1
+        return capacity
+
+    @property
+    def bitmap_offset(self) -> int:
+        return PAGE_SIZE - (self.capacity + 7) // 8
+
+    @property
+    def free_offset(self) -> int:
+        return self.bitmap_offset - 2
+
+    def dead_slots(self, frame, rec_count):
+        # Номера удалённых записей страницы; None, если таких нет
+        if not self.slotted:
+            return None
+        bitmap_offset = self.bitmap_offset
+        if not struct.unpack_from('=H', frame, bitmap_offset - 2)[0]:
+            return None
+        dead = set()
+        for i, byte in enumerate(frame[bitmap_offset:bitmap_offset + (rec_count + 7) // 8]):
+            if byte:
+                dead.update(i * 8 + bit for bit in range(8) if byte >> bit & 1)
+        return dead
+
+    def pack(self) -> bytes:
+        table_meta = struct.pack('=16sHHHB', self.name.encode('utf-8'), self.first_page & 0xFFFF, self.last_page & 0xFFFF,
+                                 self.rec_size, len(self.columns))
+        for col, t in zip(self.columns, self.types):
+            table_meta += struct.pack('=16sB', col.encode('utf-8'), t)
+        ext = struct.pack('=B', len(self.indexes))
+        for col, root in self.indexes.items():
+            ext += struct.pack('=BI', self.columns.index(col), root)
+        flags = (SLOTTED if self.slotted else 0) | (DIRECTORY if self.directory_root != DEAD_END else 0) \
+            | (HEAP if self.heap_first != DEAD_END else 0) | WIDE_PAGES \
+            | (DICTIONARY if self.dictionary_root != DEAD_END else 0)
+        ext = ext.ljust(FLAGS_OFFSET, b'\x00') + struct.pack('=BIIIIII', flags, self.directory_root, self.heap_first,
+                                                             self.heap_last, self.first_page, self.last_page,
+                                                             self.dictionary_root)
+        return table_meta.ljust(TABLE_META_SIZE - EXT_SIZE, b'\x00') + ext.ljust(EXT_SIZE, b'\x00')
+
+    def unpack_ext(self, raw: bytes):
+        index_count = raw[0]
+        for i in range(index_count):
+            col, root = struct.unpack_from('=BI', raw, 1 + 5 * i)
+            self.indexes[self.columns[col]] = root
+        flags, directory_root = struct.unpack_from('=BI', raw, FLAGS_OFFSET)
+        self.slotted = bool(flags & SLOTTED)
+        if flags & DIRECTORY:
+            self.directory_root = directory_root
+        if flags & HEAP:
+            self.heap_first, self.heap_last = struct.unpack_from('=II', raw, HEAP_OFFSET)
+        if flags & WIDE_PAGES:
+            self.first_page, self.last_page = struct.unpack_from('=II', raw, PAGES_OFFSET)
+        if flags & DICTIONARY:
+            self.dictionary_root = struct.unpack_from('=I', raw, DICTIONARY_OFFSET)[0]
+
 class Database:
-    def __init__(self, path):
+    def __init__(self, path, keep_open=False, pool_size=POOL_SIZE, autoflush=True, use_mmap=True, zone_maps=False,
+                 wal=True, group_commit=32, commit_delay=0.01, checkpoint_pages=CHECKPOINT_PAGES, workers=0,
+                 stats_hook=None, sort_rows=SORT_ROWS):
         self.filepath = path
         if not os.path.exists(self.filepath):
             with open(self.filepath, 'w+b') as file:
-                file.write(b'\x00' * (TABLE_META_SIZE * MAX_TABLE_COUNT + 3) + b'\xff\xff\xff\xff' + b'\x00' * (PAGE_SIZE - 4))                
+                file.write(struct.pack('=BH', 0, 0xFFFF) + b'\x00' * (SUPERBLOCK_OFFSET - 3)
+                           + SUPERBLOCK.pack(FORMAT_MAGIC, DEAD_END, 0, 0).ljust(TABLE_META_SIZE, b'\x00'))
+            # Журнал, оставшийся от удалённого файла с тем же именем, к новому файлу не относится
+            if os.path.exists(path + '-wal'):
+                os.remove(path + '-wal')
+        self.catalog = {}
+        self.pool = BufferPool(pool_size, PAGE_SIZE, DATA_OFFSET)
+        self.autoflush = autoflush
+        self.use_mmap = use_mmap
+        self.zone_maps = zone_maps
+        self._map = None
+        self._vacant_page = DEAD_END
+        self._next_page = 0
+        self._page_count = 0
+        self._header_dirty = False
+        self._dirty_slots = set()
+        self._stamp = None
+        self._generation = None
+        self._file = open(self.filepath, 'r+b', buffering=0) if keep_open else None
+        # В режиме журнала изменения попадают в основной файл только на контрольной точке
+        self.wal = WriteAheadLog(path + '-wal', DATA_OFFSET, PAGE_SIZE, group_commit, commit_delay) if wal else None
+        self.checkpoint_pages = checkpoint_pages
+        # Число процессов для параллельного просмотра таблиц; 0 -- просмотр в текущем процессе
+        self.workers = workers
+        self._executor = None
+        # Выборки с order by длиннее sort_rows строк сортируются во временных файлах
+        self.sort_rows = sort_rows
+        # Коллектор счётчиков текущей команды (QueryStats) или None, если счётчики не собираются;
+        # stats_hook(stats, totals) вызывается после каждой операции, итоги копятся в stats_totals
+        self.stats = None
+        self.stats_hook = stats_hook
+        self.stats_totals = QueryStats()
+        self._transaction = False
+        # Все обращения к состоянию объекта выполняются под _lock; между процессами доступ
+        # согласуется блокировкой файла: разделяемой для чтения и исключительной для изменений
+        self._lock = threading.RLock()
+        self._lock_handle = None
+        self._lock_mode = None
+        self._lock_depth = 0
+        if self.wal is not None:
+            self.pool.steal = False
+            self.pool.overlay = self.wal.pages
+            self.pool.log = self._spill
+        elif os.path.exists(path + '-wal') and os.path.getsize(path + '-wal') > len(WAL_MAGIC):
+            # Без журнала зафиксированные в нём транзакции были бы не видны и затёрты:
+            # они переносятся в основной файл до первого обращения
+            self.wal = WriteAheadLog(path + '-wal', DATA_OFFSET, PAGE_SIZE)
+            try:
+                self.checkpoint()
+            finally:
+                self.wal.close()
+                self.wal = None
+                self._stamp = None
+
+    def close(self):
+        with self._lock:
+            if self._transaction:
+                self._discard()
+                self._release_file_lock()
+            if self._header_dirty or self._dirty_slots or self.pool.dirty:
+                self.flush()
+            if self.wal is not None:
+                self.checkpoint()
+                self.wal.close()
+            self._map = None
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self._lock_handle is not None and self._lock_handle is not self._file:
+                self._lock_handle.close()
+            self._lock_handle = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _file_stamp(file):
+        # Счётчик поколений и размер файла; размер нужен для отображения файла в память
+        file.seek(GENERATION_OFFSET)
+        generation, = GENERATION.unpack(file.read(GENERATION.size).ljust(GENERATION.size, b'\x00'))
+        return generation, os.fstat(file.fileno()).st_size
+
+    def _bump(self, file):
+        # Новое поколение записывается до изменений, чтобы другие процессы не пропустили их
+        # и при аварийном завершении операции
+        self._generation += 1
+        file.seek(GENERATION_OFFSET)
+        file.write(GENERATION.pack(self._generation))
+        self._stamp = self._generation, self._stamp[1]
+
+    def _load_catalog(self, file):
+        file.seek(0)
+        header = bytearray(file.read(3))
+        if self.wal is not None:
+            self.wal.patch(0, header)
+        table_count, legacy_vacant_page = struct.unpack('=BH', header)
+        raw = bytearray(file.read(TABLE_META_SIZE * table_count))
+        if self.wal is not None:
+            self.wal.patch(3, raw)
+        file.seek(SUPERBLOCK_OFFSET)
+        superblock = bytearray(file.read(SUPERBLOCK.size))
+        if self.wal is not None:
+            self.wal.patch(SUPERBLOCK_OFFSET, superblock)
+        magic, vacant_page, page_count, next_page = SUPERBLOCK.unpack(superblock)
+        if magic != FORMAT_MAGIC:
+            # Файл формата 1 переводится в формат 2 при следующей записи: список свободных
+            # страниц заканчивается последней страницей файла, за ней страниц ещё нет
+            if table_count >= MAX_TABLE_COUNT:
+                raise ValueError(f'Файл прежнего формата с {table_count} таблицами не может быть преобразован')
+            page_count = (self._file_stamp(file)[1] - DATA_OFFSET) // PAGE_SIZE
+            if self.wal is not None:
+                page_count = max(page_count, max(self.wal.pages, default=-1) + 1)
+            vacant_page, next_page = legacy_vacant_page, page_count
+            self._header_dirty = True
+            self._dirty_slots.update(range(table_count))
+        self._vacant_page, self._page_count, self._next_page = vacant_page, page_count, next_page
+        self.catalog = {}
+        for slot in range(table_count):
+            pos = slot * TABLE_META_SIZE
+            name, first_page, last_page, rec_size, col_count = struct.unpack_from('=16sHHHB', raw, pos)
+            columns = []
+            types = []
+            for i in range(col_count):
+                col, t = struct.unpack_from('=16sB', raw, pos + 23 + 17 * i)
+                columns.append(decode_string(col))
+                types.append(t)
+            name = decode_string(name)
+            meta = self.catalog[name] = TableMeta(slot, name, first_page, last_page, rec_size, columns, types)
+            if col_count <= MAX_COLUMN_COUNT:
+                meta.unpack_ext(raw[pos + TABLE_META_SIZE - EXT_SIZE:pos + TABLE_META_SIZE])
+            if meta.capacity < 1:
+                raise ValueError(f'Запись таблицы {name} ({rec_size} байт) не помещается на страницу')
+
+    def _unsaved(self) -> bool:
+        return bool(self._header_dirty or self._dirty_slots or self.pool.dirty
+                    or (self.wal is not None and self.wal.uncommitted))
+
+    @contextmanager
+    def _file_lock(self, write):
+        # Вложенные операции и транзакция используют уже взятую блокировку; разделяемая
+        # блокировка повышается до исключительной, если внутри чтения выполняется изменение.
+        # Как и транзакция, незаписанные изменения (autoflush=False) удерживают исключительную
+        # блокировку до flush, иначе другой процесс мог бы изменить файл под ними
+        if fcntl is not None:
+            # Незаписанные страницы могут быть вытеснены в файл и при чтении
+            write = write or self._unsaved()
+            mode = fcntl.LOCK_EX if write else fcntl.LOCK_SH
+            if self._lock_mode is None or (mode == fcntl.LOCK_EX and self._lock_mode == fcntl.LOCK_SH):
+                if self._lock_handle is None:
+                    self._lock_handle = self._file or open(self.filepath, 'rb')
+                fcntl.flock(self._lock_handle, mode)
+                self._lock_mode = mode
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0 and not self._transaction and not self._unsaved():
+                self._release_file_lock()
+
+    def _release_file_lock(self):
+        if self._lock_mode is not None:
+            fcntl.flock(self._lock_handle, fcntl.LOCK_UN)
+            self._lock_mode = None
+
+    @contextmanager
+    def _open(self, write=False):
+        ticket = None
+        with self._lock, self._file_lock(write), self._collecting():
+            dirty = self._header_dirty or self._dirty_slots or self.pool.dirty
+            file = self._file or open(self.filepath, 'r+b' if write or dirty else 'rb')
+            writes = self.pool.writes
+            try:
+                stamp = self._file_stamp(file)
+                if self.wal is not None and self.wal.file is None:
+                    self.wal.open()
+                if self._stamp is None or stamp[0] != self._generation:
+                    if self._transaction:
+                        self._discard()
+                        raise RuntimeError('Файл БД изменён другим процессом, транзакция отменена')
+                    if dirty and stamp[0] != self._generation:
+                        # Без блокировок файла (нет fcntl) незаписанные изменения не сохранить
+                        self._discard()
+                        raise RuntimeError('Файл БД изменён другим процессом, незаписанные изменения отменены')
+                    # Файл изменён извне: кэшированные страницы и каталог больше не действительны
+                    self.pool.clear()
+                    self._header_dirty = False
+                    self._dirty_slots.clear()
+                    # Журнал перечитывается, только если его изменил другой процесс
+                    if self.wal is not None and stamp[0] != self._generation:
+                        self.wal.load()
+                    self._load_catalog(file)
+                    self._stamp = stamp
+                    self._generation = stamp[0]
+                if write:
+                    self._bump(file)
+                yield file
+                if write and self.autoflush and not self._transaction:
+                    ticket = self._flush(file)
+                if self.pool.writes != writes:
+                    self._stamp = self._file_stamp(file)
+                    self._generation = self._stamp[0]
+            except BaseException:
+                if self._transaction:
+                    if write:
+                        # Ошибка изменяющей операции отменяет всю транзакцию
+                        self._discard()
+                elif self.autoflush:
+                    # Незаписанные изменения прерванной операции отбрасываются при следующем обращении
+                    self._stamp = None
+                    if write and self.wal is not None:
+                        self.wal.rollback()
+                raise
+            finally:
+                if file is not self._file:
+                    file.close()
+        if ticket is not None:
+            # Операция завершается после fsync журнала; ожидание вне блокировок позволяет
+            # параллельным фиксациям разделить один fsync
+            self.wal.wait(ticket)
+
+    @contextmanager
+    def _collecting(self):
+        # При заданном stats_hook счётчики собираются для каждой внешней операции
+        if self.stats is not None or self.stats_hook is None:
+            yield
+            return
+        with self.collect_stats():
+            yield
+
+    @contextmanager
+    def collect_stats(self):
+        """Собирает счётчики операций, выполненных внутри блока with, в объект QueryStats.
+
+        Учитываются операции всех потоков, обращающихся к объекту в это время.
+        """
+        stats = QueryStats()
+        with self._lock:
+            outer, self.stats = self.stats, stats
+            stats.start(self.pool)
+        try:
+            yield stats
+        finally:
+            with self._lock:
+                self.stats = outer
+                stats.finish(self.pool)
+                self.stats_totals.merge(stats)
+                if self.stats_hook is not None:
+                    self.stats_hook(stats, self.stats_totals)
+
+    def _flush(self, file):
+        # Возвращает номер фиксации в журнале, которую нужно дождаться (WriteAheadLog.wait), или None
+        ticket = None
+        meta_writes = []
+        if self._header_dirty:
+            meta_writes.append((0, struct.pack('=BH', len(self.catalog), 0xFFFF)))
+            meta_writes.append((SUPERBLOCK_OFFSET, SUPERBLOCK.pack(FORMAT_MAGIC, self._vacant_page, self._page_count, self._next_page)))
+            self._header_dirty = False
+        if self._dirty_slots:
+            by_slot = {meta.slot: meta for meta in self.catalog.values()}
+            for slot in sorted(self._dirty_slots):
+                meta_writes.append((3 + slot * TABLE_META_SIZE,
+                                    by_slot[slot].pack() if slot in by_slot else b'\x00' * TABLE_META_SIZE))
+            self._dirty_slots.clear()
+        if self.wal is not None:
+            # Фиксация: образы изменённых областей дописываются в журнал одной транзакцией
+            frames = self.pool.frames
+            page_writes = [(DATA_OFFSET + page * PAGE_SIZE, frames[page]) for page in sorted(self.pool.dirty)]
+            if meta_writes or page_writes or self.wal.uncommitted:
+                ticket = self.wal.commit(meta_writes + page_writes)
+            self.pool.dirty.clear()
+            self.pool.trim(file)
+            if self.wal.frames >= self.checkpoint_pages:
+                self._checkpoint(file)
+            return ticket
+        writes = self.pool.writes
+        for offset, data in meta_writes:
+            file.seek(offset)
+            file.write(data)
+        self.pool.writes += bool(meta_writes)
+        self.pool.flush(file)
+        self.pool.trim(file)
+        if self.pool.writes != writes:
+            file.flush()
+        return ticket
+
+    def flush(self):
+        if self._transaction:
+            raise RuntimeError('Внутри транзакции изменения сохраняются командой commit')
+        with self._open(write=True) as file:
+            ticket = self._flush(file)
+        if ticket is not None:
+            self.wal.wait(ticket)
+
+    def _spill(self, frames: list):
+        # Изменённые страницы, не помещающиеся в буферный пул, записываются в журнал до фиксации
+        self.wal.spill([(DATA_OFFSET + page * PAGE_SIZE, frame) for page, frame in frames])
+
+    def _checkpoint(self, file):
+        if self.wal.checkpoint(file):
+            self._stamp = self._file_stamp(file)
+
+    def checkpoint(self):
+        """Переносит зафиксированные в журнале изменения в основной файл и очищает журнал."""
+        if self.wal is None:
+            return
+        with self._open(write=True) as file:
+            self._checkpoint(file)
+
+    def _discard(self):
+        # Незафиксированные изменения отбрасываются: страницы и каталог перечитываются из файла и журнала
+        if self.wal is not None and self.wal.file is not None:
+            self.wal.rollback()
+        self.pool.clear()
+        self._header_dirty = False
+        self._dirty_slots.clear()
+        self._stamp = None
+        self._transaction = False
+        self.pool.steal = self.wal is None
+
+    def begin(self):
+        # Исключительная блокировка файла удерживается до commit или rollback
+        with self._lock:
+            if self._transaction:
+                raise RuntimeError('Транзакция уже начата')
+            with self._open(write=True) as file:
+                ticket = self._flush(file)
+                self._transaction = True
+                self.pool.steal = False
+            if ticket is not None:
+                self.wal.wait(ticket)
+
+    def commit(self):
+        with self._lock:
+            if not self._transaction:
+                raise RuntimeError('Транзакция не начата')
+            with self._open(write=True) as file:
+                ticket = self._flush(file)
+                self._transaction = False
+                self.pool.steal = self.wal is None
+            if ticket is not None:
+                self.wal.wait(ticket)
+
+    def rollback(self):
+        with self._lock:
+            if not self._transaction:
+                raise RuntimeError('Транзакция не начата')
+            self._discard()
+            if self._lock_depth == 0:
+                self._release_file_lock()
+
+    def _mapping(self, file):
+        # Отображение переиспользуется, пока файл открыт постоянно и не вырос;
+        # старое отображение закрывается сборщиком мусора после освобождения всех memoryview
+        size = self._stamp[1]
+        if self._file is None:
+            return mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        if self._map is None or len(self._map) != size:
+            self._map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _reader(self, file):
+        # Функция чтения страницы: из отображения файла, если страница не изменена в буферном пуле
+        mapping = self._mapping(file) if self.use_mmap else None
+        if mapping is None:
+            read = lambda page: memoryview(self._page(file, page))
+        else:
+            view = memoryview(mapping)
+            mapped = len(mapping)
+            dirty = self.pool.dirty
+            # Журнал пополняется и во время просмотра, поэтому проверяется сам словарь образов
+            overlay = self.pool.overlay if self.pool.overlay is not None else ()
+
+            def read(page):
+                offset = DATA_OFFSET + page * PAGE_SIZE
+                if page in dirty or page in overlay or offset + PAGE_SIZE > mapped:
+                    return memoryview(self._page(file, page))
+                return view[offset:offset + PAGE_SIZE]
+        if self.stats is not None:
+            read = self.stats.timed(read, 'read_time')
+        return read
+
+    def _scan_pages(self, file, meta: TableMeta, skip=None, pages=None):
+        # Возвращает номер страницы, memoryview области её записей без копирования и номера
+        # удалённых записей (None, если их нет); страницы, для которых skip возвращает True,
+        # и страницы без живых записей пропускаются без распаковки. pages -- часть каталога
+        # страниц таблицы, которой ограничивается просмотр
+        rec_size = meta.rec_size
+        read = self._reader(file)
+        stats = self.stats
+        if pages is not None:
+            pages = iter(pages)
+        page = meta.first_page if pages is None else next(pages, DEAD_END)
+        while page != DEAD_END:
+            frame = read(page)
+            next_page, rec_count = struct.unpack_from('=IH', frame)
+            if rec_count == 0:
+                break
+            dead = meta.dead_slots(frame, rec_count)
+            if (dead is None or len(dead) < rec_count) and (skip is None or not skip(page)):
+                if stats is not None:
+                    stats.pages_read += 1
+                yield page, frame[6:6 + rec_size * rec_count], dead
+            elif stats is not None:
+                stats.pages_skipped += 1
+            page = next_page if pages is None else next(pages, DEAD_END)
+
+    def _live(self, records, dead, unpacker: Struct):
+        rows = enumerate(unpacker.iter_unpack(records))
+        if dead is None:
+            return rows
+        return ((slot, raw) for slot, raw in rows if slot not in dead)
+
+    def _chain(self, file, meta: TableMeta) -> list:
+        read = self._reader(file)
+        pages = []
+        page = meta.first_page
+        while page != DEAD_END:
+            pages.append(page)
+            page = struct.unpack_from('=I', read(page))[0]
+        return pages
+
+    def _directory(self, file, meta: TableMeta) -> list:
+        # Номера страниц таблицы в порядке цепочки; у таблиц без сохранённого каталога
+        # он собирается обходом цепочки и записывается при следующем изменении таблицы
+        if meta.directory is None:
+            if meta.directory_root == DEAD_END:
+                meta.directory = self._chain(file, meta)
+            else:
+                read = self._reader(file)
+                entries = []
+                pages = []
+                page = meta.directory_root
+                while page != DEAD_END:
+                    frame = read(page)
+                    next_page, count = struct.unpack_from('=IH', frame)
+                    entries.extend(struct.unpack_from(f'={count}I', frame, 6))
+                    pages.append(page)
+                    page = next_page
+                meta.directory = entries
+                meta.directory_pages = pages
+        return meta.directory
+
+    def _store_directory(self, file, meta: TableMeta, start=0):
+        # Перезаписывает страницы каталога, начиная с той, где находится элемент start
+        entries = meta.directory
+        pages = meta.directory_pages
+        if pages is None:
+            pages = meta.directory_pages = []
+            start = 0
+        first = max(0, min(start // DIRECTORY_CAPACITY, len(pages) - 1))
+        needed = max(1, -(-len(entries) // DIRECTORY_CAPACITY))
+        while len(pages) < needed:
+            pages.append(self._take_vacant_page(file))
+        while len(pages) > needed:
+            self._free_page(file, pages.pop())
+        for i in range(first, needed):
+            chunk = entries[i * DIRECTORY_CAPACITY:(i + 1) * DIRECTORY_CAPACITY]
+            next_page = pages[i + 1] if i + 1 < needed else DEAD_END
+            self.pool.new(file, pages[i], struct.pack(f'=IH{len(chunk)}I', next_page, len(chunk), *chunk))
+        if meta.directory_root != pages[0]:
+            meta.directory_root = pages[0]
+            self._dirty_slots.add(meta.slot)
+
+    def _holes(self, file, meta: TableMeta) -> dict:
+        if meta.holes is None:
+            meta.holes = {}
+            if meta.slotted:
+                read = self._reader(file)
+                free_offset = meta.free_offset
+                page = meta.first_page
+                while page != DEAD_END:
+                    frame = read(page)
+                    next_page, rec_count = struct.unpack_from('=IH', frame)
+                    if rec_count == 0:
+                        break
+                    free = struct.unpack_from('=H', frame, free_offset)[0]
+                    if free:
+                        meta.holes[page] = free
+                    page = next_page
+        return meta.holes
+
+    def _zones(self, file, meta: TableMeta) -> dict:
+        if meta.zones is None:
+            meta.zones = {}
+            for page, records, dead in self._scan_pages(file, meta):
+                self._widen_zone(meta, page, (raw for _, raw in self._live(records, dead, meta.packer)))
+        return meta.zones
+
+    @staticmethod
+    def _widen_zone(meta: TableMeta, page, records, reset=False):
+        columns = list(zip(*records))
+        if not columns:
+            return
+        zone = None if reset else meta.zones.get(page)
+        summary = [(min(values), max(values)) for values in columns]
+        if zone is not None:
+            summary = [(min(lo, low), max(hi, high)) for (lo, hi), (low, high) in zip(zone, summary)]
+        meta.zones[page] = summary
+
+    def _zone_constraints(self, meta: TableMeta, where) -> list:
+        # Ограничения условия на диапазоны значений столбцов: (позиция в записи, диапазоны)
+        if not self.zone_maps or not isinstance(where, ast.AST):
+            return []
+        layout = meta.layout()
+        constraints = []
+        for column in column_names(where):
+            if column not in layout:
+                continue
+            index, size = layout[column]
+            ranges = index_ranges(where, column, size)
+            if ranges is not None:
+                constraints.append((index, ranges))
+        return constraints
+
+    def _zone_filter(self, file, meta: TableMeta, where):
+        # Функция пропуска страниц, диапазон значений которых не может удовлетворить условию
+        constraints = self._zone_constraints(meta, where)
+        if not constraints:
+            return None
+        zones = self._zones(file, meta)
+
+        def skip(page):
+            zone = zones.get(page)
+            if zone is None:
+                return False
+            return any(not any(range_overlaps(r, *zone[i]) for r in ranges) for i, ranges in constraints)
+        return skip
+
+    def _page(self, file, page) -> bytearray:
+        return self.pool.get(file, page)
+
+    def _table(self, table_name) -> TableMeta:
+        meta = self.catalog.get(table_name)
+        if meta is None:
+            raise NameError('Таблица не существует')
+        return meta
+
+    def _grow(self, file):
+        # Место под следующий участок страниц резервируется в файле сразу целиком
+        extent = min(max(EXTENT_PAGES, self._page_count // 8), MAX_EXTENT_PAGES)
+        self._page_count += extent
+        size = DATA_OFFSET + self._page_count * PAGE_SIZE
+        current = os.fstat(file.fileno()).st_size
+        if current < size:
+            try:
+                os.posix_fallocate(file.fileno(), current, size - current)
+            except (AttributeError, OSError):
+                # Нет posix_fallocate (Windows) или файловая система его не поддерживает
+                file.truncate(size)
+            self.pool.writes += 1
+        self._header_dirty = True
+
+    def _take_vacant_page(self, file):
+        # Сначала используются освобождённые страницы, затем ещё не занятые страницы участка;
+        # вызывающий код сам записывает содержимое полученной страницы
+        page = self._vacant_page
+        if page != DEAD_END:
+            self._vacant_page = struct.unpack_from('=I', self._page(file, page))[0]
+        else:
+            if self._next_page >= self._page_count:
+                self._grow(file)
+            page = self._next_page
+            self._next_page += 1
+        self._header_dirty = True
+        return page
+
+    def _free_page(self, file, page):
+        struct.pack_into('=I', self._page(file, page), 0, self._vacant_page)
+        self.pool.mark_dirty(page)
+        self._vacant_page = page
+        self._header_dirty = True
+
+    def _decoder(self, file, meta: TableMeta):
+        if 4 in meta.types:
+            self._dictionary(file, meta)
+        return record_decoder(self._reader(file), meta)
+
+    def _dictionary(self, file, meta: TableMeta) -> list:
+        if meta.dictionary is None:
+            read = self._reader(file)
+            values = []
+            pages = []
+            page = meta.dictionary_root
+            while page != DEAD_END:
+                frame = read(page)
+                next_page, used = DICTIONARY_HEADER.unpack_from(frame)
+                pos = DICTIONARY_HEADER.size
+                while pos < DICTIONARY_HEADER.size + used:
+                    length = frame[pos]
+                    values.append(bytes(frame[pos + 1:pos + 1 + length]).decode('utf-8'))
+                    pos += 1 + length
+                pages.append(page)
+                page = next_page
+            meta.dictionary = values
+            meta.codes = {value: code for code, value in enumerate(values)}
+            meta.dictionary_pages = pages
+        return meta.dictionary
+
+    def _dictionary_code(self, file, meta: TableMeta, value: str) -> int:
+        # Код строки в словаре таблицы; новая строка дописывается в конец последней страницы словаря
+        if meta.codes is None:
+            self._dictionary(file, meta)
+        code = meta.codes.get(value)
+        if code is not None:
+            return code
+        data = value.encode('utf-8')
+        if len(data) > MAX_DICTIONARY_VALUE:
+            raise ValueError(f'Строка столбца dict длиннее {MAX_DICTIONARY_VALUE} байт')
+        code = len(meta.dictionary)
+        if code >= DICTIONARY_CODES:
+            raise ValueError(f'Словарь таблицы {meta.name} заполнен: {DICTIONARY_CODES} строк')
+        entry = bytes([len(data)]) + data
+        pages = meta.dictionary_pages
+        used = PAGE_SIZE
+        if pages:
+            used = DICTIONARY_HEADER.size + DICTIONARY_HEADER.unpack_from(self._page(file, pages[-1]))[1]
+        if used + len(entry) > PAGE_SIZE:
+            page = self._take_vacant_page(file)
+            self.pool.new(file, page, DICTIONARY_HEADER.pack(DEAD_END, 0))
+            if pages:
+                struct.pack_into('=I', self._page(file, pages[-1]), 0, page)
+                self.pool.mark_dirty(pages[-1])
+            else:
+                meta.dictionary_root = page
+                self._dirty_slots.add(meta.slot)
+            pages.append(page)
+            used = DICTIONARY_HEADER.size
+        frame = self._page(file, pages[-1])
+        frame[used:used + len(entry)] = entry
+        struct.pack_into('=H', frame, 4, used + len(entry) - DICTIONARY_HEADER.size)
+        self.pool.mark_dirty(pages[-1])
+        meta.dictionary.append(value)
+        meta.codes[value] = code
+        return code
+
+    def _new_heap_page(self, file, meta: TableMeta):
+        page = self._take_vacant_page(file)
+        self.pool.new(file, page, struct.pack('=IH', DEAD_END, 0))
+        if meta.heap_last == DEAD_END:
+            meta.heap_first = page
+        else:
+            struct.pack_into('=I', self._page(file, meta.heap_last), 0, page)
+            self.pool.mark_dirty(meta.heap_last)
+        meta.heap_last = page
+        self._dirty_slots.add(meta.slot)
+        return page
+
+    def _heap_append(self, file, meta: TableMeta, data: bytes):
+        # Дописывает строку в конец кучи; длина строки всегда помещается на одну страницу,
+        # сами байты могут продолжаться на следующих. Возвращает страницу и смещение начала
+        page = meta.heap_last
+        used = PAGE_SIZE
+        if page != DEAD_END:
+            used = 6 + struct.unpack_from('=H', self._page(file, page), 4)[0]
+        if used + 4 > PAGE_SIZE:
+            page, used = self._new_heap_page(file, meta), 6
+        start = (page, used)
+        entry = struct.pack('=I', len(data)) + data
+        pos = 0
+        while True:
+            frame = self._page(file, page)
+            n = min(len(entry) - pos, PAGE_SIZE - used)
+            frame[used:used + n] = entry[pos:pos + n]
+            struct.pack_into('=H', frame, 4, used + n - 6)
+            self.pool.mark_dirty(page)
+            pos += n
+            if pos == len(entry):
+                return start
+            page, used = self._new_heap_page(file, meta), 6
+
+    def _text_field(self, file, meta: TableMeta, data: bytes) -> bytes:
+        if len(data) < TEXT_SIZE and b'\x00' not in data:
+            return data
+        return bytes([HEAP_REF]) + HEAP_POINTER.pack(*self._heap_append(file, meta, data))
+
+    def _heap_pages(self, file, meta: TableMeta) -> list:
+        read = self._reader(file)
+        pages = []
+        page = meta.heap_first
+        while page != DEAD_END:
+            pages.append(page)
+            page = struct.unpack_from('=I', read(page))[0]
+        return pages
 
-    def _allocate_page(self):
-        with open(self.filepath, 'r+b') as file:
-            file.seek(1)
-            vacant_page = struct.unpack('=H', file.read(2))[0]
-            file.seek(1)
-            file.write(struct.pack('=H', vacant_page + 1))
-            file.seek(0, 2)
-            file.write(b'\xff\xff\xff\xff' + b'\x00' * (PAGE_SIZE - 4))    
+    def _free_heap(self, file, meta: TableMeta):
+        # Цепочка страниц кучи целиком присоединяется к списку свободных страниц
+        if meta.heap_first == DEAD_END:
+            return
+        struct.pack_into('=I', self._page(file, meta.heap_last), 0, self._vacant_page)
+        self.pool.mark_dirty(meta.heap_last)
+        self._vacant_page = meta.heap_first
+        self._header_dirty = True
+        meta.heap_first = meta.heap_last = DEAD_END
+        self._dirty_slots.add(meta.slot)
+
+    def _compact_heap(self, file, meta: TableMeta) -> int:
+        # Строки, на которые ссылаются живые записи, переписываются в новую кучу, старая
+        # освобождается. Возвращает число освобождённых страниц
+        if meta.heap_first == DEAD_END:
+            return 0
+        old_pages = self._heap_pages(file, meta)
+        rec_size = meta.rec_size
+        offsets = meta.column_offsets()
+        fields = [offsets[col][0] for col, t in zip(meta.columns, meta.types) if t == 3]
+        read = self._reader(file)
+        live = {}
+        for _, records, dead in self._scan_pages(file, meta):
+            for slot in range(len(records) // rec_size):
+                if dead is None or slot not in dead:
+                    for offset in fields:
+                        pos = slot * rec_size + offset
+                        if records[pos] == HEAP_REF and bytes(records[pos:pos + TEXT_SIZE]) not in live:
+                            page, start = HEAP_POINTER.unpack_from(records, pos + 1)
+                            live[bytes(records[pos:pos + TEXT_SIZE])] = struct.unpack_from('=I', read(page), start)[0]
+        # Новая куча не меньше суммарного размера строк; если выигрыша нет, куча не переписывается
+        needed = -(-sum(4 + length for length in live.values()) // (PAGE_SIZE - 6))
+        if needed >= len(old_pages):
+            return 0
+        old_first, old_last = meta.heap_first, meta.heap_last
+        meta.heap_first = meta.heap_last = DEAD_END
+        moved = {}
+        for field in live:
+            data = read_heap(read, *HEAP_POINTER.unpack_from(field, 1))
+            moved[field] = self._text_field(file, meta, data).ljust(TEXT_SIZE, b'\x00')
+        for page, records, dead in self._scan_pages(file, meta):
+            frame = None
+            for slot in range(len(records) // rec_size):
+                for offset in fields:
+                    pos = slot * rec_size + offset
+                    if records[pos] == HEAP_REF:
+                        field = moved.get(bytes(records[pos:pos + TEXT_SIZE]))
+                        if field is not None:
+                            frame = frame or self._page(file, page)
+                            frame[6 + pos:6 + pos + TEXT_SIZE] = field
+            if frame is not None:
+                self.pool.mark_dirty(page)
+        struct.pack_into('=I', self._page(file, old_last), 0, self._vacant_page)
+        self.pool.mark_dirty(old_last)
+        self._vacant_page = old_first
+        self._header_dirty = True
+        self._dirty_slots.add(meta.slot)
+        return len(old_pages) - len(self._heap_pages(file, meta))
+
+    def _index(self, file, meta: TableMeta, column) -> BTree:
+        return BTree(self, file, STRUCT_TYPES[meta.types[meta.columns.index(column)]], meta.indexes[column])
+
+    def _index_entries(self, file, meta: TableMeta, column):
+        unpacker = meta.projection([column])
+        entries = []
+        for page, records, dead in self._scan_pages(file, meta):
+            entries.extend((key, page, slot) for slot, (key,) in self._live(records, dead, unpacker))
+        return entries
+
+    def _build_index(self, file, meta: TableMeta, column):
+        key_code = STRUCT_TYPES[meta.types[meta.columns.index(column)]]
+        meta.indexes[column] = BTree.create(self, file, key_code, self._index_entries(file, meta, column)).root
+        self._dirty_slots.add(meta.slot)
+
+    def _drop_index(self, file, meta: TableMeta, column):
+        for page in self._index(file, meta, column).pages():
+            self._free_page(file, page)
+        del meta.indexes[column]
+        self._dirty_slots.add(meta.slot)
+
+    def _update_index(self, file, meta: TableMeta, column, tree: BTree):
+        if tree.root != meta.indexes[column]:
+            meta.indexes[column] = tree.root
+            self._dirty_slots.add(meta.slot)
+
+    def _maintain_indexes(self, file, meta: TableMeta, removed: list, added: list, layout=None):
+        # removed и added -- списки (кортеж записи, страница, слот); layout задаёт позиции столбцов
+        # в кортеже и ограничивает обновляемые индексы, по умолчанию -- все столбцы таблицы.
+        # Если изменена заметная часть таблицы, индексы строятся заново, что быстрее
+        # поэлементных вставок и удалений
+        columns = [col for col in meta.indexes if layout is None or col in layout]
+        if not columns:
+            return
+        changed = len(removed) + len(added)
+        if changed > INDEX_REBUILD_ROWS and changed * 4 > len(self._directory(file, meta)) * meta.capacity:
+            for column in columns:
+                self._drop_index(file, meta, column)
+                self._build_index(file, meta, column)
+            return
+        for column in columns:
+            i = meta.columns.index(column) if layout is None else layout[column][0]
+            tree = self._index(file, meta, column)
+            for raw, page, slot in removed:
+                tree.delete(raw[i], page, slot)
+            for raw, page, slot in added:
+                tree.insert(raw[i], page, slot)
+            self._update_index(file, meta, column, tree)
+
+    def create_index(self, table_name: str, column: str):
+        with self._open(write=True) as file:
+            meta = self._table(table_name)
+            if column not in meta.columns:
+                raise NameError(f'Column {column} does not exist')
+            if column in meta.indexes:
+                raise NameError(f'Индекс по столбцу {column} уже существует')
+            column_type = meta.types[meta.columns.index(column)]
+            if column_type in (3, 4):
+                raise TypeError(f'Индекс по столбцу {column} типа {"text" if column_type == 3 else "dict"} не поддерживается')
+            if len(meta.indexes) >= MAX_INDEX_COUNT:
+                raise ValueError(f'Максимальное количество индексов таблицы: {MAX_INDEX_COUNT}')
+            self._build_index(file, meta, column)
+
+    def drop_index(self, table_name: str, column: str):
+        with self._open(write=True) as file:
+            meta = self._table(table_name)
+            if column not in meta.indexes:
+                raise NameError(f'Индекс по столбцу {column} не существует')
+            self._drop_index(file, meta, column)
+
+    def _index_plan(self, meta: TableMeta, where):
+        # Выбор индекса: сначала точечные условия (==, in), затем диапазоны
+        if not meta.indexes or not isinstance(where, ast.AST):
+            return None
+        layout = meta.layout()
+        best = None
+        for column in column_names(where):
+            if column not in meta.indexes:
+                continue
+            ranges = index_ranges(where, column, layout[column][1])
+            if ranges is None:
+                continue
+            points = all(r[0] is not None and r[0] == r[2] for r in ranges)
+            if best is None or (points and not best[2]):
+                best = (column, ranges, points)
+        return best
+
+    @staticmethod
+    def _describe_index(plan) -> str:
+        column, ranges, points = plan
+        return f'индекс {column}, {"значений" if points else "диапазонов"}: {len(ranges)}'
+
+    def _index_rids(self, file, meta: TableMeta, plan) -> list:
+        column, ranges, _ = plan
+        tree = self._index(file, meta, column)
+        rids = set()
+        for r in ranges:
+            rids.update(tree.range(*r))
+        return sorted(rids)
 
     def create_table(self, table_name: str, columns: dict[str, str]):
         if len(table_name) > 16:
-            raise ValueError('Имя таблицы длиннее 16 символов')                
-        with open(self.filepath, 'r+b') as file:            
-            table_count, vacant_page = struct.unpack('=BH', file.read(3))
-            if table_count < MAX_TABLE_COUNT:
-                file.seek(0)
-                file.write(struct.pack('=B', table_count + 1))
-            else: 
-                raise ValueError(f'Достигнуто максимальное число таблиц ({MAX_TABLE_COUNT})')
-            if len(columns) > MAX_COLUMN_COUNT:
-                raise ValueError(f'Максимальное количество столбцов: {MAX_COLUMN_COUNT}')
-            for v in columns.values():
-                if v not in DATA_TYPES:
-                    raise TypeError(f'Unknown type {v}')
-            table_meta_offset = 3 + table_count * TABLE_META_SIZE
-            rec_size = struct.calcsize('=' + ''.join(STRUCT_TYPES[DATA_TYPES[v]] for v in columns.values()))
-            table_meta = struct.pack('=16sHHHB', table_name.encode('utf-8'), vacant_page, vacant_page, rec_size, len(columns))            
-            for col, data_type in columns.items():
-                if len(col) > 16:
-                    raise ValueError(f'Название столбца "{col}" длиннее 16 символов')
-                if data_type not in DATA_TYPES:
-                    raise TypeError(f'Unknown type: {data_type}')
-                table_meta += struct.pack('=16sB', col.encode('utf-8'), DATA_TYPES[data_type])
-            table_meta = table_meta.ljust(TABLE_META_SIZE, b'\x00')
-            file.seek(table_meta_offset)
-            file.write(table_meta)
-            file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + vacant_page * PAGE_SIZE)
-            next_page = struct.unpack('=I', file.read(4))[0]
-            if next_page == DEAD_END:
-                self._allocate_page()
-            else:
-                file.seek(-4, 1)
-                file.write(b'\xff\xff\xff\xff')
-                file.seek(1)
-                file.write(struct.pack('=H', next_page))
-
-    def insert(self, table_name: str, values: list):        
-        with open(self.filepath, 'r+b') as file:
-            table_count, vacant_page = struct.unpack('=BH', file.read(3))
-            found = False
-            for i in range(table_count):
-                file.seek(3 + i * TABLE_META_SIZE)
-                table_meta_pos = file.tell()
-                name, _, last_page, rec_size, col_count = struct.unpack('=16sHHHB', file.read(23))
-                found = decode_string(name) == table_name
-                if found:
-                    break
-            if not found:
-                raise NameError('Таблица не существует')
-            types = [struct.unpack('=16sB', file.read(17))[1] for _ in range(col_count)]
+            raise ValueError('Имя таблицы длиннее 16 символов')
+        if len(columns) > MAX_COLUMN_COUNT:
+            raise ValueError(f'Максимальное количество столбцов: {MAX_COLUMN_COUNT}')
+        for col, data_type in columns.items():
+            if len(col) > 16:
+                raise ValueError(f'Название столбца "{col}" длиннее 16 символов')
+            if data_type not in DATA_TYPES:
+                raise TypeError(f'Unknown type: {data_type}')
+        with self._open(write=True) as file:
+            table_count = len(self.catalog)
+            if table_count >= MAX_TABLE_COUNT - 1:
+                raise ValueError(f'Достигнуто максимальное число таблиц ({MAX_TABLE_COUNT - 1})')
+            if table_name in self.catalog:
+                raise NameError('Таблица уже существует')
+            types = [DATA_TYPES[v] for v in columns.values()]
+            meta = TableMeta(table_count, table_name, DEAD_END, DEAD_END, 0, list(columns), types)
+            meta.rec_size = meta.packer.size
+            meta.slotted = True
+            if meta.capacity < 1:
+                raise ValueError(f'Запись таблицы ({meta.rec_size} байт) не помещается на страницу')
+            page = self._take_vacant_page(file)
+            meta.first_page = meta.last_page = page
+            self.pool.new(file, page, b'\xff\xff\xff\xff')
+            self.catalog[table_name] = meta
+            self._dirty_slots.add(meta.slot)
+            meta.directory = [page]
+            self._store_directory(file, meta)
+
+    def insert(self, table_name: str, values: list):
+        with self._open(write=True) as file:
+            meta = self._table(table_name)
+            types = meta.types
+            col_count = len(types)
             if len(values) != col_count:
                 raise ValueError(f'Insufficient number of values, should be {col_count}')
+            values = list(values)
             for i in range(col_count):
                 if not isinstance(values[i], CHECK_TYPES[types[i]]):
                     raise TypeError(f'Wrong type: {type(values[i])}, expected {CHECK_TYPES[types[i]]}')
-                if isinstance(values[i], str):
+            for i in range(col_count):
+                if types[i] == 4:
+                    values[i] = self._dictionary_code(file, meta, values[i])
+                elif isinstance(values[i], str):
                     values[i] = values[i].encode('utf-8')
-            rec_packer = Struct('=' + ''.join(STRUCT_TYPES[t] for t in types))
-            file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + last_page * PAGE_SIZE)
-            _, rec_count = struct.unpack('=IH', file.read(6))
-            if 6 + rec_size * rec_count + rec_size <= PAGE_SIZE:
-                file.seek(-2, 1)
-                file.write(struct.pack('=H', rec_count + 1))
-                file.seek(rec_size * rec_count, 1)
-                file.write(rec_packer.pack(*values))
+                    if types[i] == 3:
+                        values[i] = self._text_field(file, meta, values[i])
+            self._append(file, meta, [values])
+
+    def insert_many(self, table_name: str, rows) -> int:
+        with self._open(write=True) as file:
+            meta = self._table(table_name)
+            col_count = len(meta.types)
+            rows = list(rows)
+            for row in rows:
+                if len(row) != col_count:
+                    raise ValueError(f'Insufficient number of values, should be {col_count}')
+            if not rows:
+                return 0
+            columns = list(zip(*rows))
+            for i, t in enumerate(meta.types):
+                expected = CHECK_TYPES[t]
+                for v in columns[i]:
+                    if not isinstance(v, expected):
+                        raise TypeError(f'Wrong type: {type(v)}, expected {expected}')
+            self._store_columns(file, meta, columns)
+            return len(rows)
+
+    def _store_columns(self, file, meta: TableMeta, columns: list):
+        # Дописывает в таблицу проверенные строки, заданные списками значений по столбцам
+        for i, t in enumerate(meta.types):
+            if t == 2:
+                columns[i] = [v.encode('utf-8') for v in columns[i]]
+            elif t == 3:
+                columns[i] = [self._text_field(file, meta, v.encode('utf-8')) for v in columns[i]]
+            elif t == 4:
+                self._dictionary(file, meta)
+                codes = meta.codes
+                columns[i] = [codes[v] if v in codes else self._dictionary_code(file, meta, v) for v in columns[i]]
+        self._append(file, meta, list(zip(*columns)))
+
+    def copy_from(self, table_name: str, path: str, format=None) -> int:
+        """Загружает строки из файла CSV или JSON Lines; возвращает число загруженных строк.
+
+        Первая строка CSV содержит имена столбцов таблицы в любом порядке, строка JSON Lines --
+        объект со всеми столбцами или массив значений в порядке столбцов. Файл читается порциями
+        по COPY_BATCH строк, каждая порция записывается отдельной операцией, поэтому объём памяти
+        не зависит от размера файла, а при ошибке уже загруженные порции остаются в таблице.
+        """
+        format = copy_format(path, format)
+        with self._open():
+            meta = self._table(table_name)
+        table_columns = list(meta.columns)
+        converters = [copy_converter(t, format) for t in meta.types]
+        count = 0
+        with open(path, newline='' if format == 'csv' else None, encoding='utf-8') as source:
+            if format == 'csv':
+                reader = csv.reader(source)
+                header = next(reader, None)
+                if header is None or sorted(header) != sorted(table_columns):
+                    raise ValueError(f'Заголовок CSV должен содержать столбцы таблицы: {", ".join(table_columns)}')
+                order = [header.index(c) for c in table_columns]
+                records = ([row[i] for i in order] if len(row) == len(order) else row for row in reader if row)
+                first_line = 2
             else:
-                file.seek(-6, 1)
-                file.write(struct.pack('=I', vacant_page))
-                file.seek(table_meta_pos + 18)
-                file.write(struct.pack('=H', vacant_page))
-                file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + vacant_page * PAGE_SIZE)
-                next_page = struct.unpack('=I', file.read(4))[0]
-                file.seek(-4, 1)
-                file.write(b'\xff\xff\xff\xff\x01\x00')
-                file.write(rec_packer.pack(*values))
-                if next_page == DEAD_END:
-                    self._allocate_page()
-                else:
-                    file.seek(1)
-                    file.write(struct.pack('=H', next_page))
-
-    def select(self, table_name: str, columns: list, where=lambda row: True) -> tuple[dict, dict]:
-        with open(self.filepath, 'rb') as file:
-            table_count, _ = struct.unpack('=BH', file.read(3))
-            found = False
-            for i in range(table_count):
-                file.seek(3 + i * TABLE_META_SIZE)
-                name, first_page, _, rec_size, col_count = struct.unpack('=16sHHHB', file.read(23))
-                found = decode_string(name) == table_name
-                if found:
-                    break
-            if not found:
-                raise NameError('Таблица не существует')            
-            table_columns = []
-            types = []
-            records = []
-            for _ in range(col_count):
-                col, type = struct.unpack('=16sB', file.read(17))
-                table_columns.append(decode_string(col))
-                types.append(type)
-            rec_unpack = Struct('=' + ''.join(STRUCT_TYPES[t] for t in types))
-            next_page = first_page
-            while next_page != DEAD_END:
-                file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + next_page * PAGE_SIZE)
-                next_page, rec_count = struct.unpack('=IH', file.read(6))
-                if rec_count != 0:
-                    records.extend([decode_string(r) if isinstance(r, bytes) else r for r in rec_unpack.unpack(file.read(rec_size))] for _ in range(rec_count))
-                else:
+                def parse(line):
+                    value = json.loads(line)
+                    if isinstance(value, dict):
+                        if sorted(value) != sorted(table_columns):
+                            raise ValueError(f'Ожидаются столбцы: {", ".join(table_columns)}')
+                        return [value[c] for c in table_columns]
+                    return value
+                records = (parse(line) for line in source if line.strip())
+                first_line = 1
+            while True:
+                batch = list(islice(records, COPY_BATCH))
+                if not batch:
                     break
-        selected_columns = table_columns if '*' in columns else columns
-        data = [dict(zip(table_columns, rec)) for rec in records]
-        res_data = [{col: d[col] for col in selected_columns} for d in data if where(d)]
-        res_column = dict(zip(table_columns, types))
+                columns = [[] for _ in table_columns]
+                for n, row in enumerate(batch):
+                    try:
+                        if not isinstance(row, list) or len(row) != len(table_columns):
+                            raise ValueError(f'Insufficient number of values, should be {len(table_columns)}')
+                        for values, convert, value in zip(columns, converters, row):
+                            values.append(convert(value))
+                    except (TypeError, ValueError) as e:
+                        raise type(e)(f'{path}, запись {first_line + count + n}: {e}') from e
+                with self._open(write=True) as file:
+                    meta = self._table(table_name)
+                    if meta.columns != table_columns:
+                        raise RuntimeError(f'Таблица {table_name} изменена во время загрузки')
+                    self._store_columns(file, meta, columns)
+                count += len(batch)
+        return count
+
+    def copy_to(self, table_name: str, path: str, format=None, columns=('*',), where=None) -> int:
+        """Выгружает строки таблицы в файл CSV или JSON Lines; возвращает число строк.
+
+        Строки записываются по мере просмотра страниц, без построения списка строк.
+        """
+        format = copy_format(path, format)
+        with self._open() as file:
+            meta = self._table(table_name)
+            selected_columns, unpacker, pred, out = self._select_plan(meta, columns, where, None,
+                                                                      self._decoder(file, meta))
+            count = 0
+            with open(path, 'w', newline='' if format == 'csv' else None, encoding='utf-8') as target:
+                if format == 'csv':
+                    writer = csv.writer(target)
+                    writer.writerow(selected_columns)
+                for _, matched in self._matches(file, meta, where, pred, unpacker):
+                    rows = [[decode(rec[i]) if decode else rec[i] for _, i, decode in out] for _, rec in matched]
+                    if format == 'csv':
+                        writer.writerows(rows)
+                    else:
+                        target.write(''.join(json.dumps(dict(zip(selected_columns, row)), ensure_ascii=False) + '\n'
+                                             for row in rows))
+                    count += len(rows)
+        return count
+
+    def _append(self, file, meta: TableMeta, rows: list):
+        pack = meta.packer.pack
+        self._append_records(file, meta, [pack(*row) for row in rows])
+
+    def _fill_holes(self, file, meta: TableMeta, records: list) -> list:
+        # Размещает записи в слотах удалённых записей; возвращает ссылки на размещённые
+        holes = self._holes(file, meta)
+        rec_size = meta.rec_size
+        bitmap_offset = meta.bitmap_offset
+        rids = []
+        for page in sorted(holes):
+            if len(rids) == len(records):
+                break
+            frame = self._page(file, page)
+            rec_count = struct.unpack_from('=H', frame, 4)[0]
+            slots = sorted(meta.dead_slots(frame, rec_count))[:len(records) - len(rids)]
+            for slot in slots:
+                pos = 6 + rec_size * slot
+                frame[pos:pos + rec_size] = records[len(rids)]
+                frame[bitmap_offset + (slot >> 3)] &= ~(1 << (slot & 7)) & 0xff
+                rids.append((page, slot))
+            free = holes[page] - len(slots)
+            struct.pack_into('=H', frame, meta.free_offset, free)
+            self.pool.mark_dirty(page)
+            if free:
+                holes[page] = free
+            else:
+                del holes[page]
+        return rids
+
+    def _append_records(self, file, meta: TableMeta, records: list):
+        # Занимает слоты удалённых записей, затем дописывает оставшиеся записи в конец таблицы,
+        # заполняя страницы целиком, и добавляет записи в индексы
+        rec_size = meta.rec_size
+        capacity = meta.capacity
+        if capacity < 1:
+            raise ValueError(f'Запись таблицы {meta.name} ({rec_size} байт) не помещается на страницу')
+        directory = self._directory(file, meta)
+        stored = len(directory) if meta.directory_pages is not None else 0
+        rids = self._fill_holes(file, meta, records) if meta.slotted else []
+        done = len(rids)
+        new_pages = set()
+        frame = self._page(file, meta.last_page)
+        rec_count = struct.unpack_from('=H', frame, 4)[0]
+        count = min(capacity - rec_count, len(records) - done)
+        if count > 0:
+            frame[6 + rec_size * rec_count:6 + rec_size * (rec_count + count)] = b''.join(records[done:done + count])
+            struct.pack_into('=H', frame, 4, rec_count + count)
+            self.pool.mark_dirty(meta.last_page)
+            rids.extend((meta.last_page, rec_count + i) for i in range(count))
+            done += count
+        while done < len(records):
+            chunk = records[done:done + capacity]
+            page = self._take_vacant_page(file)
+            struct.pack_into('=I', self._page(file, meta.last_page), 0, page)
+            self.pool.mark_dirty(meta.last_page)
+            meta.last_page = page
+            self._dirty_slots.add(meta.slot)
+            self.pool.new(file, page, struct.pack('=IH', DEAD_END, len(chunk)) + b''.join(chunk))
+            new_pages.add(page)
+            directory.append(page)
+            rids.extend((page, i) for i in range(len(chunk)))
+            done += len(chunk)
+        if stored < len(directory) or meta.directory_pages is None:
+            self._store_directory(file, meta, stored)
+        if meta.zones is None and not meta.indexes:
+            return
+        # Ключи индексов берутся из упакованных записей, чтобы совпадать с хранимыми значениями
+        # (float, дополненная строка)
+        unpack = meta.packer.unpack
+        added = [(unpack(record), page, slot) for (page, slot), record in zip(rids, records)]
+        if meta.zones is not None:
+            by_page = {}
+            for raw, page, _ in added:
+                by_page.setdefault(page, []).append(raw)
+            for page, raws in by_page.items():
+                self._widen_zone(meta, page, raws, reset=page in new_pages)
+        self._maintain_indexes(file, meta, [], added)
+
+    @staticmethod
+    def _predicate(where, layout: dict, where_columns=None, decode=decode_string, codes=None):
+        if where is None:
+            return None
+        if isinstance(where, ast.AST):
+            return compile_where(where, layout, decode, codes)
+        # Условие в виде функции от словаря со значениями столбцов
+        fields = [(c, *layout[c]) for c in (layout if where_columns is None else where_columns)]
+        return lambda row: where({c: decode(row[i]) if size is not None else row[i] for c, i, size in fields})
+
+    @staticmethod
+    def _where_columns(where, table_columns, where_columns=None):
+        if where is None:
+            return []
+        if isinstance(where, ast.AST):
+            return column_names(where)
+        return table_columns if where_columns is None else where_columns
+
+    def _matches(self, file, meta: TableMeta, where, pred, unpacker: Struct, part=None):
+        # Записи, удовлетворяющие условию, сгруппированные по страницам: (страница, [(слот, кортеж)]).
+        # part ограничивает просмотр частью каталога страниц или, если выбран индекс, частью его адресов
+        rec_size = meta.rec_size
+        plan = self._index_plan(meta, where)
+        stats = self.stats
+        if stats is not None and pred is not None:
+            pred = stats.timed(pred, 'predicate_time')
+        if plan is not None:
+            read = self._reader(file)
+            by_page = {}
+            rids = self._index_rids(file, meta, plan) if part is None else part
+            for page, slot in rids:
+                raw = unpacker.unpack_from(read(page), 6 + rec_size * slot)
+                if pred(raw):
+                    by_page.setdefault(page, []).append((slot, raw))
+            if stats is not None:
+                stats.path(self._describe_index(plan))
+                stats.index_lookups += len(rids)
+                stats.pages_read += len({page for page, _ in rids})
+                stats.rows_scanned += len(rids)
+                stats.rows_matched += sum(len(matched) for matched in by_page.values())
+                stats.bytes_unpacked += unpacker.size * len(rids)
+            yield from by_page.items()
+            return
+        skip = self._zone_filter(file, meta, where)
+        if stats is not None:
+            stats.path('полный просмотр' if skip is None else 'просмотр с картами зон')
+        for page, records, dead in self._scan_pages(file, meta, skip, part):
+            rows = self._live(records, dead, unpacker)
+            matched = list(rows) if pred is None else [(slot, raw) for slot, raw in rows if pred(raw)]
+            if stats is not None:
+                live = len(records) // rec_size - len(dead or ())
+                stats.rows_scanned += live
+                stats.rows_matched += len(matched)
+                stats.bytes_unpacked += unpacker.size * live
+            if matched:
+                yield page, matched
+
+    @staticmethod
+    def _select_plan(meta: TableMeta, columns: list, where, where_columns, decode=decode_string):
+        table_columns = meta.columns
+        selected_columns = table_columns if '*' in columns else list(columns)
+        for c in selected_columns:
+            if c not in table_columns:
+                raise NameError(f'Column {c} does not exist')
+        where_columns = Database._where_columns(where, table_columns, where_columns)
+        for c in where_columns:
+            if c not in table_columns:
+                raise NameError(f'Column {c} does not exist')
+        fields = meta.fields(set(selected_columns) | set(where_columns))
+        unpacker = meta.projection([col for col, _ in fields])
+        layout = meta.layout(fields)
+        pred = Database._predicate(where, layout, where_columns, decode, meta.codes)
+        out = [(c, layout[c][0], None if layout[c][1] is None else decode) for c in selected_columns]
+        return selected_columns, unpacker, pred, out
+
+    def _select_rows(self, file, meta: TableMeta, where, pred, unpacker: Struct, out: list, limit=None, offset=0):
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError('LIMIT и OFFSET не могут быть отрицательными')
+        rows = ({c: decode(rec[i]) if decode else rec[i] for c, i, decode in out}
+                for _, matched in self._matches(file, meta, where, pred, unpacker) for _, rec in matched)
+        # Обход страниц прекращается, как только набрано нужное число строк
+        return islice(rows, offset, None if limit is None else offset + limit)
+
+    def select(self, table_name: str, columns: list, where=None, where_columns=None,
+               limit=None, offset=0, order_by=None) -> tuple[dict, dict]:
+        """Выборка строк таблицы.
+
+        order_by -- столбцы сортировки: имена или пары (столбец, по убыванию). Без него строки
+        возвращаются в порядке страниц таблицы.
+        """
+        with self._open() as file:
+            meta = self._table(table_name)
+            if order_by:
+                selected_columns = meta.columns if '*' in columns else list(columns)
+                rows = self._ordered_select(file, meta, selected_columns, where, where_columns, limit, offset, order_by)
+                try:
+                    res_data = list(rows)
+                finally:
+                    rows.close()
+            else:
+                selected_columns, unpacker, pred, out = self._select_plan(meta, columns, where, where_columns,
+                                                                          self._decoder(file, meta))
+                res_data = None
+                if limit is None and not offset:
+                    res_data = self._parallel_select(file, meta, selected_columns, where)
+                if res_data is None:
+                    res_data = list(self._select_rows(file, meta, where, pred, unpacker, out, limit, offset))
+        res_column = dict(zip(meta.columns, meta.types))
         return {col: res_column[col] for col in selected_columns}, res_data
-    
-    def update(self, table_name: str, updated_values: dict, where=lambda row: True):
-        with open(self.filepath, 'r+b') as file:
-            table_count, _ = struct.unpack('=BH', file.read(3))
-            found = False
-            for i in range(table_count):
-                file.seek(3 + i * TABLE_META_SIZE)
-                name, first_page, _, rec_size, col_count = struct.unpack('=16sHHHB', file.read(23))
-                found = decode_string(name) == table_name
-                if found:
-                    break
-            if not found:
-                raise NameError('Таблица не существует')
-            table_columns = []
-            types = []            
-            for _ in range(col_count):
-                col, t = struct.unpack('=16sB', file.read(17))
-                table_columns.append(decode_string(col))
-                types.append(t)
-            table_col_types = dict(zip(table_columns, types))
+
+    def _ordered_select(self, file, meta: TableMeta, columns: list, where, where_columns, limit, offset, order_by):
+        order = order_columns(order_by)
+        # Столбцы сортировки, не входящие в выборку, читаются дополнительно и отбрасываются после сортировки
+        extra = [c for c, _ in order if c not in columns]
+        _, unpacker, pred, out = self._select_plan(meta, columns + extra, where, where_columns, self._decoder(file, meta))
+        rows = self._ordered(self._select_rows(file, meta, where, pred, unpacker, out), order, limit, offset)
+        if extra:
+            return ({c: row[c] for c in columns} for row in rows)
+        return rows
+
+    def _ordered(self, rows, order: list, limit=None, offset=0):
+        """Строки rows в порядке order.
+
+        При limit, если offset + limit строк помещаются в sort_rows, отбираются только первые строки
+        через кучу без сортировки всей выборки. Иначе строки сортируются в памяти, а выборки
+        больше sort_rows -- сериями, которые записываются во временные файлы и затем сливаются.
+        """
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError('LIMIT и OFFSET не могут быть отрицательными')
+        key, reverse = order_key(order)
+        stop = None if limit is None else offset + limit
+        stats = self.stats
+        if stop is not None and stop <= self.sort_rows:
+            if stats is not None:
+                stats.path(f'первые {stop} строк через кучу')
+            yield from (heapq.nlargest if reverse else heapq.nsmallest)(stop, rows, key=key)[offset:]
+            return
+        chunk = list(islice(rows, self.sort_rows))
+        if len(chunk) < self.sort_rows:
+            if stats is not None:
+                stats.path('сортировка в памяти')
+            chunk.sort(key=key, reverse=reverse)
+            yield from islice(chunk, offset, stop)
+            return
+        with tempfile.TemporaryDirectory(prefix='vkr-sort-') as directory:
+            runs = []
+            while chunk:
+                chunk.sort(key=key, reverse=reverse)
+                runs.append(write_spill(os.path.join(directory, str(len(runs))), chunk))
+                chunk = list(islice(rows, self.sort_rows))
+            if stats is not None:
+                stats.path(f'внешняя сортировка, серий: {len(runs)}')
+            count = len(runs)
+            while len(runs) > MERGE_FANIN:
+                # Промежуточные проходы ограничивают число одновременно открытых файлов
+                merged = []
+                for i in range(0, len(runs), MERGE_FANIN):
+                    group = [read_spill(path) for path in runs[i:i + MERGE_FANIN]]
+                    merged.append(write_spill(os.path.join(directory, str(count)),
+                                              heapq.merge(*group, key=key, reverse=reverse)))
+                    count += 1
+                runs = merged
+            yield from islice(heapq.merge(*(read_spill(path) for path in runs), key=key, reverse=reverse), offset, stop)
+
+    def _parallel_select(self, file, meta: TableMeta, columns: list, where):
+        # Страницы из каталога делятся на участки, которые просматривают процессы-исполнители;
+        # страницы, последние версии которых ещё не записаны в основной файл, просматриваются здесь же.
+        # Возвращает None, если параллельный просмотр неприменим
+        pages = self._parallel_pages(file, meta, where)
+        if pages is None:
+            return None
+        skip = self._zone_filter(file, meta, where)
+        if skip is not None:
+            pages = [page for page in pages if not skip(page)]
+        local = self.pool.dirty | set(self.pool.overlay or ())
+        size = -(-len(pages) // (self.workers * 4))
+        runs = []
+        for page in pages:
+            is_local = page in local
+            if runs and runs[-1][0] == is_local and (is_local or len(runs[-1][1]) < size):
+                runs[-1][1].append(page)
+            else:
+                runs.append((is_local, [page]))
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        table = (meta.columns, meta.types, meta.rec_size, meta.slotted, meta.dictionary)
+        futures = [None if is_local else self._executor.submit(scan_file_pages, self.filepath, table, run, columns, where)
+                   for is_local, run in runs]
+        read = self._reader(file)
+        rows = []
+        for (is_local, run), future in zip(runs, futures):
+            rows.extend(scan_pages(read, meta, run, columns, where) if is_local else future.result())
+        if self.stats is not None:
+            # Записи просматриваются в исполнителях, поэтому учитываются только страницы и результат
+            self.stats.path(f'параллельный просмотр, процессов: {self.workers}')
+            self.stats.pages_read += len(pages)
+            self.stats.rows_matched += len(rows)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def _parallel_pages(self, file, meta: TableMeta, where):
+        # Страницы таблицы для параллельного просмотра или None, если он неприменим
+        if self.workers < 2 or (where is not None and not isinstance(where, ast.AST)) \
+                or self._index_plan(meta, where) is not None:
+            return None
+        if meta.heap_first != DEAD_END and (self.pool.dirty or self.pool.overlay):
+            # Исполнители читают кучу строк из файла, где она может быть ещё не записана
+            return None
+        pages = self._directory(file, meta)
+        if len(pages) < PARALLEL_PAGES:
+            return None
+        return pages
+
+    def explain(self, table_name: str, where=None, limit=None) -> dict:
+        """Способ доступа к таблице для условия where без выполнения команды."""
+        with self._open() as file:
+            meta = self._table(table_name)
+            for c in self._where_columns(where, meta.columns):
+                if c not in meta.columns:
+                    raise NameError(f'Column {c} does not exist')
+            plan = self._index_plan(meta, where)
+            if plan is not None:
+                access = self._describe_index(plan)
+            elif limit is None and self._parallel_pages(file, meta, where) is not None:
+                access = f'параллельный просмотр, процессов: {self.workers}'
+            elif self._zone_constraints(meta, where):
+                access = 'просмотр с картами зон'
+            else:
+                access = 'полный просмотр'
+            return {
+                'table': table_name,
+                'access': access,
+                'where': ast.unparse(where) if isinstance(where, ast.AST) else '-' if where is None else 'функция',
+                'pages': len(self._directory(file, meta)),
+                'records_per_page': meta.capacity,
+                'indexes': ', '.join(meta.indexes) or '-',
+            }
+
+    def select_iter(self, table_name: str, columns: list, where=None, where_columns=None, limit=None, offset=0,
+                    order_by=None):
+        """Генератор строк выборки.
+
+        Таблица читается порциями по CURSOR_PAGES страниц, блокировка базы берётся только на время
+        чтения порции, поэтому открытый результат не задерживает изменения в других потоках и
+        процессах. Если файл изменился между порциями, обход прекращается с RuntimeError.
+        С order_by выборка целиком сортируется при первом обращении: до sort_rows строк остаются
+        в памяти, более длинный результат записывается во временный файл.
+        """
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError('LIMIT и OFFSET не могут быть отрицательными')
+        if not order_by:
+            rows = self._cursor(table_name, columns, where, where_columns)
+            try:
+                yield from islice(rows, offset, None if limit is None else offset + limit)
+            except GeneratorExit:
+                # Досрочное прекращение обхода не является ошибкой
+                return
+            finally:
+                rows.close()
+            return
+        directory = None
+        with self._open() as file:
+            meta = self._table(table_name)
+            selected_columns = meta.columns if '*' in columns else list(columns)
+            rows = self._ordered_select(file, meta, selected_columns, where, where_columns, limit, offset, order_by)
+            try:
+                chunk = list(islice(rows, self.sort_rows))
+                if len(chunk) == self.sort_rows:
+                    directory = tempfile.TemporaryDirectory(prefix='vkr-select-')
+                    path = write_spill(os.path.join(directory.name, 'rows'), chain(chunk, rows))
+                    chunk = None
+            except BaseException:
+                if directory is not None:
+                    directory.cleanup()
+                raise
+            finally:
+                rows.close()
+        try:
+            yield from chunk if directory is None else read_spill(path)
+        except GeneratorExit:
+            return
+        finally:
+            if directory is not None:
+                directory.cleanup()
+
+    def _cursor(self, table_name: str, columns: list, where, where_columns):
+        # Строки выборки порциями: просмотр продолжается с места остановки в каталоге страниц
+        # (или в списке адресов записей из индекса), запомненном при чтении первой порции;
+        # счётчик поколений показывает, что файл с тех пор не изменялся
+        generation = targets = None
+        position = 0
+        while targets is None or position < len(targets):
+            with self._open() as file:
+                meta = self._table(table_name)
+                if targets is None:
+                    generation = self._generation
+                    plan = self._index_plan(meta, where)
+                    if plan is None:
+                        targets, step = list(self._directory(file, meta)), CURSOR_PAGES
+                    else:
+                        targets, step = self._index_rids(file, meta, plan), CURSOR_PAGES * meta.capacity
+                elif self._generation != generation:
+                    raise RuntimeError('Файл БД изменён во время чтения выборки')
+                _, unpacker, pred, out = self._select_plan(meta, columns, where, where_columns, self._decoder(file, meta))
+                part = targets[position:position + step]
+                batch = [{c: decode(rec[i]) if decode else rec[i] for c, i, decode in out}
+                         for _, matched in self._matches(file, meta, where, pred, unpacker, part) for _, rec in matched]
+                position += step
+            yield from batch
+
+    def select_array(self, table_name: str, columns: list, where=None, where_columns=None):
+        """Выборка в виде структурированного массива numpy.
+
+        Области записей идущих подряд страниц отображаются в массив без копирования, условие WHERE
+        вычисляется поэлементными операциями над столбцами; если это невозможно, записи
+        проверяются построчно. Столбцы string возвращаются байтами, text и dict -- строками.
+        """
+        if np is None:
+            raise RuntimeError('Для select_array требуется пакет numpy')
+        with self._open() as file:
+            meta = self._table(table_name)
+            decode = self._decoder(file, meta)
+            selected_columns, unpacker, pred, _ = self._select_plan(meta, columns, where, where_columns, decode)
+            table_types = dict(zip(meta.columns, meta.types))
+            where_columns = self._where_columns(where, meta.columns, where_columns)
+            offsets = meta.column_offsets()
+            names = [c for c in meta.columns if c in set(selected_columns) | set(where_columns)]
+            page_dtype = np.dtype({'names': names,
+                                   'formats': [NUMPY_TYPES[table_types[c]] for c in names],
+                                   'offsets': [offsets[c][0] for c in names],
+                                   'itemsize': meta.rec_size})
+            # Строки переменной длины декодируются в объекты str
+            out_dtype = np.dtype([(c, object if table_types[c] in (3, 4) else NUMPY_TYPES[table_types[c]])
+                                  for c in selected_columns])
+            vectorized = isinstance(where, ast.AST) and all(table_types[c] not in (3, 4) for c in where_columns)
+            rec_size = meta.rec_size
+            parts = []
+
+            def select_block(block, valid, pages):
+                # block -- записи страниц pages [(записи, удалённые слоты)], valid -- маска живых записей
+                nonlocal vectorized
+                mask = valid
+                if where is not None:
+                    live = None
+                    if vectorized:
+                        # Условие вычисляется только над живыми записями; числа расширяются до 64 бит,
+                        # чтобы арифметика совпадала с построчной
+                        values = {c: block[c][valid] if table_types[c] == 2
+                                  else block[c][valid].astype(np.float64 if table_types[c] else np.int64)
+                                  for c in where_columns}
+                        try:
+                            live = np.array(vector_mask(where, values, np))
+                        except TypeError:
+                            vectorized = False
+                    if live is None:
+                        live = np.fromiter((pred(raw) for records, dead in pages
+                                            for _, raw in self._live(records, dead, unpacker)), bool, int(valid.sum()))
+                    mask = np.zeros(valid.shape, bool)
+                    mask[valid] = live
+                part = np.empty(int(mask.sum()), out_dtype)
+                for c in selected_columns:
+                    # numpy отбрасывает завершающие нули байтовых строк, поэтому поле дополняется до размера
+                    if table_types[c] == 3:
+                        part[c] = [decode(raw.ljust(TEXT_SIZE, b'\x00')) for raw in block[c][mask]]
+                    elif table_types[c] == 4:
+                        part[c] = [meta.dictionary[code] for code in block[c][mask].tolist()]
+                    else:
+                        part[c] = block[c][mask]
+                parts.append(part)
+
+            def select_mapped(mapping, first, pages):
+                # Идущие подряд страницы отображения файла -- массив (страница, слот) с шагом PAGE_SIZE
+                # прямо над отображением, без копирования
+                block = np.ndarray((len(pages), meta.capacity), page_dtype, mapping,
+                                   DATA_OFFSET + first * PAGE_SIZE + 6, (PAGE_SIZE, rec_size))
+                valid = np.arange(meta.capacity) < np.array([len(records) // rec_size for records, _ in pages])[:, None]
+                for i, (_, dead) in enumerate(pages):
+                    if dead:
+                        valid[i, list(dead)] = False
+                select_block(block, valid, pages)
+
+            def select_copied(pages):
+                # Страницы буферного пула и журнала объединяются одним копированием
+                block = np.concatenate([np.frombuffer(records, page_dtype) for records, _ in pages])
+                valid = np.ones(len(block), bool)
+                base = 0
+                for records, dead in pages:
+                    if dead:
+                        valid[[base + slot for slot in dead]] = False
+                    base += len(records) // rec_size
+                select_block(block, valid, pages)
+
+            # Страницы обрабатываются блоками до ARRAY_CHUNK байт, чтобы накладные расходы numpy
+            # приходились на блок, а не на страницу
+            block_pages = max(1, ARRAY_CHUNK // PAGE_SIZE)
+            mapping = first = None
+            mapped, copied = [], []
+            for page, records, dead in self._scan_pages(file, meta, self._zone_filter(file, meta, where)):
+                source = records.obj if isinstance(records.obj, mmap.mmap) else None
+                if source is not None and source is mapping and page == first + len(mapped) \
+                        and len(mapped) < block_pages:
+                    mapped.append((records, dead))
+                    continue
+                if mapped:
+                    select_mapped(mapping, first, mapped)
+                    mapped = []
+                if source is not None:
+                    if copied:
+                        select_copied(copied)
+                        copied = []
+                    mapping, first = source, page
+                    mapped.append((records, dead))
+                else:
+                    copied.append((records, dead))
+                    if len(copied) >= block_pages:
+                        select_copied(copied)
+                        copied = []
+            if mapped:
+                select_mapped(mapping, first, mapped)
+            if copied:
+                select_copied(copied)
+        return np.concatenate(parts) if parts else np.empty(0, out_dtype)
+
+    def aggregate(self, table_name: str, aggregates: list, group_by=(), where=None, where_columns=None) -> tuple[dict, list]:
+        """Агрегатные функции за один проход по таблице без построения списка строк.
+
+        aggregates -- список пар (функция, столбец), для count вместо столбца допускается '*'.
+        Для каждой группы хранится только строка накопителей; строки результата содержат
+        столбцы group_by и значения функций под именами вида 'sum(a)'.
+        """
+        group_by = list(group_by)
+        with self._open() as file:
+            meta = self._table(table_name)
+            table_types = dict(zip(meta.columns, meta.types))
+            for func, col in aggregates:
+                if func not in AGGREGATES:
+                    raise ValueError(f'Неизвестная агрегатная функция: {func}')
+                if col == '*' and func != 'count':
+                    raise ValueError(f'Функция {func} требует имя столбца')
+                if col != '*' and col not in table_types:
+                    raise NameError(f'Column {col} does not exist')
+                if func in ('sum', 'avg') and table_types[col] in (2, 3, 4):
+                    raise TypeError(f'Функция {func} неприменима к строковому столбцу {col}')
+            for c in group_by:
+                if c not in table_types:
+                    raise NameError(f'Column {c} does not exist')
+            where_columns = self._where_columns(where, meta.columns, where_columns)
+            for c in where_columns:
+                if c not in table_types:
+                    raise NameError(f'Column {c} does not exist')
+            needed = set(group_by) | set(where_columns) | {col for _, col in aggregates if col != '*'}
+            fields = meta.fields(needed)
+            unpacker = meta.projection([col for col, _ in fields])
+            layout = meta.layout(fields)
+            decode = self._decoder(file, meta)
+            pred = self._predicate(where, layout, where_columns, decode, meta.codes)
+            keys = [layout[c][0] for c in group_by]
+            # Поля text могут ссылаться на кучу, поэтому группируются и сравниваются декодированными.
+            # Поля dict группируются по кодам, а для min и max декодируются: коды не упорядочены как строки
+            text = {layout[c][0] for c in needed if table_types[c] == 3} \
+                | {layout[col][0] for func, col in aggregates if func in ('min', 'max') and table_types[col] == 4}
+            specs = [(func, None if col == '*' else layout[col][0]) for func, col in aggregates]
+
+            # Накопители группы: число строк, затем по значению на каждую функцию
+            # (сумма для sum и avg, текущий минимум или максимум для min и max)
+            groups = {}
+            if not keys and pred is None and all(func == 'count' for func, _ in specs):
+                # Число строк без условия берётся из заголовков страниц без распаковки записей
+                if self.stats is not None:
+                    self.stats.path('заголовки страниц')
+                count = sum(len(records) // meta.rec_size - len(dead or ())
+                            for _, records, dead in self._scan_pages(file, meta))
+                groups[()] = [count] + [count] * len(specs)
+            for _, matched in (() if groups else self._matches(file, meta, where, pred, unpacker)):
+                if text:
+                    matched = [(slot, tuple(decode(v) if i in text else v for i, v in enumerate(rec)))
+                               for slot, rec in matched]
+                if keys:
+                    buckets = {}
+                    for _, rec in matched:
+                        key = tuple(rec[i] for i in keys)
+                        bucket = buckets.get(key)
+                        if bucket is None:
+                            buckets[key] = [rec]
+                        else:
+                            bucket.append(rec)
+                else:
+                    buckets = {(): [rec for _, rec in matched]}
+                # Агрегаты считаются встроенными функциями по всем строкам группы на странице
+                for key, recs in buckets.items():
+                    state = groups.get(key)
+                    if state is None:
+                        state = groups[key] = [0] + [None] * len(specs)
+                    state[0] += len(recs)
+                    for j, (func, pos) in enumerate(specs, 1):
+                        if func in ('sum', 'avg'):
+                            value = sum(rec[pos] for rec in recs)
+                            state[j] = value if state[j] is None else state[j] + value
+                        elif func == 'min':
+                            value = min(rec[pos] for rec in recs)
+                            state[j] = value if state[j] is None else min(state[j], value)
+                        elif func == 'max':
+                            value = max(rec[pos] for rec in recs)
+                            state[j] = value if state[j] is None else max(state[j], value)
+            if not keys and not groups:
+                groups[()] = [0] + [None] * len(specs)
+
+        res_column = {c: table_types[c] for c in group_by}
+        names = []
+        for func, col in aggregates:
+            name = f'{func}({col})'
+            names.append(name)
+            res_column[name] = 0 if func == 'count' else 1 if func == 'avg' else table_types[col]
+        res_data = []
+        for key, state in groups.items():
+            row = {c: decode_string(v) if table_types[c] == 2 else decode(v) if table_types[c] == 4 and pos not in text else v
+                   for c, v, pos in zip(group_by, key, keys)}
+            for name, (func, col), value in zip(names, aggregates, state[1:]):
+                if func == 'count':
+                    value = state[0]
+                elif func == 'avg':
+                    value = value / state[0] if state[0] else None
+                elif value is not None and table_types[col] == 2:
+                    value = decode_string(value)
+                row[name] = value
+            res_data.append(row)
+        return res_column, res_data
+
+    @staticmethod
+    def _resolver(metas: dict):
+        # Полное имя таблица.столбец для имени столбца, заданного с таблицей или без неё
+        def resolve(name):
+            table, _, column = name.rpartition('.')
+            tables = [table] if table else [t for t, meta in metas.items() if column in meta.columns]
+            if table and (table not in metas or column not in metas[table].columns) or not tables:
+                raise NameError(f'Column {name} does not exist')
+            if len(tables) > 1:
+                raise NameError(f'Столбец {name} есть в нескольких таблицах, укажите таблицу')
+            return f'{tables[0]}.{column}'
+        return resolve
+
+    def _join_plan(self, file, left: str, right: str, on: tuple, columns, where, memory: int) -> dict:
+        if left == right:
+            raise ValueError('Соединение таблицы с самой собой не поддерживается')
+        metas = {left: self._table(left), right: self._table(right)}
+        resolve = self._resolver(metas)
+        keys = [resolve(c) for c in on]
+        if len(keys) != 2 or {k.split('.', 1)[0] for k in keys} != {left, right}:
+            raise ValueError('Условие соединения должно связывать столбцы двух таблиц')
+        if keys[0].startswith(f'{right}.'):
+            keys.reverse()
+        selected = [f'{t}.{c}' for t in (left, right) for c in metas[t].columns] if '*' in columns \
+            else [resolve(c) for c in columns]
+        # Конъюнкты условия, относящиеся к одной таблице, проверяются при её просмотре
+        # (с индексами и картами зон), остальные -- на соединённых строках
+        pushed = {left: [], right: []}
+        residual = []
+        if where is not None:
+            for node in conjuncts(qualify(where, resolve)):
+                tables = {name.split('.', 1)[0] for name in column_names(node)}
+                if len(tables) == 1:
+                    pushed[tables.pop()].append(qualify(node, lambda name: name.split('.', 1)[1]))
+                else:
+                    residual.append(node)
+        residual = conjunction(residual)
+        needed = set(keys) | set(selected) | (column_names(residual) if residual is not None else set())
+        sides = {}
+        for table, key in zip((left, right), keys):
+            meta = metas[table]
+            # Ключ соединения стоит первым в строке стороны
+            side_columns = [key.split('.', 1)[1]] + [c for c in meta.columns
+                                                     if f'{table}.{c}' in needed and f'{table}.{c}' != key]
+            sides[table] = (meta, side_columns, conjunction(pushed[table]), len(self._directory(file, meta)))
+        build, probe = sorted((left, right), key=lambda t: sides[t][3])
+        build_bytes = sides[build][3] * PAGE_SIZE
+        partitions = 1 if build_bytes <= memory else min(JOIN_PARTITIONS, -(-build_bytes // memory) * 2)
+        return {'left': left, 'right': right, 'keys': keys, 'selected': selected, 'sides': sides,
+                'residual': residual, 'build': build, 'probe': probe, 'partitions': partitions}
+
+    def _side_rows(self, file, meta: TableMeta, columns: list, where):
+        # Кортежи декодированных значений columns для записей таблицы, удовлетворяющих where
+        _, unpacker, pred, out = self._select_plan(meta, columns, where, None, self._decoder(file, meta))
+        for _, matched in self._matches(file, meta, where, pred, unpacker):
+            for _, rec in matched:
+                yield tuple(decode(rec[i]) if decode else rec[i] for _, i, decode in out)
+
+    def _join_rows(self, file, plan: dict):
+        left, build, probe = plan['left'], plan['build'], plan['probe']
+        sides = plan['sides']
+        # Соединённая строка -- значения левой стороны, затем правой, в порядке столбцов сторон
+        positions = {}
+        for table in (left, plan['right']):
+            start = len(positions)
+            positions.update((f'{table}.{c}', start + i) for i, c in enumerate(sides[table][1]))
+        residual = plan['residual']
+        pred = None if residual is None else \
+            compile_where(residual, {name: (i, None) for name, i in positions.items()}, decode_string)
+        out = [(name, positions[name]) for name in plan['selected']]
+        build_left = build == left
+
+        def joined(build_rows, probe_rows):
+            table = {}
+            for row in build_rows:
+                table.setdefault(row[0], []).append(row)
+            for row in probe_rows:
+                for match in table.get(row[0], ()):
+                    values = match + row if build_left else row + match
+                    if pred is None or pred(values):
+                        yield {name: values[i] for name, i in out}
+
+        def rows(table):
+            meta, columns, where, _ = sides[table]
+            return self._side_rows(file, meta, columns, where)
+
+        partitions = plan['partitions']
+        if partitions == 1:
+            yield from joined(rows(build), rows(probe))
+            return
+        # Строящая сторона не помещается в память: строки обеих сторон раскладываются по разделам
+        # по хешу ключа, после чего соединяются пары разделов с одинаковым номером
+        with tempfile.TemporaryDirectory(prefix='vkr-join-') as directory:
+            paths = {}
+            for table in (build, probe):
+                paths[table] = [os.path.join(directory, f'{table}-{i}') for i in range(partitions)]
+                files = [open(path, 'wb') for path in paths[table]]
+                buffers = [[] for _ in range(partitions)]
+                try:
+                    for row in rows(table):
+                        i = hash(row[0]) % partitions
+                        buffers[i].append(row)
+                        if len(buffers[i]) >= SPILL_BATCH:
+                            pickle.dump(buffers[i], files[i], pickle.HIGHEST_PROTOCOL)
+                            buffers[i] = []
+                    for i, buffer in enumerate(buffers):
+                        if buffer:
+                            pickle.dump(buffer, files[i], pickle.HIGHEST_PROTOCOL)
+                finally:
+                    for f in files:
+                        f.close()
+
+            for build_path, probe_path in zip(paths[build], paths[probe]):
+                yield from joined(read_spill(build_path), read_spill(probe_path))
+
+    def join(self, left: str, right: str, on: tuple, columns=('*',), where=None, limit=None, offset=0,
+             memory: int = JOIN_MEMORY, order_by=None) -> tuple[dict, list]:
+        """Соединение двух таблиц по равенству столбцов хешированием.
+
+        on -- пара имён столбцов разных таблиц. Столбцы результата и условия where задаются
+        как таблица.столбец или просто столбец, если он есть только в одной из таблиц; в результате
+        имена всегда полные. Хеш-таблица строится по таблице с меньшим числом страниц, другая
+        просматривается один раз; если строящая сторона больше memory байт, обе таблицы
+        разбиваются на разделы во временных файлах. order_by задаётся как в select.
+        """
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError('LIMIT и OFFSET не могут быть отрицательными')
+        with self._open() as file:
+            plan = self._join_plan(file, left, right, on, columns, where, memory)
+            selected = list(plan['selected'])
+            if self.stats is not None:
+                self.stats.path(f"хеш-соединение, построение по {plan['build']}, разделов: {plan['partitions']}")
+            if order_by:
+                resolve = self._resolver({table: side[0] for table, side in plan['sides'].items()})
+                order = [(resolve(c), descending) for c, descending in order_columns(order_by)]
+                plan['selected'] += [c for c, _ in order if c not in selected]
+            joined = self._join_rows(file, plan)
+            rows = self._ordered(joined, order, limit, offset) if order_by \
+                else islice(joined, offset, None if limit is None else offset + limit)
+            try:
+                res_data = [{c: row[c] for c in selected} for row in rows] if len(plan['selected']) > len(selected) \
+                    else list(rows)
+            finally:
+                # Досрочно остановленный обход удаляет временные файлы разделов и серий
+                if order_by:
+                    rows.close()
+                joined.close()
+            types = {}
+            for name in selected:
+                table, column = name.split('.', 1)
+                meta = plan['sides'][table][0]
+                types[name] = meta.types[meta.columns.index(column)]
+        return types, res_data
+
+    def explain_join(self, left: str, right: str, on: tuple, columns=('*',), where=None,
+                     memory: int = JOIN_MEMORY) -> dict:
+        """План соединения без его выполнения."""
+        with self._open() as file:
+            plan = self._join_plan(file, left, right, on, columns, where, memory)
+            result = {
+                'access': f"хеш-соединение, построение по {plan['build']}",
+                'build_pages': plan['sides'][plan['build']][3],
+                'probe_pages': plan['sides'][plan['probe']][3],
+                'partitions': plan['partitions'],
+            }
+            for table in (left, right):
+                meta, _, side_where, _ = plan['sides'][table]
+                index = self._index_plan(meta, side_where)
+                result[table] = f"{self._describe_index(index) if index else 'просмотр'}" \
+                                f"{', ' + ast.unparse(side_where) if side_where is not None else ''}"
+            residual = plan['residual']
+            result['residual'] = ast.unparse(residual) if residual is not None else '-'
+            return result
+
+    def update(self, table_name: str, updated_values: dict, where=None, where_columns=None):
+        with self._open(write=True) as file:
+            meta = self._table(table_name)
+            table_columns = meta.columns
+            rec_size = meta.rec_size
+            table_col_types = dict(zip(table_columns, meta.types))
             for c in updated_values:
                 if c not in table_columns:
                     raise NameError(f'Column {c} does not exist')
                 if not isinstance(updated_values[c], CHECK_TYPES[table_col_types[c]]):
-                    raise TypeError(f'Wrong type: {type(updated_values[c])}, expected: {CHECK_TYPES[table_col_types[c]]}')            
-            rec_packer = Struct('=' + ''.join(STRUCT_TYPES[t] for t in types))
-            next_page = first_page
-            while next_page != DEAD_END:
-                file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + next_page * PAGE_SIZE)
-                next_page, rec_count = struct.unpack('=IH', file.read(6))
-                for _ in range(rec_count):
-                    rec = [decode_string(r) if isinstance(r, bytes) else r for r in rec_packer.unpack(file.read(rec_size))]
-                    data = dict(zip(table_columns, rec))
-                    if where(data):
-                        data.update(updated_values)
-                        updated_rec = [v.encode('utf-8') if isinstance(v, str) else v for v in data.values()]
-                        file.seek(-rec_size, 1)
-                        file.write(rec_packer.pack(*updated_rec))
-
-    def delete(self, table_name: str, where=lambda row: True):
-        with open(self.filepath, 'r+b') as file:
-            table_count, vacant_page = struct.unpack('=BH', file.read(3))
-            found = False
-            for i in range(table_count):
-                file.seek(3 + i * TABLE_META_SIZE)
-                table_meta_pos = file.tell()
-                name, first_page, last_page, rec_size, _ = struct.unpack('=16sHHHB', file.read(23))
-                found = decode_string(name) == table_name
-                if found:
+                    raise TypeError(f'Wrong type: {type(updated_values[c])}, expected: {CHECK_TYPES[table_col_types[c]]}')
+            where_columns = self._where_columns(where, table_columns, where_columns)
+            for c in where_columns:
+                if c not in table_columns:
+                    raise NameError(f'Column {c} does not exist')
+            # Новые значения упаковываются один раз; в записи перезаписываются только их байты,
+            # соседние поля объединяются в один участок
+            offsets = meta.column_offsets()
+            patches = []
+            stored = {}
+            for col in sorted(updated_values, key=lambda c: offsets[c][0]):
+                value = updated_values[col]
+                field = Struct('=' + STRUCT_TYPES[table_col_types[col]])
+                if table_col_types[col] == 4:
+                    value = self._dictionary_code(file, meta, value)
+                elif isinstance(value, str):
+                    value = value.encode('utf-8')
+                    if table_col_types[col] == 3:
+                        value = self._text_field(file, meta, value)
+                packed = field.pack(value)
+                stored[col] = field.unpack(packed)[0]
+                offset = offsets[col][0]
+                if patches and patches[-1][0] + len(patches[-1][1]) == offset:
+                    patches[-1] = (patches[-1][0], patches[-1][1] + packed)
+                else:
+                    patches.append((offset, packed))
+            # Распаковываются только столбцы условия и старые ключи изменяемых индексов
+            indexed = [col for col in meta.indexes if col in updated_values]
+            fields = meta.fields(set(where_columns) | set(indexed))
+            unpacker = meta.projection([col for col, _ in fields])
+            layout = meta.layout(fields)
+            pred = self._predicate(where, layout, where_columns, self._decoder(file, meta), meta.codes)
+            zone_values = [(table_columns.index(col), value) for col, value in stored.items()]
+            changes = [(layout[col][0], stored[col]) for col in indexed]
+            removed = []
+            added = []
+            for page, matched in self._matches(file, meta, where, pred, unpacker):
+                frame = self._page(file, page)
+                for slot, raw in matched:
+                    pos = 6 + rec_size * slot
+                    for offset, packed in patches:
+                        frame[pos + offset:pos + offset + len(packed)] = packed
+                    if changes:
+                        new_raw = list(raw)
+                        for i, value in changes:
+                            new_raw[i] = value
+                        if new_raw != list(raw):
+                            removed.append((raw, page, slot))
+                            added.append((new_raw, page, slot))
+                self.pool.mark_dirty(page)
+                zone = meta.zones.get(page) if meta.zones is not None else None
+                if zone is not None:
+                    for i, value in zone_values:
+                        lo, hi = zone[i]
+                        zone[i] = (min(lo, value), max(hi, value))
+            self._maintain_indexes(file, meta, removed, added, {col: layout[col] for col in indexed})
+
+    def _truncate(self, file, meta: TableMeta):
+        # Все страницы, кроме первой, возвращаются в список свободных одним переназначением ссылок
+        first_page = meta.first_page
+        self._directory(file, meta)
+        meta.directory = [first_page]
+        self._store_directory(file, meta)
+        next_page = struct.unpack_from('=I', self._page(file, first_page))[0]
+        if next_page != DEAD_END:
+            struct.pack_into('=I', self._page(file, meta.last_page), 0, self._vacant_page)
+            self.pool.mark_dirty(meta.last_page)
+            self._vacant_page = next_page
+            self._header_dirty = True
+        self.pool.new(file, first_page, struct.pack('=IH', DEAD_END, 0))
+        meta.last_page = first_page
+        meta.slotted = True
+        meta.holes = {}
+        meta.zones = None
+        self._free_heap(file, meta)
+        self._dirty_slots.add(meta.slot)
+        for column in list(meta.indexes):
+            self._drop_index(file, meta, column)
+            self._build_index(file, meta, column)
+
+    def _convert(self, file, meta: TableMeta):
+        # Таблица из файла прежнего формата переписывается в страницы с картой удалённых записей
+        rec_size = meta.rec_size
+        records = []
+        for _, view, _ in self._scan_pages(file, meta):
+            records.extend(bytes(view[i:i + rec_size]) for i in range(0, len(view), rec_size))
+        columns = list(meta.indexes)
+        for column in columns:
+            self._drop_index(file, meta, column)
+        self._truncate(file, meta)
+        self._append_records(file, meta, records)
+        for column in columns:
+            self._build_index(file, meta, column)
+
+    def _delete(self, file, meta: TableMeta, where):
+        # Записи помечаются удалёнными на месте; место освобождается вставкой или vacuum
+        if where is None:
+            self._truncate(file, meta)
+            return
+        if not meta.slotted:
+            self._convert(file, meta)
+        pred = self._predicate(where, meta.layout(), decode=self._decoder(file, meta), codes=meta.codes)
+        bitmap_offset = meta.bitmap_offset
+        removed = []
+        for page, matched in self._matches(file, meta, where, pred, meta.packer):
+            frame = self._page(file, page)
+            for slot, _ in matched:
+                frame[bitmap_offset + (slot >> 3)] |= 1 << (slot & 7)
+            free = struct.unpack_from('=H', frame, meta.free_offset)[0] + len(matched)
+            struct.pack_into('=H', frame, meta.free_offset, free)
+            self.pool.mark_dirty(page)
+            if meta.holes is not None:
+                meta.holes[page] = free
+            if meta.indexes:
+                removed.extend((raw, page, slot) for slot, raw in matched)
+        self._maintain_indexes(file, meta, removed, [])
+
+    def delete(self, table_name: str, where=None):
+        with self._open(write=True) as file:
+            self._delete(file, self._table(table_name), where)
+
+    def vacuum(self, table_name: str, max_pages: int = VACUUM_PAGES) -> int:
+        """Шаг уплотнения таблицы: записи с последних страниц переносятся в слоты удалённых записей,
+        опустевшие страницы возвращаются в список свободных; за шаг освобождается не больше max_pages
+        страниц. Куча строк переменной длины уплотняется отдельно (compact_heap).
+
+        Возвращает число освобождённых страниц; 0 означает, что уплотнять больше нечего.
+        """
+        with self._open(write=True) as file:
+            meta = self._table(table_name)
+            if not meta.slotted:
+                return 0
+            holes = self._holes(file, meta)
+            if not holes:
+                return 0
+            rec_size = meta.rec_size
+            chain = self._directory(file, meta)
+            length = len(chain)
+            # Новое место перенесённой записи -> (кортеж записи, исходное место); запись,
+            # перенесённая несколько раз, учитывается в индексах один раз
+            moved = {}
+            freed = 0
+            while freed < max_pages and len(chain) > 1:
+                page = chain[-1]
+                frame = self._page(file, page)
+                rec_count = struct.unpack_from('=H', frame, 4)[0]
+                dead = meta.dead_slots(frame, rec_count) or ()
+                live = [slot for slot in range(rec_count) if slot not in dead]
+                free = holes.pop(page, 0)
+                if sum(holes.values()) < len(live):
+                    if free:
+                        holes[page] = free
                     break
-            if not found:
-                raise NameError('Таблица не существует')
-            table_columns, data = self.select(table_name, '*')
-            rec_packer = Struct('=' + ''.join(STRUCT_TYPES[v] for v in table_columns.values()))
-            changed_data = [rec_packer.pack(*[v.encode('utf-8') if isinstance(v, str) else v for v in rec.values()]) for rec in data if not where(rec)]
-            next_page = first_page
-            old_last_page = last_page
-            old_vacant_page = vacant_page
-            transfered = False
-            while next_page != DEAD_END:
-                if not transfered:
-                    last_page = next_page
-                file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + next_page * PAGE_SIZE)
-                start_pos = file.tell()
-                next_page, _ = struct.unpack('=IH', file.read(6))
-                if not transfered:
-                    if next_page != DEAD_END: vacant_page = next_page
-                pack = b''
-                rec_count = 0
-                while len(changed_data) > 0 and 6 + rec_size * rec_count + rec_size <= PAGE_SIZE:
-                    pack += changed_data.pop(0)
-                    rec_count += 1
-                transfered = len(changed_data) == 0                    
-                pack = pack.ljust(PAGE_SIZE - 6, b'\x00')
-                file.write(pack)
-                file.seek(start_pos + 4)
-                file.write(struct.pack('=H', rec_count))
-            if old_last_page != last_page:
-                file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + old_last_page * PAGE_SIZE)
-                file.write(struct.pack('=I', old_vacant_page))
-            file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + last_page * PAGE_SIZE)
-            file.write(b'\xff\xff\xff\xff')
-            file.seek(1)
-            file.write(struct.pack('=H', vacant_page))
-            file.seek(table_meta_pos + 18)
-            file.write(struct.pack('=H', last_page))
+                records = [bytes(frame[6 + rec_size * slot:6 + rec_size * (slot + 1)]) for slot in live]
+                rids = self._fill_holes(file, meta, records)
+                unpack = meta.packer.unpack
+                for slot, (new_page, new_slot), record in zip(live, rids, records):
+                    raw = unpack(record)
+                    if meta.zones is not None:
+                        self._widen_zone(meta, new_page, [raw])
+                    if meta.indexes:
+                        moved[new_page, new_slot] = (raw, moved.pop((page, slot), (raw, (page, slot)))[1])
+                chain.pop()
+                struct.pack_into('=I', self._page(file, chain[-1]), 0, DEAD_END)
+                self.pool.mark_dirty(chain[-1])
+                meta.last_page = chain[-1]
+                self._dirty_slots.add(meta.slot)
+                self._free_page(file, page)
+                if meta.zones is not None:
+                    meta.zones.pop(page, None)
+                freed += 1
+            if len(chain) == 1:
+                # Единственная страница без живых записей снова становится пустой
+                page = chain[0]
+                rec_count = struct.unpack_from('=H', self._page(file, page), 4)[0]
+                if rec_count and holes.get(page) == rec_count:
+                    self.pool.new(file, page, struct.pack('=IH', DEAD_END, 0))
+                    del holes[page]
+                    if meta.zones is not None:
+                        meta.zones.pop(page, None)
+            if len(chain) != length:
+                self._store_directory(file, meta, len(chain))
+            removed = [(raw, *old) for raw, old in moved.values()]
+            added = [(raw, *new) for new, (raw, _) in moved.items()]
+            self._maintain_indexes(file, meta, removed, added)
+            return freed
+
+    def compact_heap(self, table_name: str) -> int:
+        """Удаляет из кучи таблицы строки, на которые не ссылается ни одна запись.
+
+        Таблица просматривается целиком, а куча переписывается за одну операцию, поэтому
+        в отличие от vacuum уплотнение кучи не ограничивается числом страниц и выполняется
+        только по явному запросу. Возвращает число освобождённых страниц.
+        """
+        with self._open(write=True) as file:
+            return self._compact_heap(file, self._table(table_name))
 
     def drop_table(self, table_name):
-        self.delete(table_name)
-        with open(self.filepath, 'r+b') as file:
-            table_count, vacant_page = struct.unpack('=BH', file.read(3))
-            found = False
-            for i in range(table_count):
-                file.seek(3 + i * TABLE_META_SIZE)
-                table_meta_pos = file.tell()
-                name, first_page, last_page, rec_size, _ = struct.unpack('=16sHHHB', file.read(23))
-                found = decode_string(name) == table_name
-                if found:
-                    break
-            if not found:
-                raise NameError('Таблица не существует')            
-            file.seek(3 + TABLE_META_SIZE * MAX_TABLE_COUNT + first_page * PAGE_SIZE)
-            file.write(struct.pack('=I', vacant_page))
-            file.seek(0)
-            file.write(struct.pack('=BH', table_count - 1, first_page))
-            file.seek(table_meta_pos + TABLE_META_SIZE)
-            remaining = file.read(TABLE_META_SIZE * (table_count - i))
-            erase_pos = file.tell()
-            file.seek(table_meta_pos)
-            file.write(remaining)
-            file.seek(erase_pos)
-            file.write(b'\x00' * TABLE_META_SIZE)
-            
\ No newline at end of file
+        with self._open(write=True) as file:
+            meta = self._table(table_name)
+            for column in list(meta.indexes):
+                self._drop_index(file, meta, column)
+            self._delete(file, meta, None)
+            for page in meta.directory_pages:
+                self._free_page(file, page)
+            if meta.dictionary_root != DEAD_END:
+                self._dictionary(file, meta)
+                for page in meta.dictionary_pages:
+                    self._free_page(file, page)
+            first_page = meta.first_page
+            struct.pack_into('=I', self._page(file, first_page), 0, self._vacant_page)
+            self.pool.mark_dirty(first_page)
+            self._vacant_page = first_page
+            self._header_dirty = True
+            del self.catalog[table_name]
+            for other in self.catalog.values():
+                if other.slot > meta.slot:
+                    other.slot -= 1
+            self._dirty_slots.update(range(meta.slot, len(self.catalog) + 1))
+
+
+def scan_pages(read, meta: TableMeta, pages: list, columns: list, where) -> list:
+    # Просмотр заданных страниц таблицы; возвращает кортежи значений выбранных столбцов
+    _, unpacker, pred, out = Database._select_plan(meta, columns, where, None, record_decoder(read, meta))
+    rec_size = meta.rec_size
+    rows = []
+    for page in pages:
+        frame = read(page)
+        rec_count = struct.unpack_from('=H', frame, 4)[0]
+        dead = meta.dead_slots(frame, rec_count)
+        for slot, rec in enumerate(unpacker.iter_unpack(frame[6:6 + rec_size * rec_count])):
+            if (dead is None or slot not in dead) and (pred is None or pred(rec)):
+                rows.append(tuple(decode(rec[i]) if decode else rec[i] for _, i, decode in out))
+    return rows
+
+
+def scan_file_pages(path: str, table: tuple, pages: list, columns: list, where) -> list:
+    # Выполняется в процессе-исполнителе: страницы читаются из отображения основного файла
+    table_columns, types, rec_size, slotted, dictionary = table
+    meta = TableMeta(0, '', DEAD_END, DEAD_END, rec_size, table_columns, types)
+    meta.slotted = slotted
+    if dictionary is not None:
+        meta.dictionary = dictionary
+        meta.codes = {value: code for code, value in enumerate(dictionary)}
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        def read(page):
+            offset = DATA_OFFSET + page * PAGE_SIZE
+            return mapping[offset:offset + PAGE_SIZE]
+        return scan_pages(read, meta, pages, columns, where)
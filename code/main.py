@@ -1,10 +1,76 @@
+import queue
+import threading
+import time
 import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.messagebox as messagebox
 import tkinter.filedialog as filedialog
-from parser import parse_command
+from parser import prepare, execute
 from database import Database
 
+# Строк, добавляемых в таблицу за одну подгрузку
+FETCH_ROWS = 200
+# Период опроса очереди сообщений рабочего потока, мс
+POLL_INTERVAL = 50
+# Доля прокрутки, после которой подгружается следующая порция строк
+FETCH_THRESHOLD = 0.9
+
+
+class QueryWorker(threading.Thread):
+    """Выполняет команду в отдельном потоке и отдаёт строки результата порциями.
+
+    Курсор выборки читается и закрывается только здесь; блокировку базы он не удерживает,
+    поэтому открытый результат не мешает изменениям. Окно запрашивает очередную порцию
+    через fetch() и получает сообщения ('result', ...), ('rows', строки, конец),
+    ('error', исключение) из очереди events.
+    """
+
+    def __init__(self, db: Database, command: str, events: queue.Queue):
+        super().__init__(daemon=True)
+        self.db = db
+        self.command = command
+        self.events = events
+        self.requests = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def fetch(self):
+        self.requests.put(True)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.requests.put(False)
+
+    def post(self, *message):
+        if not self.cancelled.is_set():
+            self.events.put((self, *message))
+
+    def run(self):
+        rows = None
+        try:
+            parsed = execute(prepare(self.command), self.db, stream=True)
+            if not isinstance(parsed, tuple):
+                self.post('result', parsed)
+                return
+            headings, rows = parsed
+            rows = iter(rows)
+            self.post('result', headings)
+            while self.requests.get() and not self.cancelled.is_set():
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) == FETCH_ROWS or self.cancelled.is_set():
+                        break
+                done = len(batch) < FETCH_ROWS
+                self.post('rows', batch, done)
+                if done:
+                    break
+        except Exception as e:
+            self.post('error', e)
+        finally:
+            if hasattr(rows, 'close'):
+                rows.close()
+
+
 class MainWindow(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -12,6 +78,12 @@ class MainWindow(tk.Tk):
         self.title('СУБД')
 
         self.selected_db = None
+        self.worker = None
+        self.fetching = False
+        self.fetched = 0
+        self.started = None
+        self.progress = ''
+        self.events = queue.Queue()
             
         self.main_menu = tk.Menu()
         self.file_menu = tk.Menu(tearoff=0)
@@ -19,6 +91,7 @@ class MainWindow(tk.Tk):
         self.main_menu.add_command(label='Выбрать БД', command=self.select_database)
              
         self.main_menu.add_command(label='Запуск', command=self.execute_sql)              
+        self.main_menu.add_command(label='Отмена', command=self.cancel_sql, state='disabled')
         self.config(menu=self.main_menu)
 
         self.table_frame = tk.Frame(self)        
@@ -27,7 +100,7 @@ class MainWindow(tk.Tk):
 
         self.ysb = ttk.Scrollbar(self.table, orient=tk.VERTICAL, command=self.table.yview)
         self.xsb = ttk.Scrollbar(self.table, orient=tk.HORIZONTAL, command=self.table.xview)
-        self.table.configure(xscrollcommand=self.xsb.set, yscrollcommand=self.ysb.set)
+        self.table.configure(xscrollcommand=self.xsb.set, yscrollcommand=self.on_scroll)
         self.ysb.pack(side='right', fill='y')
         self.xsb.pack(side='bottom', fill='x')
 
@@ -35,8 +108,14 @@ class MainWindow(tk.Tk):
         self.sql_field = tk.Text(master=self.sql_field_frame)
         self.sql_field.pack(fill='both', expand=1)         
 
+        self.status = tk.Label(self, anchor='w')
+
         self.table_frame.place(x=5, y=10, relheight=0.5, relwidth=1.0, width=self.winfo_width() - 5)
-        self.sql_field_frame.place(x=5, y=10, rely=0.5, relheight=0.5, relwidth=1.0)  
+        self.sql_field_frame.place(x=5, y=10, rely=0.5, relheight=0.5, height=-30, relwidth=1.0)  
+        self.status.place(x=5, rely=1.0, y=-20, height=20, relwidth=1.0)
+
+        self.protocol('WM_DELETE_WINDOW', self.on_close)
+        self.after(POLL_INTERVAL, self.poll_events)
 
     def update_table(self, headings, contents):
         self.table.delete(*self.table.get_children())
@@ -45,23 +124,115 @@ class MainWindow(tk.Tk):
         for h in headings:
             self.table.heading(h, text=h)
             self.table.column(h, width=100, anchor="center")
+        self.append_rows(contents)
+
+    def append_rows(self, contents):
         for c in contents:
             self.table.insert("", tk.END, values=list(c.values())) 
+
+    def on_scroll(self, first, last):
+        # Следующая порция строк запрашивается, когда прокрутка подходит к концу загруженных
+        self.ysb.set(first, last)
+        if float(last) >= FETCH_THRESHOLD:
+            self.fetch_rows()
+
+    def fetch_rows(self):
+        if self.worker is not None and not self.fetching:
+            self.fetching = True
+            self.worker.fetch()
+
+    def set_running(self, running: bool):
+        self.main_menu.entryconfigure('Отмена', state='normal' if running else 'disabled')
+
+    def show_progress(self):
+        self.status['text'] = f'{self.progress}, {time.monotonic() - self.started:.1f} с'
+
+    def poll_events(self):
+        # Сообщения рабочего потока обрабатываются в главном потоке: tkinter не потокобезопасен
+        while True:
+            try:
+                worker, kind, *payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not self.worker:
+                continue
+            if kind == 'error':
+                self.finish_query()
+                messagebox.showerror('Error', str(payload[0]))
+            elif kind == 'result':
+                parsed = payload[0]
+                if isinstance(parsed, Database):
+                    self.selected_db = parsed
+                    self.finish_query()
+                    self.status['text'] = ''
+                else:
+                    self.update_table(parsed, [])
+                    self.fetch_rows()
+            elif kind == 'rows':
+                rows, done = payload
+                self.fetching = False
+                self.fetched += len(rows)
+                self.append_rows(rows)
+                if done:
+                    self.finish_query()
+                    self.status['text'] = f'Строк: {self.fetched}'
+                else:
+                    self.progress = f'Загружено строк: {self.fetched}'
+                    # Если загруженные строки ещё не заполнили окно, прокрутки не будет
+                    if self.table.yview()[1] >= FETCH_THRESHOLD:
+                        self.fetch_rows()
+        if self.worker is not None:
+            self.show_progress()
+        self.after(POLL_INTERVAL, self.poll_events)
+
+    def finish_query(self):
+        self.worker = None
+        self.fetching = False
+        self.set_running(False)
+
+    def stop_worker(self):
+        # Рабочий поток закрывает курсор и освобождает базу, после чего её можно закрыть
+        worker = self.worker
+        self.finish_query()
+        if worker is not None:
+            worker.cancel()
+            return worker
+
+    def cancel_sql(self):
+        if self.stop_worker() is not None:
+            self.status['text'] = 'Отменено'
+
+    def close_later(self, worker, db, then=None):
+        # База закрывается, когда рабочий поток завершит выполняемую команду; ожидание через
+        # join остановило бы обработку событий окна до конца запроса
+        if worker is not None and worker.is_alive():
+            self.after(POLL_INTERVAL, self.close_later, worker, db, then)
+            return
+        if db is not None:
+            db.close()
+        if then is not None:
+            then()
+
+    def on_close(self):
+        self.withdraw()
+        self.close_later(self.stop_worker(), self.selected_db, self.destroy)
     
     def select_database(self):
         file_path = filedialog.askopenfilename(defaultextension=".db", filetypes=[("Database files", "*.db")], initialdir='databases/')
-        if file_path:            
-            self.selected_db = Database(file_path)
+        if file_path:
+            if self.selected_db is not None:
+                self.close_later(self.stop_worker(), self.selected_db)
+            self.selected_db = Database(file_path, keep_open=True)
 
     def execute_sql(self):
-        try:
-            parsed = parse_command(self.sql_field.get('1.0', 'end'), self.selected_db)
-            if isinstance(parsed, Database):                
-                self.selected_db = parsed
-            elif isinstance(parsed, tuple):
-                self.update_table(*parsed)
-        except Exception as e:
-            messagebox.showerror('Error', str(e))
+        self.stop_worker()
+        self.worker = QueryWorker(self.selected_db, self.sql_field.get('1.0', 'end'), self.events)
+        self.fetched = 0
+        self.started = time.monotonic()
+        self.progress = 'Выполняется'
+        self.set_running(True)
+        self.show_progress()
+        self.worker.start()
 
 window = MainWindow()
 window.mainloop()
\ No newline at end of file
@@ -1,5 +1,22 @@
 import ast
-from database import Database
+import io
+import re
+import threading
+import tokenize
+from collections import OrderedDict
+from database import AGGREGATES, Database, order_key
+from predicate import BIN_OPS, CMP_OPS
+
+AGGREGATE_PATTERN = re.compile(r'(\w+)\((\*|\w+)\)')
+# Параметры ? и :имя заменяются при разборе именами PARAM_PREFIX<номер>
+PARAM_PREFIX = '_param_'
+NAMED_PARAM = re.compile(r'[A-Za-z_]\w*')
+PLAN_CACHE_SIZE = 256
+COPY_COMMAND = re.compile(r'copy\s+(\S+)\s+(from|to)\s+(\'[^\']*\'|"[^"]*"|\S+)(?:\s+(csv|jsonl))?',
+                          re.IGNORECASE)
+EXPLAIN_PREFIX = re.compile(r'\s*explain(\s+analyze(?=\s|$))?', re.IGNORECASE)
+# Предложения select после имени таблицы; limit и offset допускаются в любом порядке между собой
+SELECT_CLAUSES = ('join', 'where', 'group', 'order', 'limit', 'offset')
 
 class CommandError(Exception):
     pass
@@ -20,28 +37,25 @@ def eval_node(node: ast.Expression, row: dict = None):
         values = node.values
         return {eval_node(keys[i], row): eval_node(values[i], row) for i in range(len(keys))}        
     
+    elif isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return tuple(eval_node(value, row) for value in node.elts)
+
     elif isinstance(node, ast.BinOp):
-        op = node.op
-        left = eval_node(node.left, row)
-        right = eval_node(node.right, row)
-        if isinstance(op, ast.Add): return left + right
-        if isinstance(op, ast.Sub): return left - right
-        if isinstance(op, ast.Mult): return left * right
-        if isinstance(op, ast.Div): return left / right
-        if isinstance(op, ast.FloorDiv): return left // right
-        if isinstance(op, ast.Mod): return left % right    
-        if isinstance(op, ast.Pow): return left ** right    
+        op = BIN_OPS.get(type(node.op))
+        if op is None:
+            raise ValueError(f"Unsupported operator: {type(node.op).__name__}")
+        return op(eval_node(node.left, row), eval_node(node.right, row))
 
     elif isinstance(node, ast.Compare):
-        op = node.ops[0]
         left = eval_node(node.left, row)
-        right = eval_node(node.comparators[0], row)
-        if isinstance(op, ast.Gt): return left > right
-        if isinstance(op, ast.GtE): return left >= right
-        if isinstance(op, ast.Lt): return left < right
-        if isinstance(op, ast.LtE): return left <= right
-        if isinstance(op, ast.Eq): return left == right
-        if isinstance(op, ast.NotEq): return left != right
+        for op, comparator in zip(node.ops, node.comparators):
+            right = eval_node(comparator, row)
+            if type(op) not in CMP_OPS:
+                raise ValueError(f"Unsupported operator: {type(op).__name__}")
+            if not CMP_OPS[type(op)](left, right):
+                return False
+            left = right
+        return True
 
     elif isinstance(node, ast.BoolOp):
         op = node.op
@@ -54,224 +68,715 @@ def eval_node(node: ast.Expression, row: dict = None):
     elif isinstance(node, ast.UnaryOp):
         op = node.op
         if isinstance(op, ast.USub): return -eval_node(node.operand, row)
+        if isinstance(op, ast.UAdd): return +eval_node(node.operand, row)
         if isinstance(op, ast.Not): return not(eval_node(node.operand, row))
 
     else:
         raise ValueError(f"Unsupported AST node type: {type(node).__name__}")    
     
 
-def parse_command(command: str, db: Database):
+def parse_row_nodes(text: str) -> list:
+    rows = []
+    depth = 0
+    start = None
+    text = ' '.join(text.splitlines())
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+            if tok.type == tokenize.OP and tok.string == '(':
+                if depth == 0:
+                    start = tok.start[1]
+                depth += 1
+            elif tok.type == tokenize.OP and tok.string == ')':
+                depth -= 1
+                if depth == 0:
+                    rows.append(text[start:tok.end[1]])
+            elif depth == 0 and tok.string not in (',', '') and tok.type not in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                raise CommandError(f"Некорректный список строк: {text}")
+    except tokenize.TokenError:
+        raise CommandError(f"Некорректный список строк: {text}")
+
+    result = []
+    for row in rows:
+        try:
+            node = ast.parse(row, mode='eval').body
+        except SyntaxError:
+            raise CommandError(f"Некорректное значение: {row}")
+        result.append(node.elts if isinstance(node, ast.Tuple) else [node])
+    return result
+
+
+def quoted_words(text: str) -> set:
+    # Номера слов text.split(), входящих в строковые литералы: ключевые слова внутри строк
+    # не начинают предложений команды
+    line = ' '.join(text.splitlines())
+    spans = []
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(line).readline):
+            if tok.type == tokenize.STRING:
+                spans.append((tok.start[1], tok.end[1]))
+    except (tokenize.TokenError, SyntaxError):
+        # Незакрытая строка или скобка: ошибку сообщит разбор соответствующего предложения
+        pass
+    return {i for i, word in enumerate(re.finditer(r'\S+', line))
+            if any(start < word.end() and word.start() < end for start, end in spans)}
+
+
+def eval_values(nodes: list, params: dict = None) -> list:
+    try:
+        return [eval_node(node, params) for node in nodes]
+    except Exception:
+        raise CommandError(f"Некорректное значение: {', '.join(ast.unparse(node) for node in nodes)}")
+
+
+def parse_rows(text: str) -> list:
+    return [eval_values(nodes) for nodes in parse_row_nodes(text)]
+
+
+def substitute_params(command: str):
+    """Заменяет параметры ? и :имя вне строковых литералов именами PARAM_PREFIX<номер>.
+
+    Возвращает текст команды и список ключей параметров: номер для ?, имя для :имя.
+    """
+    out = []
+    keys = []
+    quote = None
+    i = 0
+    while i < len(command):
+        ch = command[i]
+        if quote is not None:
+            if ch == '\\':
+                out.append(command[i:i + 2])
+                i += 2
+                continue
+            if ch == quote:
+                quote = None
+        elif ch in '\'"':
+            quote = ch
+        elif ch == '?':
+            ch = f'{PARAM_PREFIX}{len(keys)}'
+            keys.append(len(keys))
+        elif ch == ':' and (i == 0 or command[i - 1] in ' \t\n(,=<>!+-*/%[{') and NAMED_PARAM.match(command, i + 1):
+            name = NAMED_PARAM.match(command, i + 1)[0]
+            if name not in keys:
+                keys.append(name)
+            out.append(f'{PARAM_PREFIX}{keys.index(name)}')
+            i += 1 + len(name)
+            continue
+        out.append(ch)
+        i += 1
+    if len({isinstance(key, int) for key in keys}) > 1:
+        raise CommandError("Параметры ? и :имя нельзя использовать в одной команде")
+    return ''.join(out), keys
+
+
+def param_spine(node: ast.AST) -> set:
+    # Узлы дерева (их id), поддеревья которых содержат параметры
+    spine = set()
+
+    def visit(n):
+        found = isinstance(n, ast.Name) and n.id.startswith(PARAM_PREFIX)
+        for child in ast.iter_child_nodes(n):
+            found = visit(child) or found
+        if found:
+            spine.add(id(n))
+        return found
+    visit(node)
+    return spine
+
+
+def bind_params(node: ast.AST, params: dict, spine: set) -> ast.AST:
+    # Копия дерева, в которой параметры заменены константами; копируются только узлы
+    # из spine, остальные поддеревья остаются общими с разобранной командой
+    if id(node) not in spine:
+        return node
+    if isinstance(node, ast.Name):
+        value = params[node.id]
+        return ast.Constant(value=tuple(value) if isinstance(value, list) else value)
+    fields = {}
+    for field, value in ast.iter_fields(node):
+        if isinstance(value, list):
+            value = [bind_params(v, params, spine) if isinstance(v, ast.AST) else v for v in value]
+        elif isinstance(value, ast.AST):
+            value = bind_params(value, params, spine)
+        fields[field] = value
+    return type(node)(**fields)
+
+
+def parse_where(tokens: list, start: int):
+    # Условие WHERE из токенов после start; None, если условия нет
+    if start >= len(tokens):
+        return None
+    if start == len(tokens) - 1:
+        raise CommandError(
+            "Отсутствует условие после where"
+        )
+    where_clause = ' '.join(tokens[start + 1:])
+    try:
+        return ast.parse(where_clause, mode='eval')
+    except SyntaxError:
+        raise CommandError(
+            f"Некорректное условие WHERE: {where_clause}"
+        )
+
+
+def show_table(db: Database, table_name: str, stream: bool):
+    # Содержимое таблицы; при stream строки читаются курсором по мере потребления
+    if stream:
+        return db.select(table_name, ['*'], limit=0)[0], db.select_iter(table_name, ['*'])
+    return db.select(table_name, ['*'])
+
+
+def parse_join(tokens: list, start: int):
+    # join <таблица> on <столбец> == <столбец> из токенов начиная с start; (таблица, (столбец, столбец))
+    end = tokens.index('where') if 'where' in tokens else len(tokens)
+    if end - start < 4 or tokens[start + 2].lower() != 'on':
+        raise CommandError(
+            "Ожидаемый синтаксис: join <таблица> on <таблица1>.<столбец> == <таблица2>.<столбец>"
+        )
+    condition = ' '.join(tokens[start + 3:end])
+
+    def name(node):
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            return f'{node.value.id}.{node.attr}'
+        return None
+
+    try:
+        node = ast.parse(condition, mode='eval').body
+    except SyntaxError:
+        node = None
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1 or not isinstance(node.ops[0], ast.Eq) \
+            or name(node.left) is None or name(node.comparators[0]) is None:
+        raise CommandError(
+            f"Некорректное условие соединения: {condition}\n"
+            "Поддерживается только равенство столбцов двух таблиц"
+        )
+    return tokens[start + 1], (name(node.left), name(node.comparators[0]))
+
+
+def parse_order(tokens: list) -> list:
+    # by <столбец> [asc|desc] [, <столбец> [asc|desc] ...] -> [(столбец, по убыванию)]
+    words = ' '.join(tokens[1:]).replace(',', ' ').split()
+    if tokens[:1] != ['by'] or not words or words[0].lower() in ('asc', 'desc'):
+        raise CommandError(
+            "Ожидаемый синтаксис: order by <столбец> [asc|desc] [, <столбец> [asc|desc] ...]"
+        )
+    order = []
+    directed = False
+    for word in words:
+        if word.lower() in ('asc', 'desc'):
+            if directed:
+                raise CommandError(
+                    f"Лишнее направление сортировки: {word}"
+                )
+            order[-1] = (order[-1][0], word.lower() == 'desc')
+            directed = True
+        else:
+            order.append((word, False))
+            directed = False
+    return order
+
+
+class Statement:
+    """Разобранная команда, которую можно выполнять многократно с разными параметрами.
+
+    run(db, params, echo, stream) выполняет команду; params сопоставляет именам PARAM_PREFIX<номер>
+    значения параметров, при stream строки результата возвращаются итератором.
+    explain(db, params) описывает способ доступа к таблице; None для команд без условия WHERE.
+    """
+
+    def __init__(self, command: str, run, keys: list, explain=None):
+        self.command = command
+        self.run = run
+        self.keys = keys
+        self.explain = explain
+
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def prepare(command: str) -> Statement:
+    """Разбирает команду; разобранные команды кэшируются по тексту."""
     command = command.strip()
+    with _plans_lock:
+        statement = _plans.get(command)
+        if statement is not None:
+            _plans.move_to_end(command)
+            return statement
+    statement = _prepare(command)
+    with _plans_lock:
+        _plans[command] = statement
+        if len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return statement
+
+
+def execute(statement: Statement, db: Database, params=(), echo: bool = True, stream: bool = False):
+    keys = statement.keys
+    if isinstance(params, dict):
+        missing = [key for key in keys if key not in params]
+        if missing or (keys and isinstance(keys[0], int)):
+            raise CommandError(f"Не заданы значения параметров: {', '.join(map(str, missing or keys))}")
+        values = {f'{PARAM_PREFIX}{i}': params[key] for i, key in enumerate(keys)}
+    else:
+        params = list(params)
+        if len(params) != len(keys) or (keys and not isinstance(keys[0], int)):
+            raise CommandError(f"Ожидается параметров: {len(keys)}, передано: {len(params)}")
+        values = {f'{PARAM_PREFIX}{i}': value for i, value in enumerate(params)}
+    return statement.run(db, values, echo, stream)
+
+
+def parse_command(command: str, db: Database, echo: bool = True, params=()):
+    return execute(prepare(command), db, params, echo)
+
+
+def _prepare(command: str) -> Statement:
     if not command:
         raise CommandError("Пустая команда")
 
-    tokens = command.split()
+    text, keys = substitute_params(command)
+    tokens = text.split()
     action = tokens[0].lower() if tokens else ""
 
-    try:
-        if action == 'create':
-            if len(tokens) < 2:
+    spines = {}
+    explain = None
+
+    def bind(where, params):
+        if not keys or where is None:
+            return where
+        spine = spines.get(id(where))
+        if spine is None:
+            spine = spines[id(where)] = param_spine(where)
+        return bind_params(where, params, spine)
+
+    if action == 'create':
+        if len(tokens) < 2:
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "create table <имя_таблицы> <столбец1> <тип1> [<столбец2> <тип2> ...]\n"
+                "или\n"
+                "create index on <имя_таблицы> <столбец>\n"
+                "или\n"
+                "create database <имя_бд>"
+            )
+
+        if tokens[1] == 'table':
+            if len(tokens) < 4 or len(tokens) % 2 == 0:
                 raise CommandError(
-                    "Ожидаемый синтаксис:\n"
+                    "Ожидаемый синтаксис для создания таблицы:\n"
                     "create table <имя_таблицы> <столбец1> <тип1> [<столбец2> <тип2> ...]\n"
-                    "или\n"
-                    "create database <имя_бд>"
                 )
 
-            if tokens[1] == 'table':
-                if len(tokens) < 4 or len(tokens) % 2 == 0:
-                    raise CommandError(
-                        "Ожидаемый синтаксис для создания таблицы:\n"
-                        "create table <имя_таблицы> <столбец1> <тип1> [<столбец2> <тип2> ...]\n"                        
-                    )
-                
-                table_name = tokens[2]
-                columns = tokens[3::2]
-                types = tokens[4::2]
-                
-                if len(columns) != len(types):
-                    raise CommandError(
-                        "Несоответствие количества столбцов и типов\n"
-                        "Ожидаемый синтаксис: create table <имя> <столбец1> <тип1> <столбец2> <тип2> ..."
-                    )
-                
-                db.create_table(table_name, dict(zip(columns, types)))
-                return db.select(table_name, ['*'])
+            table_name = tokens[2]
+            columns = tokens[3::2]
+            types = tokens[4::2]
 
-            elif tokens[1] == 'database':
-                if len(tokens) != 3:
-                    raise CommandError(
-                        "Ожидаемый синтаксис для создания БД:\n"
-                        "create database <имя_бд>\n"                        
-                    )
-                db_name = tokens[2]
-                path = f'databases/{db_name}.db'
-                return Database(path)
+            if len(columns) != len(types):
+                raise CommandError(
+                    "Несоответствие количества столбцов и типов\n"
+                    "Ожидаемый синтаксис: create table <имя> <столбец1> <тип1> <столбец2> <тип2> ..."
+                )
 
-            else:
+            def run(db, params, echo, stream):
+                db.create_table(table_name, dict(zip(columns, types)))
+                return show_table(db, table_name, stream)
+
+        elif tokens[1] == 'index':
+            if len(tokens) != 5 or tokens[2] != 'on':
                 raise CommandError(
-                    "Неизвестная create команда\n"
-                    "Допустимые варианты:\n"
-                    "create table <имя> <столбцы...>\n"
-                    "create database <имя>"
+                    "Ожидаемый синтаксис для создания индекса:\n"
+                    "create index on <имя_таблицы> <столбец>"
                 )
 
-        elif action == 'insert':
-            if len(tokens) < 5 or tokens[1] != 'into' or tokens[3] != 'values':
+            def run(db, params, echo, stream):
+                db.create_index(tokens[3], tokens[4])
+                return [], [{}]
+
+        elif tokens[1] == 'database':
+            if len(tokens) != 3:
                 raise CommandError(
-                    "Ожидаемый синтаксис:\n"
-                    "insert into <таблица> values <значение1> <значение2> ..."                    
+                    "Ожидаемый синтаксис для создания БД:\n"
+                    "create database <имя_бд>\n"
                 )
-            
-            table_name = tokens[2]
-            values = []
+            path = f'databases/{tokens[2]}.db'
+
+            def run(db, params, echo, stream):
+                return Database(path)
+
+        else:
+            raise CommandError(
+                "Неизвестная create команда\n"
+                "Допустимые варианты:\n"
+                "create table <имя> <столбцы...>\n"
+                "create index on <таблица> <столбец>\n"
+                "create database <имя>"
+            )
+
+    elif action == 'insert':
+        if len(tokens) < 5 or tokens[1] != 'into' or tokens[3] != 'values':
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "insert into <таблица> values <значение1> <значение2> ...\n"
+                "или\n"
+                "insert into <таблица> values (<значение1>, <значение2>, ...), (...), ..."
+            )
+
+        table_name = tokens[2]
+        rest = text.split(maxsplit=4)[4]
+        many = rest.startswith('(')
+        if many:
+            nodes = parse_row_nodes(rest)
+        else:
+            nodes = []
             for value in tokens[4:]:
                 try:
-                    parsed_value = eval_node(ast.parse(value, mode='eval'))
-                    values.append(parsed_value)
-                except:
+                    nodes.append(ast.parse(value, mode='eval').body)
+                except SyntaxError:
                     raise CommandError(
-                        f"Некорректное значение: {value}\n"                        
+                        f"Некорректное значение: {value}\n"
                     )
-            
-            db.insert(table_name, values)
-            return db.select(table_name, ['*'])
+        # Значения без параметров вычисляются один раз при разборе
+        rows = None if keys else [eval_values(row) for row in nodes] if many else eval_values(nodes)
 
-        elif action == 'select':
-            if len(tokens) < 4 or 'from' not in tokens:
-                raise CommandError(
-                    "Ожидаемый синтаксис:\n"
-                    "select <столбцы|*> from <таблица> [where <условие>]"                    
-                )
-            
-            try:
-                from_index = tokens.index('from')
-                columns = tokens[1:from_index]
-                table_name = tokens[from_index + 1]
-            except:
+        def run(db, params, echo, stream):
+            if many:
+                count = db.insert_many(table_name, rows if rows is not None else [eval_values(row, params) for row in nodes])
+            else:
+                db.insert(table_name, rows if rows is not None else eval_values(nodes, params))
+                count = 1
+            if not echo:
+                return {'inserted': 0}, [{'inserted': count}]
+            return show_table(db, table_name, stream)
+
+    elif action == 'select':
+        if len(tokens) < 4 or 'from' not in tokens:
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "select <столбцы|*> from <таблица> [join <таблица> on <столбец> == <столбец>] [where <условие>]"
+                " [group by <столбцы>] [order by <столбец> [asc|desc] ...] [limit <n>] [offset <n>]"
+            )
+
+        try:
+            from_index = tokens.index('from')
+            columns = tokens[1:from_index]
+            table_name = tokens[from_index + 1]
+        except:
+            raise CommandError(
+                "Некорректный синтаксис после select\n"
+                "Ожидаемый формат: select <столбцы> from <таблица>"
+            )
+
+        quoted = quoted_words(text)
+
+        def clause(word):
+            # Номер слова word после имени таблицы вне строковых литералов; None, если его нет
+            for i in range(from_index + 2, len(tokens)):
+                if tokens[i] == word and i not in quoted:
+                    return i
+            return None
+
+        paging = {}
+        while len(tokens) > from_index + 3 and tokens[-2].lower() in ('limit', 'offset') \
+                and tokens[-2].lower() not in paging and len(tokens) - 2 not in quoted:
+            if not tokens[-1].isdigit() and not tokens[-1].startswith(PARAM_PREFIX):
                 raise CommandError(
-                    "Некорректный синтаксис после select\n"
-                    "Ожидаемый формат: select <столбцы> from <таблица>"
+                    f"Некорректное значение {tokens[-2].lower()}: {tokens[-1]}"
                 )
+            paging[tokens[-2].lower()] = tokens[-1]
+            tokens = tokens[:-2]
 
-            where_clause = 'True'
-            if 'where' in tokens:
-                where_index = tokens.index('where')
-                if where_index == len(tokens) - 1:
-                    raise CommandError(
-                        "Отсутствует условие после where"                        
-                    )
-                where_clause = ' '.join(tokens[where_index + 1:])
-            
-            try:
-                where_node = ast.parse(where_clause, mode='eval')
-            except SyntaxError:
+        def page_value(name, params, default):
+            value = paging.get(name)
+            if value is None:
+                return default
+            if not value.startswith(PARAM_PREFIX):
+                return int(value)
+            value = params[value]
+            if not isinstance(value, int):
+                raise CommandError(f"Некорректное значение {name}: {value}")
+            return value
+
+        order_by = None
+        order_index = clause('order')
+        if order_index is not None:
+            order_by = parse_order(tokens[order_index + 1:])
+            tokens = tokens[:order_index]
+
+        group_by = None
+        group_index = clause('group')
+        if group_index is not None:
+            if tokens[group_index + 1:group_index + 2] != ['by'] or group_index + 2 == len(tokens):
                 raise CommandError(
-                    f"Некорректное условие WHERE: {where_clause}"                    
+                    "Ожидаемый синтаксис: group by <столбец1> [<столбец2> ...]"
                 )
-            
-            return db.select(table_name, columns, where=lambda row: eval_node(where_node, row))
+            group_by = tokens[group_index + 2:]
+            tokens = tokens[:group_index]
 
-        elif action == 'delete':
-            if len(tokens) < 3 or tokens[1] != 'from':
+        where_index = clause('where')
+        if where_index is None:
+            where_index = len(tokens)
+        join = None
+        rest = tokens[from_index + 2:where_index]
+        if rest and rest[0].lower() == 'join':
+            join = parse_join(tokens, from_index + 2)
+            rest = []
+        # Предложение не на своём месте оказывается внутри другого: после имени таблицы,
+        # в условии, в group by или в order by
+        condition = [tokens[i] for i in range(where_index + 1, len(tokens)) if i not in quoted]
+        misplaced = [word for word in rest + condition + (group_by or []) + [c for c, _ in order_by or []]
+                     if word.lower() in SELECT_CLAUSES]
+        if misplaced:
+            raise CommandError(
+                f"Предложение {misplaced[0]} не на своём месте\n"
+                "Порядок предложений: join, where, group by, order by, limit, offset"
+            )
+        if rest:
+            raise CommandError(
+                f"Лишние слова после имени таблицы: {' '.join(rest)}"
+            )
+
+        aggregates = []
+        names = []
+        for column in columns:
+            match = AGGREGATE_PATTERN.fullmatch(column)
+            if match is None:
+                names.append(column)
+                continue
+            if match[1].lower() not in AGGREGATES:
                 raise CommandError(
-                    "Ожидаемый синтаксис:\n"
-                    "delete from <таблица> [where <условие>]"                    
+                    f"Неизвестная агрегатная функция: {match[1]}"
                 )
-            
-            table_name = tokens[2]
-            
-            where_clause = 'True'
-            if 'where' in tokens:
-                where_index = tokens.index('where')
-                if where_index == len(tokens) - 1:
+            aggregates.append((match[1].lower(), match[2]))
+            names.append(f'{match[1].lower()}({match[2]})')
+
+        if join is not None and (aggregates or group_by is not None):
+            raise CommandError(
+                "Агрегатные функции и group by с join не поддерживаются"
+            )
+
+        if aggregates or group_by is not None:
+            for column in columns:
+                if AGGREGATE_PATTERN.fullmatch(column) is None and column not in (group_by or []):
                     raise CommandError(
-                        "Отсутствует условие после where"                        
+                        f"Столбец {column} должен входить в group by"
+                    )
+            for column, _ in order_by or []:
+                if column not in names:
+                    raise CommandError(
+                        f"Сортировка с group by возможна только по столбцам результата: {column}"
                     )
-                where_clause = ' '.join(tokens[where_index + 1:])
-            
-            try:
-                where_node = ast.parse(where_clause, mode='eval')
-            except SyntaxError:
-                raise CommandError(
-                    f"Некорректное условие WHERE: {where_clause}"                    
-                )
-            
-            db.delete(table_name, where=lambda row: eval_node(where_node, row))
-            return db.select(table_name, ['*'])
 
-        elif action == 'update':
-            if len(tokens) < 5 or tokens[2] != 'set':
-                raise CommandError(
-                    "Ожидаемый синтаксис:\n"
-                    "update <таблица> set <столбец1> <значение1> [<столбец2> <значение2> ...] [where <условие>]"                    
-                )
-            
-            table_name = tokens[1]
-            where_index = tokens.index('where') if 'where' in tokens else len(tokens)
-            
-            if (where_index - 3) % 2 != 0:
-                raise CommandError(
-                    "Нечетное количество аргументов в SET\n"
-                    "Ожидается пары: <столбец> <значение>"                    
-                )
-            
-            try:
-                updates = {}
-                i = 3
-                while i < where_index:
-                    col = tokens[i]
-                    val = eval_node(ast.parse(tokens[i+1], mode='eval'))
-                    updates[col] = val
-                    i += 2
-            except Exception as e:
-                raise CommandError(
-                    f"Ошибка в аргументах SET: {str(e)}\n"
-                    "Ожидается: update <таблица> set <столбец1> <значение1> [<столбец2> <значение2>...]"                    
-                )
-            
-            where_clause = 'True'
-            if 'where' in tokens:
-                if where_index == len(tokens) - 1:
+        where_node = parse_where(tokens, where_index)
+
+        def run(db, params, echo, stream):
+            limit = page_value('limit', params, None)
+            offset = page_value('offset', params, 0)
+            where = bind(where_node, params)
+            if join is not None:
+                return db.join(table_name, join[0], join[1], columns, where=where, limit=limit, offset=offset,
+                               order_by=order_by)
+            if aggregates or group_by is not None:
+                res_column, res_data = db.aggregate(table_name, aggregates, group_by or [], where=where)
+                if order_by:
+                    key, reverse = order_key(order_by)
+                    res_data.sort(key=key, reverse=reverse)
+                res_data = res_data[offset:None if limit is None else offset + limit]
+                return {n: res_column[n] for n in names}, [{n: row[n] for n in names} for row in res_data]
+            if stream:
+                return (db.select(table_name, columns, limit=0)[0],
+                        db.select_iter(table_name, columns, where=where, limit=limit, offset=offset, order_by=order_by))
+            return db.select(table_name, columns, where=where, limit=limit, offset=offset, order_by=order_by)
+
+        def describe(db, params):
+            if join is not None:
+                return db.explain_join(table_name, join[0], join[1], columns, bind(where_node, params))
+            return db.explain(table_name, bind(where_node, params), page_value('limit', params, None))
+
+        explain = describe
+
+    elif action == 'delete':
+        if len(tokens) < 3 or tokens[1] != 'from':
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "delete from <таблица> [where <условие>]"
+            )
+
+        table_name = tokens[2]
+        where_node = parse_where(tokens, tokens.index('where')) if 'where' in tokens else ast.parse('True', mode='eval')
+
+        def run(db, params, echo, stream):
+            db.delete(table_name, where=bind(where_node, params))
+            if not echo:
+                return [], [{}]
+            return show_table(db, table_name, stream)
+
+        def describe(db, params):
+            return db.explain(table_name, bind(where_node, params))
+
+        explain = describe
+
+    elif action == 'update':
+        if len(tokens) < 5 or tokens[2] != 'set':
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "update <таблица> set <столбец1> <значение1> [<столбец2> <значение2> ...] [where <условие>]"
+            )
+
+        table_name = tokens[1]
+        where_index = tokens.index('where') if 'where' in tokens else len(tokens)
+
+        if (where_index - 3) % 2 != 0:
+            raise CommandError(
+                "Нечетное количество аргументов в SET\n"
+                "Ожидается пары: <столбец> <значение>"
+            )
+
+        try:
+            updates = {}
+            i = 3
+            while i < where_index:
+                updates[tokens[i]] = ast.parse(tokens[i + 1], mode='eval').body
+                i += 2
+            if not keys:
+                updates = {col: eval_node(node) for col, node in updates.items()}
+        except Exception as e:
+            raise CommandError(
+                f"Ошибка в аргументах SET: {str(e)}\n"
+                "Ожидается: update <таблица> set <столбец1> <значение1> [<столбец2> <значение2>...]"
+            )
+
+        where_node = parse_where(tokens, where_index) if 'where' in tokens else ast.parse('True', mode='eval')
+
+        def run(db, params, echo, stream):
+            values = updates
+            if keys:
+                try:
+                    values = {col: eval_node(node, params) for col, node in updates.items()}
+                except Exception as e:
                     raise CommandError(
-                        "Отсутствует условие после where"                        
+                        f"Ошибка в аргументах SET: {str(e)}\n"
+                        "Ожидается: update <таблица> set <столбец1> <значение1> [<столбец2> <значение2>...]"
                     )
-                where_clause = ' '.join(tokens[where_index + 1:])
-            
-            try:
-                where_node = ast.parse(where_clause, mode='eval')
-            except SyntaxError:
-                raise CommandError(
-                    f"Некорректное условие WHERE: {where_clause}"                    
-                )
-            
-            db.update(table_name, updates, where=lambda row: eval_node(where_node, row))
-            return db.select(table_name, ['*'])
-        
-        elif action == 'drop':
-            if len(tokens) != 3 or tokens[1] != 'table':
-                raise CommandError(
-                    "Ожидаемый синтаксис:\n"
-                    "drop table <имя_таблицы>"                    
-                )
-            
-            table_name = tokens[2]
-            db.drop_table(table_name)
+            db.update(table_name, values, where=bind(where_node, params))
+            if not echo:
+                return [], [{}]
+            return show_table(db, table_name, stream)
+
+        def describe(db, params):
+            return db.explain(table_name, bind(where_node, params))
+
+        explain = describe
+
+    elif action == 'explain':
+        analyze = EXPLAIN_PREFIX.match(command)[1] is not None
+        inner_command = command[EXPLAIN_PREFIX.match(command).end():].strip()
+        if not inner_command:
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "explain [analyze] <команда>"
+            )
+        inner = _prepare(inner_command)
+        if not analyze and inner.explain is None:
+            raise CommandError(
+                "explain без analyze применим к командам select, update и delete"
+            )
+
+        def run(db, params, echo, stream):
+            if not analyze:
+                return {'name': 2, 'value': 2}, [{'name': k, 'value': v} for k, v in inner.explain(db, params).items()]
+            # Команда выполняется без вывода содержимого таблицы, чтобы он не попал в счётчики
+            with db.collect_stats() as stats:
+                result = inner.run(db, params, False, False)
+            rows = [{'name': k, 'value': v} for k, v in stats.as_dict().items()]
+            if isinstance(result, tuple) and result[0]:
+                rows.append({'name': 'rows_returned', 'value': len(result[1])})
+            return {'name': 2, 'value': 2}, rows
+
+    elif action in ('begin', 'commit', 'rollback', 'checkpoint'):
+        if len(tokens) != 1:
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                f"{action}"
+            )
+
+        def run(db, params, echo, stream):
+            getattr(db, action)()
             return [], [{}]
-        
-        else:
+
+    elif action == 'copy':
+        match = COPY_COMMAND.fullmatch(text)
+        if match is None:
             raise CommandError(
-                f"Неизвестная команда: {action}\n"
-                "Доступные команды:\n"
-                "create table/database ...\n"
-                "drop table ...\n"
-                "insert into ...\n"
-                "select ... from ...\n"
-                "update ... set ...\n"
-                "delete from ..."
+                "Ожидаемый синтаксис:\n"
+                "copy <таблица> from '<файл>' [csv|jsonl]\n"
+                "или\n"
+                "copy <таблица> to '<файл>' [csv|jsonl]"
             )
+        table_name, direction, path, format = match.groups()
+        direction = direction.lower()
+        format = format.lower() if format else None
+        if path[0] in '\'"':
+            path = path[1:-1]
 
-    except Exception:
-        raise
-    except Exception as e:
-        raise CommandError(f"Ошибка выполнения команды: {str(e)}")
\ No newline at end of file
+        def run(db, params, echo, stream):
+            target = params[path] if path.startswith(PARAM_PREFIX) else path
+            if direction == 'from':
+                return {'copied': 0}, [{'copied': db.copy_from(table_name, target, format)}]
+            return {'copied': 0}, [{'copied': db.copy_to(table_name, target, format)}]
+
+    elif action == 'vacuum':
+        if len(tokens) not in (2, 3) or (len(tokens) == 3 and not tokens[2].isdigit() and tokens[2].lower() != 'heap'):
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "vacuum <таблица> [<число_страниц>]\n"
+                "или\n"
+                "vacuum <таблица> heap"
+            )
+
+        def run(db, params, echo, stream):
+            if len(tokens) == 3 and tokens[2].lower() == 'heap':
+                freed = db.compact_heap(tokens[1])
+            elif len(tokens) == 3:
+                freed = db.vacuum(tokens[1], int(tokens[2]))
+            else:
+                freed = db.vacuum(tokens[1])
+            return {'freed': 0}, [{'freed': freed}]
+
+    elif action == 'drop':
+        if len(tokens) == 5 and tokens[1] == 'index' and tokens[2] == 'on':
+            def run(db, params, echo, stream):
+                db.drop_index(tokens[3], tokens[4])
+                return [], [{}]
+
+        elif len(tokens) != 3 or tokens[1] != 'table':
+            raise CommandError(
+                "Ожидаемый синтаксис:\n"
+                "drop table <имя_таблицы>\n"
+                "или\n"
+                "drop index on <имя_таблицы> <столбец>"
+            )
+
+        else:
+            def run(db, params, echo, stream):
+                db.drop_table(tokens[2])
+                return [], [{}]
+
+    else:
+        raise CommandError(
+            f"Неизвестная команда: {action}\n"
+            "Доступные команды:\n"
+            "create table/index/database ...\n"
+            "drop table/index ...\n"
+            "insert into ...\n"
+            "select ... from ...\n"
+            "update ... set ...\n"
+            "delete from ...\n"
+            "vacuum <таблица> [<число_страниц>|heap]\n"
+            "copy <таблица> from/to '<файл>'\n"
+            "begin / commit / rollback / checkpoint\n"
+            "explain [analyze] <команда>"
+        )
+
+    return Statement(command, run, keys, explain)
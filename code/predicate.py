@@ -0,0 +1,365 @@
+import ast
+import copy
+import operator
+
+BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+CMP_OPS = {
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+UNARY_OPS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: operator.not_,
+}
+
+def column_names(node: ast.AST) -> set:
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+def validate(node: ast.AST, columns=None):
+    # Допускаются только узлы, которые умеет вычислять eval_node
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name):
+            if columns is not None and n.id not in columns:
+                raise NameError(f'Column {n.id} does not exist')
+        elif isinstance(n, ast.BinOp):
+            if type(n.op) not in BIN_OPS:
+                raise ValueError(f'Unsupported operator: {type(n.op).__name__}')
+        elif isinstance(n, ast.Compare):
+            for op in n.ops:
+                if type(op) not in CMP_OPS:
+                    raise ValueError(f'Unsupported operator: {type(op).__name__}')
+        elif isinstance(n, ast.UnaryOp):
+            if type(n.op) not in UNARY_OPS:
+                raise ValueError(f'Unsupported operator: {type(n.op).__name__}')
+        elif not isinstance(n, (ast.Expression, ast.Constant, ast.BoolOp, ast.And, ast.Or, ast.Load,
+                                ast.Tuple, ast.List, ast.Set, ast.Dict, *BIN_OPS, *CMP_OPS, *UNARY_OPS)):
+            raise ValueError(f'Unsupported AST node type: {type(n).__name__}')
+
+
+def pad_string(value: str, size: int):
+    # Строка в том виде, в котором она хранится в записи; None, если сравнение по байтам невозможно
+    raw = value.encode('utf-8')
+    if len(raw) >= size or b'\x00' in raw:
+        return None
+    return raw.ljust(size, b'\x00')
+
+
+class _Folder(ast.NodeTransformer):
+    # Свёртка подвыражений без ссылок на столбцы в константы
+    def generic_visit(self, node):
+        node = super().generic_visit(node)
+        if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp, ast.Tuple, ast.List, ast.Set)) \
+                and not column_names(node):
+            value = eval(compile(ast.fix_missing_locations(ast.Expression(body=node)), '<where>', 'eval'),
+                         {'__builtins__': {}})
+            if isinstance(value, list):
+                value = tuple(value)
+            return ast.copy_location(ast.Constant(value=value), node)
+        return node
+
+
+class _Binder(ast.NodeTransformer):
+    # Замена имён столбцов обращениями к позициям кортежа записи
+    def __init__(self, layout: dict, codes=None):
+        self.layout = layout
+        self.codes = codes
+
+    def _raw(self, name):
+        index, _ = self.layout[name]
+        return ast.Subscript(value=ast.Name(id='row', ctx=ast.Load()), slice=ast.Constant(value=index), ctx=ast.Load())
+
+    def visit_Name(self, node):
+        access = self._raw(node.id)
+        if self.layout[node.id][1] is not None:
+            access = ast.Call(func=ast.Name(id='_decode', ctx=ast.Load()), args=[access], keywords=[])
+        return ast.copy_location(access, node)
+
+    def _raw_operand(self, operand, size: int, container: bool):
+        if isinstance(operand, ast.Name):
+            return self._raw(operand.id) if abs(self.layout[operand.id][1]) == size and not container else None
+        if not isinstance(operand, ast.Constant):
+            return None
+        value = operand.value
+        if container:
+            if isinstance(value, frozenset) and all(isinstance(v, str) for v in value):
+                padded = {pad_string(v, size) for v in value}
+                return None if None in padded else ast.Constant(value=frozenset(padded))
+        elif isinstance(value, str):
+            padded = pad_string(value, size)
+            return None if padded is None else ast.Constant(value=padded)
+        return None
+
+    def _code_operand(self, operand, container: bool):
+        # Строка, отсутствующая в словаре, получает код -1, не совпадающий ни с одним полем
+        if isinstance(operand, ast.Name):
+            return None if container else self._raw(operand.id)
+        if not isinstance(operand, ast.Constant):
+            return None
+        value = operand.value
+        if container:
+            if isinstance(value, frozenset) and all(isinstance(v, str) for v in value):
+                return ast.Constant(value=frozenset(self.codes.get(v, -1) for v in value))
+        elif isinstance(value, str):
+            return ast.Constant(value=self.codes.get(value, -1))
+        return None
+
+    def visit_Compare(self, node):
+        # Столбцы dict хранят коды общего словаря таблицы, поэтому на равенство сравниваются
+        # коды: и между собой, и с кодами строк-констант
+        operands = [node.left, *node.comparators]
+        sizes = {self.layout[o.id][1] for o in operands if isinstance(o, ast.Name)}
+        if sizes == {0} and self.codes is not None \
+                and all(isinstance(op, (ast.Eq, ast.NotEq, ast.In, ast.NotIn)) for op in node.ops):
+            raw = [self._code_operand(o, i > 0 and isinstance(node.ops[i - 1], (ast.In, ast.NotIn)))
+                   for i, o in enumerate(operands)]
+            if None not in raw:
+                return ast.copy_location(ast.Compare(left=raw[0], ops=node.ops, comparators=raw[1:]), node)
+        # Строковый столбец сравнивается с константой без декодирования: байты UTF-8,
+        # дополненные нулями, упорядочены так же, как сами строки. Поле строки переменной
+        # длины (отрицательный размер) может ссылаться на кучу, но короткая строка хранится
+        # в записи всегда, поэтому с короткой константой его можно сравнивать только на равенство
+        if len(sizes) == 1 and None not in sizes and 0 not in sizes and (min(sizes) > 0 or (
+                all(isinstance(op, (ast.Eq, ast.NotEq, ast.In, ast.NotIn)) for op in node.ops)
+                and sum(isinstance(o, ast.Name) for o in operands) == 1)):
+            size = abs(sizes.pop())
+            raw = [self._raw_operand(o, size, i > 0 and isinstance(node.ops[i - 1], (ast.In, ast.NotIn)))
+                   for i, o in enumerate(operands)]
+            if None not in raw:
+                return ast.copy_location(ast.Compare(left=raw[0], ops=node.ops, comparators=raw[1:]), node)
+        return self.generic_visit(node)
+
+
+class _Qualifier(ast.NodeTransformer):
+    # Замена имён столбцов (в том числе вида таблица.столбец) результатом resolve
+    def __init__(self, resolve):
+        self.resolve = resolve
+
+    def visit_Name(self, node):
+        return ast.copy_location(ast.Name(id=self.resolve(node.id), ctx=ast.Load()), node)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.value, ast.Name):
+            raise ValueError('Unsupported AST node type: Attribute')
+        return ast.copy_location(ast.Name(id=self.resolve(f'{node.value.id}.{node.attr}'), ctx=ast.Load()), node)
+
+
+def qualify(node: ast.AST, resolve) -> ast.AST:
+    """Копия условия, в которой каждое имя столбца name заменено на resolve(name)."""
+    return _Qualifier(resolve).visit(copy.deepcopy(node))
+
+
+def conjuncts(node: ast.AST) -> list:
+    # Условия, объединённые на верхнем уровне через and
+    if isinstance(node, ast.Expression):
+        node = node.body
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        return [c for value in node.values for c in conjuncts(value)]
+    return [node]
+
+
+def conjunction(nodes: list):
+    # Условие из списка конъюнктов; None для пустого списка
+    if not nodes:
+        return None
+    return ast.Expression(body=nodes[0] if len(nodes) == 1 else ast.BoolOp(op=ast.And(), values=nodes))
+
+
+def fold(node: ast.AST) -> ast.AST:
+    if isinstance(node, ast.Expression):
+        node = node.body
+    return _Folder().visit(copy.deepcopy(node))
+
+
+def compile_where(node: ast.AST, layout: dict, decode, codes=None):
+    """Компилирует условие WHERE в функцию от кортежа записи.
+
+    layout сопоставляет имени столбца пару (позиция в кортеже, размер строкового поля или None;
+    для поля text размер отрицательный, для поля dict -- 0), decode преобразует поле строкового
+    столбца в строку, codes сопоставляет строкам словаря их коды.
+    """
+    validate(node, layout)
+    body = fold(node)
+    if isinstance(body, ast.Constant):
+        return (lambda row: True) if body.value else (lambda row: False)
+    for n in ast.walk(body):
+        if isinstance(n, ast.Compare):
+            for op, right in zip(n.ops, n.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)) and isinstance(right, ast.Constant) and isinstance(right.value, tuple):
+                    try:
+                        right.value = frozenset(right.value)
+                    except TypeError:
+                        pass
+    body = _Binder(layout, codes).visit(body)
+    tree = ast.Expression(body=ast.Lambda(
+        args=ast.arguments(posonlyargs=[], args=[ast.arg(arg='row')], kwonlyargs=[], kw_defaults=[], defaults=[]),
+        body=body))
+    code = compile(ast.fix_missing_locations(tree), '<where>', 'eval')
+    return eval(code, {'__builtins__': {}, '_decode': decode})
+
+
+FLIPPED = {ast.Gt: ast.Lt, ast.GtE: ast.LtE, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Eq: ast.Eq}
+
+
+def index_ranges(node: ast.AST, column: str, size=None):
+    """Диапазоны значений столбца, которыми условие ограничено через конъюнкцию сравнений.
+
+    Возвращает список (lo, lo_inclusive, hi, hi_inclusive) или None, если индекс неприменим;
+    точечное значение задаётся как lo == hi. size -- размер строкового поля, None для чисел.
+    """
+    body = fold(node)
+    conjuncts = body.values if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And) else [body]
+
+    def convert(value):
+        if size is not None:
+            return pad_string(value, size) if isinstance(value, str) else None
+        return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+    lo, lo_inclusive, hi, hi_inclusive = None, True, None, True
+    points = None
+    found = False
+    for conjunct in conjuncts:
+        if not isinstance(conjunct, ast.Compare):
+            continue
+        operands = [conjunct.left, *conjunct.comparators]
+        for op, left, right in zip(conjunct.ops, operands, operands[1:]):
+            op = type(op)
+            if isinstance(left, ast.Name) and left.id == column and isinstance(right, ast.Constant):
+                value = right.value
+            elif isinstance(right, ast.Name) and right.id == column and isinstance(left, ast.Constant) and op in FLIPPED:
+                value, op = left.value, FLIPPED[op]
+            else:
+                continue
+            if op is ast.In:
+                if not isinstance(value, (tuple, frozenset)):
+                    continue
+                values = {convert(v) for v in value}
+                if None in values:
+                    continue
+                points = values if points is None else points & values
+            elif op in FLIPPED:
+                value = convert(value)
+                if value is None:
+                    continue
+                if op is ast.Eq:
+                    points = {value} if points is None else points & {value}
+                if op in (ast.Gt, ast.GtE, ast.Eq):
+                    inclusive = op is not ast.Gt
+                    if lo is None or value > lo or (value == lo and not inclusive):
+                        lo, lo_inclusive = value, inclusive
+                if op in (ast.Lt, ast.LtE, ast.Eq):
+                    inclusive = op is not ast.Lt
+                    if hi is None or value < hi or (value == hi and not inclusive):
+                        hi, hi_inclusive = value, inclusive
+            else:
+                continue
+            found = True
+    if not found:
+        return None
+    if points is not None:
+        return [(p, True, p, True) for p in sorted(points)
+                if (lo is None or p > lo or (p == lo and lo_inclusive)) and (hi is None or p < hi or (p == hi and hi_inclusive))]
+    return [(lo, lo_inclusive, hi, hi_inclusive)]
+
+
+def range_overlaps(bounds, low, high) -> bool:
+    # Пересекается ли диапазон из index_ranges с отрезком [low, high]
+    lo, lo_inclusive, hi, hi_inclusive = bounds
+    if lo is not None and (high < lo or (high == lo and not lo_inclusive)):
+        return False
+    if hi is not None and (low > hi or (low == hi and not hi_inclusive)):
+        return False
+    return True
+
+
+def vector_mask(node: ast.AST, columns: dict, np):
+    """Вычисляет условие сразу для всех записей страницы.
+
+    columns сопоставляет имени столбца массив его значений, строковые столбцы хранятся
+    массивами байтов. Возвращает булев массив; TypeError, если условие не сводится
+    к поэлементным операциям над массивами или если деление на ноль либо переполнение
+    делают результат отличным от построчного вычисления (там они приводят к исключению,
+    а целые числа не ограничены 64 битами).
+    """
+    size = len(next(iter(columns.values()))) if columns else 0
+
+    def truth(value):
+        value = np.asarray(value)
+        if value.dtype != bool:
+            value = value != 0
+        return np.broadcast_to(value, (size,))
+
+    def constant(value):
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        if isinstance(value, (tuple, frozenset)):
+            return [constant(v) for v in value]
+        return value
+
+    def arithmetic(op, *operands):
+        result = op(*operands)
+        if np.asarray(result).dtype.kind in 'iu':
+            # Целые numpy переполняются молча: если оценка результата в float64 близка
+            # к границе int64, условие вычисляется построчно
+            estimate = op(*(np.asarray(v, np.float64) for v in operands))
+            if np.any(np.abs(estimate) >= 2.0 ** 62):
+                raise TypeError('Возможно переполнение 64-битных целых')
+        return result
+
+    def ev(n):
+        if isinstance(n, ast.Name):
+            return columns[n.id]
+        if isinstance(n, ast.Constant):
+            return constant(n.value)
+        if isinstance(n, ast.BinOp):
+            return arithmetic(BIN_OPS[type(n.op)], ev(n.left), ev(n.right))
+        if isinstance(n, ast.UnaryOp):
+            if isinstance(n.op, ast.Not):
+                return ~truth(ev(n.operand))
+            return arithmetic(UNARY_OPS[type(n.op)], ev(n.operand))
+        if isinstance(n, ast.BoolOp):
+            masks = [truth(ev(v)) for v in n.values]
+            result = masks[0]
+            for mask in masks[1:]:
+                result = result & mask if isinstance(n.op, ast.And) else result | mask
+            return result
+        if isinstance(n, ast.Compare):
+            result = None
+            left = ev(n.left)
+            for op, comparator in zip(n.ops, n.comparators):
+                right = ev(comparator)
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    if not isinstance(right, list):
+                        raise TypeError('Оператор in требует константный набор значений')
+                    mask = np.isin(left, right)
+                    if isinstance(op, ast.NotIn):
+                        mask = ~mask
+                else:
+                    mask = CMP_OPS[type(op)](left, right)
+                mask = truth(mask)
+                result = mask if result is None else result & mask
+                left = right
+            return result
+        raise TypeError(f'Unsupported AST node type: {type(n).__name__}')
+
+    validate(node, columns)
+    with np.errstate(all='raise', under='ignore'):
+        try:
+            return truth(ev(fold(node)))
+        except (TypeError, ValueError, ArithmeticError) as e:
+            raise TypeError(str(e)) from e
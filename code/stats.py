@@ -0,0 +1,69 @@
+import time
+
+# Счётчики команды в порядке вывода explain analyze
+COUNTERS = (
+    'pages_read',
+    'pages_skipped',
+    'rows_scanned',
+    'rows_matched',
+    'bytes_unpacked',
+    'index_lookups',
+    'pool_hits',
+    'pool_misses',
+    'pages_written',
+)
+TIMERS = ('total_time', 'read_time', 'predicate_time')
+
+
+class QueryStats:
+    """Счётчики выполнения команды.
+
+    Собираются, только пока коллектор установлен в Database.stats; без него операции
+    проверяют атрибут один раз на просмотр или страницу и не замедляются на каждой записи.
+    read_time -- время чтения страниц, predicate_time -- время вычисления условия WHERE.
+    """
+
+    def __init__(self):
+        for name in COUNTERS + TIMERS:
+            setattr(self, name, 0)
+        self.access = []
+        self._pool = None
+        self._started = None
+
+    def start(self, pool):
+        self._pool = (pool.hits, pool.misses, pool.writes)
+        self._started = time.perf_counter()
+
+    def finish(self, pool):
+        self.total_time += time.perf_counter() - self._started
+        hits, misses, writes = self._pool
+        self.pool_hits += pool.hits - hits
+        self.pool_misses += pool.misses - misses
+        self.pages_written += pool.writes - writes
+
+    def path(self, description: str):
+        # Способ доступа к таблице; повторы одного способа в команде не дублируются
+        if description not in self.access:
+            self.access.append(description)
+
+    def timed(self, func, timer: str):
+        # Обёртка, добавляющая время каждого вызова func к таймеру timer
+        clock = time.perf_counter
+
+        def wrapper(arg):
+            started = clock()
+            try:
+                return func(arg)
+            finally:
+                setattr(self, timer, getattr(self, timer) + clock() - started)
+        return wrapper
+
+    def merge(self, other: 'QueryStats'):
+        # Накопление итогов; способы доступа относятся к отдельной команде и не суммируются
+        for name in COUNTERS + TIMERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def as_dict(self) -> dict:
+        result = {name: getattr(self, name) for name in COUNTERS + TIMERS}
+        result['access'] = '; '.join(self.access)
+        return result
@@ -0,0 +1,268 @@
+import os
+import threading
+import zlib
+from struct import Struct
+
+MAGIC = b'VKRWAL01'
+# Запись журнала: смещение в основном файле и длина образа; у записи фиксации
+# вместо смещения COMMIT, а вместо длины -- контрольная сумма транзакции
+RECORD = Struct('=QI')
+COMMIT = 256**8 - 1
+# Записи журнала накапливаются перед записью в файл порциями такого размера
+WRITE_BUFFER = 1 << 20
+
+
+class PageImages(dict):
+    # Номер страницы -> смещение её образа в файле журнала; образ читается из журнала
+    # при обращении через get, поэтому в памяти хранятся только смещения
+    def __init__(self, wal: 'WriteAheadLog'):
+        super().__init__()
+        self.wal = wal
+
+    def get(self, page, default=None):
+        offset = super().get(page)
+        return default if offset is None else self.wal.read(offset)
+
+
+class WriteAheadLog:
+    """Журнал упреждающей записи рядом с файлом БД.
+
+    Зафиксированные транзакции дописываются в журнал как образы изменённых областей файла
+    и до контрольной точки доступны через pages -- образы страниц данных по номерам (читаются
+    из журнала) и meta -- образы заголовка и метаданных таблиц по смещениям (хранятся в памяти).
+    Страницы большой транзакции могут быть записаны в журнал до её фиксации (spill): до commit
+    они видны только этому объекту, rollback и восстановление после сбоя их отбрасывают. Фиксация считается выполненной
+    после fsync журнала (wait); фиксации параллельных потоков сбрасываются на диск одним fsync.
+    """
+
+    def __init__(self, path: str, base_offset: int, page_size: int, group_commit: int = 32, commit_delay: float = 0.01):
+        self.path = path
+        self.base_offset = base_offset
+        self.page_size = page_size
+        self.group_commit = group_commit
+        self.commit_delay = commit_delay
+        self.pages = PageImages(self)
+        self.meta = {}
+        # Конец последней зафиксированной транзакции в файле, контрольная сумма записей после
+        # него и прежние смещения страниц, переписанных незафиксированными записями
+        self.end = len(MAGIC)
+        self._crc = 0
+        self._undo = {}
+        self.frames = 0
+        self.commits = 0
+        self.syncs = 0
+        # Номера последней дописанной и последней сброшенной на диск фиксаций; fsync выполняет
+        # один из ожидающих потоков, остальные ждут его под _state
+        self.written = 0
+        self.synced = 0
+        self._syncing = False
+        self._waiting = 0
+        self._state = threading.Condition()
+        self.file = None
+        self.open()
+
+    @property
+    def pending(self) -> int:
+        return self.written - self.synced
+
+    def open(self):
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as file:
+                file.write(MAGIC)
+        self.file = open(self.path, 'r+b', buffering=0)
+
+    def load(self):
+        # Восстанавливает образы зафиксированных транзакций; оборванный хвост журнала отбрасывается.
+        # Журнал читается по записям, образы страниц в памяти не сохраняются
+        self.pages.clear()
+        self.meta.clear()
+        self.frames = 0
+        self._undo.clear()
+        self._crc = 0
+        file = self.file
+        file.seek(0)
+        pos = valid = len(MAGIC)
+        size = os.fstat(file.fileno()).st_size
+        if file.read(len(MAGIC)) != MAGIC:
+            size = 0
+        crc = 0
+        writes = []
+        while pos + RECORD.size <= size:
+            header = file.read(RECORD.size)
+            offset, length = RECORD.unpack(header)
+            if offset == COMMIT:
+                if crc != length:
+                    break
+                pos += RECORD.size
+                for offset, image in writes:
+                    self._remember(offset, image)
+                writes = []
+                crc = 0
+                valid = pos
+                continue
+            if pos + RECORD.size + length > size:
+                break
+            image = file.read(length)
+            crc = zlib.crc32(image, zlib.crc32(header, crc))
+            writes.append((offset, pos + RECORD.size if offset >= self.base_offset else image))
+            pos += RECORD.size + length
+        self.end = valid
+        if valid != os.fstat(file.fileno()).st_size or size == 0:
+            if size == 0:
+                file.seek(0)
+                file.write(MAGIC)
+            file.truncate(valid)
+            os.fsync(file.fileno())
+
+    def _remember(self, offset: int, image):
+        # Для страниц данных image -- смещение образа в журнале, для метаданных -- сам образ
+        if offset >= self.base_offset:
+            self.pages[(offset - self.base_offset) // self.page_size] = image
+            self.frames += 1
+        else:
+            self.meta[offset] = image
+
+    def read(self, position: int) -> bytes:
+        self.file.seek(position)
+        return self.file.read(self.page_size)
+
+    def _append(self, writes):
+        # Дописывает записи образов после конца файла порциями до WRITE_BUFFER байт;
+        # прежние смещения переписанных страниц запоминаются для rollback
+        position = self.file.seek(0, os.SEEK_END)
+        buffer = bytearray()
+        for offset, image in writes:
+            header = RECORD.pack(offset, len(image))
+            self._crc = zlib.crc32(image, zlib.crc32(header, self._crc))
+            if offset >= self.base_offset:
+                page = (offset - self.base_offset) // self.page_size
+                if page not in self._undo:
+                    self._undo[page] = dict.get(self.pages, page)
+                self._remember(offset, position + len(buffer) + RECORD.size)
+            else:
+                self.meta[offset] = bytes(image)
+            buffer += header
+            buffer += image
+            if len(buffer) >= WRITE_BUFFER:
+                self.file.write(buffer)
+                position += len(buffer)
+                buffer = bytearray()
+        self.file.write(buffer)
+
+    @property
+    def uncommitted(self) -> bool:
+        return bool(self._undo)
+
+    def spill(self, writes: list):
+        """Записывает образы страниц незафиксированной транзакции, чтобы освободить буферный пул."""
+        self._append(writes)
+
+    def rollback(self):
+        # Отбрасывает записанные до фиксации образы страниц
+        if not self._undo:
+            return
+        for page, position in self._undo.items():
+            if position is None:
+                self.pages.pop(page, None)
+            else:
+                self.pages[page] = position
+        self._undo.clear()
+        self._crc = 0
+        self.file.truncate(self.end)
+
+    def commit(self, writes: list) -> int:
+        """Дописывает транзакцию в журнал и возвращает её номер для wait.
+
+        writes -- список (смещение в основном файле, образ); вместе с ними фиксируются образы,
+        записанные spill. Фиксация не переживает сбой, пока wait с этим номером не вернул управление.
+        """
+        self._append(writes)
+        self.file.write(RECORD.pack(COMMIT, self._crc))
+        self.end = self.file.tell()
+        self._crc = 0
+        self._undo.clear()
+        self.commits += 1
+        with self._state:
+            self.written += 1
+            if self.pending >= self.group_commit:
+                self._state.notify_all()
+            return self.written
+
+    def wait(self, ticket: int):
+        # Ждёт fsync журнала, покрывающего фиксацию ticket. Первый ожидающий поток выполняет
+        # fsync за все дописанные к этому времени фиксации; если другие потоки тоже ждут,
+        # он до commit_delay секунд собирает ещё фиксации, но не больше group_commit
+        with self._state:
+            self._waiting += 1
+            try:
+                while self.synced < ticket:
+                    if self._syncing:
+                        self._state.wait()
+                        continue
+                    self._syncing = True
+                    try:
+                        if self._waiting > 1 and self.commit_delay and self.pending < self.group_commit:
+                            self._state.wait(self.commit_delay)
+                        target = self.written
+                        fileno = self.file.fileno()
+                        self._state.release()
+                        try:
+                            os.fsync(fileno)
+                        finally:
+                            self._state.acquire()
+                        self.synced = max(self.synced, target)
+                        self.syncs += 1
+                    finally:
+                        self._syncing = False
+                        self._state.notify_all()
+            finally:
+                self._waiting -= 1
+
+    def sync(self):
+        self.wait(self.written)
+
+    def patch(self, offset: int, data: bytearray):
+        # Накладывает зафиксированные образы заголовка и метаданных на прочитанную из файла область
+        end = offset + len(data)
+        for start, image in self.meta.items():
+            lo, hi = max(start, offset), min(start + len(image), end)
+            if lo < hi:
+                data[lo - offset:hi - offset] = image[lo - start:hi - start]
+
+    def checkpoint(self, file):
+        # Перенос образов в основной файл; журнал очищается только после записи файла на диск
+        # Пока в журнале есть незафиксированные образы, перенос откладывается
+        self.sync()
+        if (not self.pages and not self.meta) or self._undo:
+            return False
+        for offset in sorted(self.meta):
+            file.seek(offset)
+            file.write(self.meta[offset])
+        for page in sorted(self.pages):
+            file.seek(self.base_offset + page * self.page_size)
+            file.write(self.pages.get(page))
+        file.flush()
+        os.fsync(file.fileno())
+        self.file.truncate(len(MAGIC))
+        os.fsync(self.file.fileno())
+        self.end = len(MAGIC)
+        self.pages.clear()
+        self.meta.clear()
+        self.frames = 0
+        return True
+
+    def close(self):
+        self.sync()
+        with self._state:
+            while self._syncing:
+                self._state.wait()
+            self.file.close()
+            self.file = None
+
+    def stats(self) -> dict:
+        return {
+            'commits': self.commits,
+            'syncs': self.syncs,
+            'pending': self.pending,
+            'frames': self.frames,
+        }